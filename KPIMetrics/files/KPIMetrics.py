@@ -1,18 +1,135 @@
+import gc
+import math
 import json
 import os
+import re
+import time
+import sqlite3
+import multiprocessing
 import argparse
 import collect_agent
+import numpy as np
+
+
+HANDOVER_WINDOW = 10  # s
+SETTLE_TOLERANCE = 0.1
+CWND_RECOVERY_RATIO = 0.9
+JOIN_BIN = 1  # s
+FLOW_INDEX_FILE = "flow_index.jsonl"
+# Spazi di numerazione dei pacchetti QUIC (0-RTT e 1-RTT condividono lo spazio application data)
+PACKET_SPACES = {"initial": 0, "handshake": 1, "0RTT": 2, "1RTT": 2}
+PACKET_SPACE_SHIFT = 56
+PACKET_SPACES_BYTES = {kind.encode(): space for kind, space in PACKET_SPACES.items()}
+PACKET_EVENT = re.compile(rb'"name":\s*"transport:packet_(sent|received)"')
+PACKET_TIME = re.compile(rb'"time":\s*([-+.\deE]+)')
+PACKET_TYPE = re.compile(rb'"packet_type":\s*"(\w+)"')
+PACKET_NUMBER = re.compile(rb'"packet_number":\s*(\d+)')
+PACKET_FAST = re.compile(
+    rb'"time":\s*([-+.\deE]+),\s*"name":\s*"transport:packet_(sent|received)",\s*"data":\s*\{\s*"header":\s*\{'
+    rb'[^{}]*?"packet_type":\s*"(\w+)"[^{}]*?"packet_number":\s*(\d+)')
+PACKET_CHUNK = 32 * 1024 * 1024
+SKETCH_QUANTILES = (50, 90, 99, 99.9)
+RESULTS_DB = "results.sqlite"
+RESULTS_DB_TIMEOUT = 10  # s
+
+
+def open_results(log_directory):
+    """Database dei risultati scritto dai job quicos in log_directory, se presente"""
+    path = os.path.join(log_directory, RESULTS_DB)
+    if not os.path.exists(path):
+        return None
+    db = sqlite3.connect(path, timeout=RESULTS_DB_TIMEOUT)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def select_folders(log_directory, n_servers):
+    """Le ultime n_servers cartelle più recenti di log_directory
+
+    Dal database dei risultati quando i server vi registrano le esecuzioni,
+    altrimenti dai nomi (data e ora) delle cartelle.
+    """
+    db = open_results(log_directory)
+    if db is not None:
+        try:
+            rows = db.execute(
+                    "SELECT log_dir, MAX(started) AS last FROM runs WHERE role = 'server' AND log_dir IS NOT NULL "
+                    "GROUP BY log_dir ORDER BY last DESC LIMIT ?", (n_servers,)).fetchall()
+            folders = [row["log_dir"] for row in rows if os.path.isdir(row["log_dir"])]
+            if folders:
+                return folders
+        except sqlite3.Error as e:
+            print(f"Errore del database dei risultati: {e}")
+        finally:
+            db.close()
 
-def calculate_server_fairness(log_directory, n_servers):
-    """Calcola la fairness tra i client leggendo i log dalle ultime n_servers cartelle più recenti."""
-    
     all_folders = [
         os.path.join(log_directory, d) for d in os.listdir(log_directory) if os.path.isdir(os.path.join(log_directory, d))
     ]
     
     sorted_folders = sorted(all_folders, key=lambda d: os.path.basename(d), reverse=True)
 
-    selected_folders = sorted_folders[:n_servers]
+    return sorted_folders[:n_servers]
+
+
+def record_kpis(log_directory, folders, statistics):
+    """Associa i KPI calcolati alle esecuzioni dei server registrate per *folders*"""
+    db = open_results(log_directory)
+    if db is None or not statistics:
+        return
+    try:
+        with db:
+            run_ids = [
+                    row["id"] for folder in folders
+                    for row in db.execute("SELECT id FROM runs WHERE log_dir = ?", (folder,))]
+            db.executemany(
+                    "INSERT OR REPLACE INTO kpis (run_id, name, value) VALUES (?, ?, ?)",
+                    [(run_id, name, value) for run_id in run_ids for name, value in statistics.items()])
+        print(f"KPI registrati per {len(run_ids)} esecuzioni")
+    except sqlite3.Error as e:
+        print(f"Errore del database dei risultati: {e}")
+    finally:
+        db.close()
+
+
+def list_runs(log_directory, limit, congestion_control=None, qdisc=None, days=None, experiment_id=None, role=None):
+    """Esecuzioni registrate che corrispondono ai filtri, con file e KPI, dalla più recente"""
+    db = open_results(log_directory)
+    if db is None:
+        print(f"Nessun database dei risultati in {log_directory}")
+        return []
+
+    conditions, parameters = [], []
+    for column, value in (("congestion_control", congestion_control), ("qdisc", qdisc),
+                          ("experiment_id", experiment_id), ("role", role)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    if days is not None:
+        conditions.append("started >= ?")
+        parameters.append(time.time() - days * 86400)
+    query = "SELECT * FROM runs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY started DESC LIMIT ?"
+    parameters.append(limit)
+
+    try:
+        runs = [dict(row) for row in db.execute(query, parameters)]
+        for run in runs:
+            run["files"] = [row["path"] for row in db.execute("SELECT path FROM files WHERE run_id = ?", (run["id"],))]
+            run["kpis"] = {row["name"]: row["value"] for row in db.execute("SELECT name, value FROM kpis WHERE run_id = ?", (run["id"],))}
+    finally:
+        db.close()
+    for run in runs:
+        print(json.dumps(run))
+    return runs
+
+
+def calculate_server_fairness(log_directory, n_servers):
+    """Calcola la fairness tra i client leggendo i log dalle ultime n_servers cartelle più recenti."""
+    
+    selected_folders = select_folders(log_directory, n_servers)
 
     if not selected_folders:
         print("Nessuna cartella valida trovata.")
@@ -59,15 +176,553 @@ def calculate_server_fairness(log_directory, n_servers):
     timestamp = collect_agent.now()
     collect_agent.send_stat(timestamp, fairness=fairness)
     print(f"Server Fairness: {fairness}")
+    record_kpis(log_directory, selected_folders, {"fairness": fairness})
+
+
+def load_handovers(handover_file):
+    """Istanti (ms Unix) degli handover: prima colonna di ogni riga, in secondi Unix"""
+    handovers = []
+    with open(handover_file) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                handovers.append(float(fields[0]) * 1000)
+    return np.sort(np.array(handovers))
+
+
+def load_recovery_series(path):
+    """Serie recovery:metrics_updated di un qlog, con tempi assoluti in ms Unix"""
+    reference_time = None
+    times, srtt, cwnd, pto = [], [], [], []
+    with open(path) as f:
+        for line in f:
+            try:
+                log_entry = json.loads(line.strip())
+            except json.JSONDecodeError:
+                continue
+            if reference_time is None and "trace" in log_entry:
+                reference_time = log_entry["trace"].get("common_fields", {}).get("reference_time")
+                continue
+            if log_entry.get("name") != "recovery:metrics_updated":
+                continue
+            data = log_entry.get("data", {})
+            if any(data.get(key) is None for key in ("smoothed_rtt", "congestion_window", "pto_count")):
+                continue
+            times.append(log_entry["time"])
+            srtt.append(data["smoothed_rtt"])
+            cwnd.append(data["congestion_window"])
+            pto.append(data["pto_count"])
+
+    if reference_time is None or not times:
+        return None
+    return {
+        "time": np.array(times, dtype=float) + float(reference_time),
+        "smoothed_rtt": np.array(srtt, dtype=float),
+        "congestion_window": np.array(cwnd, dtype=float),
+        "pto_count": np.array(pto, dtype=float),
+    }
+
+
+def _window_matrix(values, starts, ends):
+    """Valori delle finestre [starts[i], ends[i]) riga per riga, con maschera di validità"""
+    width = max(int((ends - starts).max()), 1)
+    indices = starts[:, None] + np.arange(width)[None, :]
+    mask = indices < ends[:, None]
+    return values[np.minimum(indices, len(values) - 1)], mask, indices
+
+
+def _window_mean(prefix, starts, ends):
+    counts = ends - starts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, (prefix[ends] - prefix[starts]) / counts, np.nan)
+
+
+def handover_kpis(series, handovers, window=HANDOVER_WINDOW, tolerance=SETTLE_TOLERANCE):
+    """KPI di ogni handover per un flusso, sulle finestre [T - window, T) e [T, T + window)
+
+    settle_time: smoothed_rtt entro *tolerance* dalla media dell'ultimo quarto
+    della finestra dopo; cwnd_drop e cwnd_recovery_time (al 90%) rispetto alla
+    media prima di T; stall_bytes al ritmo cwnd/srtt; incrementi di pto_count.
+    """
+    t = series["time"]
+    srtt = series["smoothed_rtt"]
+    cwnd = series["congestion_window"]
+    pto = series["pto_count"]
+    window_ms = window * 1000
+
+    before = np.searchsorted(t, handovers - window_ms)
+    start = np.searchsorted(t, handovers)
+    end = np.searchsorted(t, handovers + window_ms)
+    last_quarter = np.searchsorted(t, handovers + window_ms * 3 / 4)
+    valid = (end > start) & (start > before)
+    if not valid.any():
+        return None
+    handovers, before, start, end, last_quarter = (a[valid] for a in (handovers, before, start, end, last_quarter))
+
+    rate = cwnd / np.maximum(srtt, 1e-3)  # bytes/ms
+    zero = np.zeros(1)
+    srtt_prefix = np.concatenate((zero, np.cumsum(srtt)))
+    cwnd_prefix = np.concatenate((zero, np.cumsum(cwnd)))
+    rate_prefix = np.concatenate((zero, np.cumsum(rate)))
+
+    # smoothed_rtt settling
+    target = _window_mean(srtt_prefix, last_quarter, end)
+    values, mask, indices = _window_matrix(srtt, start, end)
+    outside = mask & (np.abs(values - target[:, None]) > tolerance * target[:, None])
+    last_outside = np.where(outside, indices, -1).max(axis=1)
+    settled_at = np.where(last_outside >= 0, t[np.minimum(last_outside + 1, len(t) - 1)], handovers)
+    settle_time = np.where(last_outside + 1 >= end, window_ms, settled_at - handovers)
+
+    # PTO increments
+    increments = np.concatenate((zero, np.maximum(np.diff(pto), 0)))
+    increments_prefix = np.concatenate((zero, np.cumsum(increments)))
+    pto_count = increments_prefix[end] - increments_prefix[start]
+
+    # cwnd drop and recovery
+    cwnd_before = _window_mean(cwnd_prefix, before, start)
+    values, mask, indices = _window_matrix(cwnd, start, end)
+    masked = np.where(mask, values, np.inf)
+    minimum_position = masked.argmin(axis=1)
+    cwnd_drop = 1 - masked.min(axis=1) / cwnd_before
+    recovered = mask & (values >= CWND_RECOVERY_RATIO * cwnd_before[:, None]) & (np.arange(values.shape[1])[None, :] >= minimum_position[:, None])
+    first_recovered = np.where(recovered.any(axis=1), recovered.argmax(axis=1), -1)
+    rows = np.arange(len(start))
+    cwnd_recovery_time = np.where(
+        first_recovered >= 0,
+        t[indices[rows, np.maximum(first_recovered, 0)].clip(max=len(t) - 1)] - t[indices[rows, minimum_position].clip(max=len(t) - 1)],
+        np.nan)
+
+    # Bytes not delivered compared to the rate before the handover
+    rate_before = _window_mean(rate_prefix, before, start)
+    values, mask, indices = _window_matrix(rate, start, end)
+    next_times = t[np.minimum(indices + 1, len(t) - 1)]
+    durations = np.where(mask, np.clip(next_times, None, (handovers + window_ms)[:, None]) - t[np.minimum(indices, len(t) - 1)], 0)
+    stall_bytes = (np.maximum(rate_before[:, None] - values, 0) * durations).sum(axis=1)
+
+    return {
+        "handover": handovers,
+        "settle_time": settle_time,
+        "pto_count": pto_count,
+        "cwnd_drop": cwnd_drop,
+        "cwnd_recovery_time": cwnd_recovery_time,
+        "stall_bytes": stall_bytes,
+    }
+
+
+def analyse_handovers(log_directory, n_servers, handover_file, window, tolerance):
+    """Calcola l'impatto di ogni handover sui flussi delle ultime n_servers cartelle."""
+    handovers = load_handovers(handover_file)
+    if not len(handovers):
+        print(f"Nessun handover trovato in {handover_file}.")
+        return
+
+    summary = {}
+    for folder in select_folders(log_directory, n_servers):
+        for file in sorted(os.listdir(folder)):
+            if not file.endswith(".sqlog"):
+                continue
+            series = load_recovery_series(os.path.join(folder, file))
+            if series is None:
+                print(f"File {file} ignorato: nessuna serie o reference_time mancante.")
+                continue
+            kpis = handover_kpis(series, handovers, window, tolerance)
+            if kpis is None:
+                continue
+
+            flow = os.path.splitext(file)[0]
+            for index, handover in enumerate(kpis["handover"]):
+                statistics = {
+                    f"handover_{name}": float(values[index])
+                    for name, values in kpis.items()
+                    if name != "handover" and not np.isnan(values[index])
+                }
+                collect_agent.send_stat(int(handover), suffix=flow, **statistics)
+            for name, values in kpis.items():
+                if name != "handover":
+                    summary.setdefault(name, []).append(values)
+
+    if not summary:
+        print("Nessun flusso attivo intorno agli handover.")
+        return
+
+    statistics = {
+        f"handover_mean_{name}": float(np.nanmean(np.concatenate(values)))
+        for name, values in summary.items()
+        if not np.isnan(np.concatenate(values)).all()
+    }
+    collect_agent.send_stat(collect_agent.now(), **statistics)
+    print(f"Handover KPIs: {statistics}")
+    record_kpis(log_directory, select_folders(log_directory, n_servers), statistics)
+
+
+def read_qlog_header(path):
+    """ODCID, reference_time e vantage point dall'intestazione di un qlog"""
+    with open(path) as f:
+        for line in f:
+            try:
+                log_entry = json.loads(line.strip())
+            except json.JSONDecodeError:
+                continue
+            if "trace" not in log_entry:
+                break
+            trace = log_entry["trace"]
+            common_fields = trace.get("common_fields", {})
+            odcid = common_fields.get("ODCID") or common_fields.get("group_id")
+            return odcid, common_fields.get("reference_time"), trace.get("vantage_point", {}).get("type")
+    return None, None, None
+
+
+def index_qlogs(folders):
+    """Connessioni dei qlog di *folders*, per ODCID
+
+    Dal flow_index.jsonl scritto dai server accanto ai qlog quando presente,
+    altrimenti dall'intestazione di ogni qlog.
+    """
+    connections = {}
+    for folder in folders:
+        indexed = {}
+        try:
+            with open(os.path.join(folder, FLOW_INDEX_FILE)) as index:
+                for line in index:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    indexed.setdefault(entry["odcid"], {}).update(entry)
+        except FileNotFoundError:
+            pass
+        for odcid, entry in indexed.items():
+            path = os.path.join(folder, entry.get("file", ""))
+            if os.path.isfile(path):
+                connections[odcid] = {
+                    "path": path,
+                    "reference_time": entry.get("reference_time"),
+                    "vantage_point": entry.get("vantage_point"),
+                    "flow": entry.get("flow"),
+                }
+
+        known = {connection["path"] for connection in connections.values()}
+        for root, _, files in os.walk(folder):
+            for file in files:
+                path = os.path.join(root, file)
+                if not file.endswith(".sqlog") or path in known:
+                    continue
+                odcid, reference_time, vantage_point = read_qlog_header(path)
+                if odcid:
+                    connections[odcid] = {
+                        "path": path,
+                        "reference_time": reference_time,
+                        "vantage_point": vantage_point,
+                        "flow": None,
+                    }
+    return connections
+
+
+def _packet_columns(matches):
+    """Colonne numpy (inviato, tempo, chiave) di una lista di match (tempo, evento, tipo, numero)"""
+    if not matches:
+        return np.zeros(0, dtype=bool), np.zeros(0), np.zeros(0, dtype=np.int64)
+    times, events, kinds, numbers = zip(*matches)
+    spaces = np.fromiter((PACKET_SPACES_BYTES.get(kind, -1) for kind in kinds), dtype=np.int64, count=len(kinds))
+    known = spaces >= 0
+    sent = np.fromiter((event == b"sent" for event in events), dtype=bool, count=len(events))
+    keys = (spaces << PACKET_SPACE_SHIFT) | np.fromiter(map(int, numbers), dtype=np.int64, count=len(numbers))
+    return sent[known], np.fromiter(map(float, times), dtype=float, count=len(times))[known], keys[known]
+
+
+def _parse_packet_line(line):
+    event = PACKET_EVENT.search(line)
+    time = PACKET_TIME.search(line)
+    kind = PACKET_TYPE.search(line)
+    number = PACKET_NUMBER.search(line)
+    if event and time and kind and number:
+        return time.group(1), event.group(1), kind.group(1), number.group(1)
+    return None
+
+
+def _parse_packet_chunk(chunk):
+    """Eventi pacchetto delle righe che iniziano in [start, end) di un qlog"""
+    path, start, end = chunk
+    with open(path, "rb") as f:
+        if start:
+            # Complete the line cut by *start*: it belongs to the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        data = f.read(max(end - f.tell(), 0)) if f.tell() < end else b""
+        if data and not data.endswith(b"\n"):
+            data += f.readline()
+
+    # Millions of small tuples: the garbage collector has nothing to free here
+    gc.disable()
+    try:
+        matches = PACKET_FAST.findall(data)
+        if len(matches) != data.count(b"transport:packet_sent") + data.count(b"transport:packet_received"):
+            matches = [match for match in map(_parse_packet_line, data.splitlines()) if match is not None]
+        return _packet_columns(matches)
+    finally:
+        gc.enable()
+
+
+def load_packets(path, reference_time, pool=None):
+    """Pacchetti inviati e ricevuti di un qlog: tempi assoluti (ms) e chiavi spazio/numero
+
+    Blocchi di PACKET_CHUNK byte letti da *pool* con una sola espressione
+    regolare, riga per riga solo se il formato degli eventi è diverso.
+    """
+    size = os.path.getsize(path)
+    chunks = [(path, start, min(start + PACKET_CHUNK, size)) for start in range(0, size, PACKET_CHUNK)]
+    columns = (pool.map if pool is not None else map)(_parse_packet_chunk, chunks)
+    sent, times, keys = (np.concatenate(column) for column in zip(*columns)) if chunks else (
+        np.zeros(0, dtype=bool), np.zeros(0), np.zeros(0, dtype=np.int64))
+
+    times += float(reference_time or 0)
+    return {
+        "sent": (times[sent], keys[sent]),
+        "received": (times[~sent], keys[~sent]),
+    }
+
+
+def join_packets(sent_times, sent_keys, received_times, received_keys):
+    """Unisce gli invii di un lato con le ricezioni dell'altro, per numero di pacchetto
+
+    Ritardo one-way e riordino (numero più alto dello stesso spazio già
+    ricevuto) per ogni pacchetto ricevuto, perdita per ogni pacchetto inviato.
+    """
+    order = np.argsort(sent_keys, kind="stable")
+    sent_keys, sent_times = sent_keys[order], sent_times[order]
+
+    order = np.argsort(received_times, kind="stable")
+    received_times, received_keys = received_times[order], received_keys[order]
+    _, first = np.unique(received_keys, return_index=True)
+    first.sort()
+    received_times, received_keys = received_times[first], received_keys[first]
+
+    position = np.minimum(np.searchsorted(sent_keys, received_keys), max(len(sent_keys) - 1, 0))
+    matched = (sent_keys[position] == received_keys) if len(sent_keys) else np.zeros(len(received_keys), dtype=bool)
+    delay = received_times[matched] - sent_times[position[matched]]
+
+    spaces = received_keys >> PACKET_SPACE_SHIFT
+    reordered = np.zeros(len(received_keys), dtype=bool)
+    for space in np.unique(spaces):
+        mask = spaces == space
+        keys = received_keys[mask]
+        highest_before = np.concatenate(([-1], np.maximum.accumulate(keys)[:-1]))
+        reordered[mask] = keys < highest_before
+
+    received_sorted = np.sort(received_keys)
+    position = np.minimum(np.searchsorted(received_sorted, sent_keys), max(len(received_sorted) - 1, 0))
+    lost = (received_sorted[position] != sent_keys) if len(received_sorted) else np.ones(len(sent_keys), dtype=bool)
+
+    order = np.argsort(sent_times, kind="stable")
+    return {
+        "received_time": received_times[matched],
+        "one_way_delay": delay,
+        "reordered": reordered[matched],
+        "sent_time": sent_times[order],
+        "lost": lost[order],
+    }
+
+
+def _binned(times, values, start, width, reduce):
+    """Riduzione di *values* per intervalli di *width* ms da *start*"""
+    bins = ((times - start) // width).astype(np.int64)
+    order = np.argsort(bins, kind="stable")
+    bins, values = bins[order], values[order]
+    boundaries = np.flatnonzero(np.diff(bins)) + 1
+    starts = np.concatenate(([0], boundaries))
+    return bins[starts], reduce.reduceat(values, starts), np.diff(np.concatenate((starts, [len(bins)])))
+
+
+def send_join_series(joined, flow, direction, width):
+    """Serie per intervallo di ritardo one-way, riordino e perdita di una direzione"""
+    suffix = f"{flow}_{direction}"
+    start = joined["sent_time"][0] if len(joined["sent_time"]) else 0
+    series = {}
+
+    if len(joined["received_time"]):
+        bins, total, count = _binned(joined["received_time"], joined["one_way_delay"], start, width, np.add)
+        _, minimum, _ = _binned(joined["received_time"], joined["one_way_delay"], start, width, np.minimum)
+        _, maximum, _ = _binned(joined["received_time"], joined["one_way_delay"], start, width, np.maximum)
+        _, reordered, _ = _binned(joined["received_time"], joined["reordered"].astype(float), start, width, np.add)
+        for index, bin_ in enumerate(bins.tolist()):
+            series.setdefault(bin_, {}).update({
+                "one_way_delay_mean": float(total[index] / count[index]),
+                "one_way_delay_min": float(minimum[index]),
+                "one_way_delay_max": float(maximum[index]),
+                "reordering_ratio": float(reordered[index] / count[index]),
+            })
+    if len(joined["sent_time"]):
+        bins, lost, count = _binned(joined["sent_time"], joined["lost"].astype(float), start, width, np.add)
+        for index, bin_ in enumerate(bins.tolist()):
+            series.setdefault(bin_, {})["loss_ratio"] = float(lost[index] / count[index])
+
+    for bin_, statistics in sorted(series.items()):
+        collect_agent.send_stat(int(start + bin_ * width), suffix=suffix, **statistics)
+
+
+def analyse_join(log_directory, n_servers, client_directory, width):
+    """Ritardo one-way, riordino e perdita dei flussi dai qlog dei due lati"""
+    servers = index_qlogs(select_folders(log_directory, n_servers))
+    clients = index_qlogs([client_directory])
+    common = sorted(set(servers) & set(clients))
+    print(f"{len(common)} connessioni presenti nei qlog di entrambi i lati")
+    if not common:
+        return
+
+    width_ms = width * 1000
+    summary = {}
+    with multiprocessing.Pool() as pool:
+        for odcid in common:
+            server, client = servers[odcid], clients[odcid]
+            server_packets = load_packets(server["path"], server["reference_time"], pool)
+            client_packets = load_packets(client["path"], client["reference_time"], pool)
+            flow = server["flow"] or odcid
+            arrays = {}
+            for direction, sender, receiver in (("up", client_packets, server_packets), ("down", server_packets, client_packets)):
+                joined = join_packets(*sender["sent"], *receiver["received"])
+                send_join_series(joined, flow, direction, width_ms)
+                arrays.update({f"{direction}_{name}": values for name, values in joined.items()})
+
+                delays = joined["one_way_delay"]
+                statistics = {"loss_ratio": float(joined["lost"].mean()) if len(joined["lost"]) else 0.0}
+                if len(delays):
+                    statistics.update({
+                        "one_way_delay_mean": float(delays.mean()),
+                        "one_way_delay_p99": float(np.percentile(delays, 99)),
+                        "reordering_ratio": float(joined["reordered"].mean()),
+                    })
+                for name, value in statistics.items():
+                    summary.setdefault(f"join_{direction}_{name}", []).append(value)
+                print(f"Flusso {flow} ({direction}): {statistics}")
+
+            # Serie per pacchetto complete, accanto ai qlog del server
+            np.savez(os.path.join(os.path.dirname(server["path"]), f"join_{odcid}.npz"), **arrays)
+
+    statistics = {name: float(np.mean(values)) for name, values in summary.items()}
+    collect_agent.send_stat(collect_agent.now(), **statistics)
+    print(f"Join KPIs: {statistics}")
+    record_kpis(log_directory, select_folders(log_directory, n_servers), statistics)
+
+
+class QuantileSketch:
+    """Sketch di quantili scritto dai job quicos (sketch_*.json), unibile per somma dei bin"""
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    @classmethod
+    def from_dict(cls, content):
+        sketch = cls(content["alpha"])
+        sketch.bins = {int(index): count for index, count in content["bins"].items()}
+        sketch.zero_count = content["zero_count"]
+        sketch.count = content["count"]
+        if sketch.count:
+            sketch.minimum = content["min"]
+            sketch.maximum = content["max"]
+        return sketch
+
+    def merge(self, other):
+        if other.alpha != self.alpha:
+            raise ValueError(f"sketch con precisione diversa: {other.alpha} invece di {self.alpha}")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def quantile(self, q):
+        """Quantile *q* (tra 0 e 1), con errore relativo al più alpha"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return max(self.minimum, 0.0)
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.minimum), self.maximum)
+        return self.maximum
+
+
+def find_sketches(folders):
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for file in sorted(files):
+                if file.startswith("sketch_") and file.endswith(".json"):
+                    yield os.path.join(root, file)
+
+
+def merge_sketches(log_directory, n_servers, sketch_directories):
+    """Quantili globali di smoothed_rtt, latest_rtt e congestion_window dagli sketch dei flussi"""
+    merged = {}
+    flows = 0
+    for path in find_sketches(select_folders(log_directory, n_servers) + list(sketch_directories)):
+        try:
+            with open(path) as sketch_file:
+                content = json.load(sketch_file)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Sketch ignorato {path}: {e}")
+            continue
+        flows += 1
+        for metric, sketch in content.get("metrics", {}).items():
+            sketch = QuantileSketch.from_dict(sketch)
+            if metric in merged:
+                merged[metric].merge(sketch)
+            else:
+                merged[metric] = sketch
+    print(f"{flows} sketch uniti")
+
+    statistics = {}
+    for metric, sketch in merged.items():
+        if not sketch.count:
+            continue
+        statistics[f"{metric}_count"] = sketch.count
+        for q in SKETCH_QUANTILES:
+            statistics[f"{metric}_p{str(q).replace('.', '')}"] = sketch.quantile(q / 100)
+    if statistics:
+        collect_agent.send_stat(collect_agent.now(), **statistics)
+    print(f"Quantili globali: {statistics}")
+    record_kpis(log_directory, select_folders(log_directory, n_servers), statistics)
+
 
 def main():
     parser = argparse.ArgumentParser(description="KPIMetrics Job")
     parser.add_argument("log_directory", type=str, help="Percorso base della cartella contenente i file di log.")
     parser.add_argument("n_server", type=int, help="Numero di cartelle più recenti da analizzare.")
+    parser.add_argument("--handovers", type=str, default=None, help="File degli istanti di handover (secondi Unix, uno per riga): calcola i KPI di handover invece della fairness.")
+    parser.add_argument("--window", type=float, default=HANDOVER_WINDOW, help="Finestra di analisi prima e dopo ogni handover, in secondi.")
+    parser.add_argument("--settle-tolerance", type=float, default=SETTLE_TOLERANCE, help="Tolleranza relativa di stabilizzazione dello smoothed_rtt.")
+    parser.add_argument("--join", type=str, default=None, help="Cartella dei qlog dei client: unisce i qlog dei due lati per ritardo one-way, riordino e perdita.")
+    parser.add_argument("--join-bin", type=float, default=JOIN_BIN, help="Risoluzione in secondi delle serie del join.")
+    parser.add_argument("--sketches", type=str, nargs="*", default=None, help="Unisce gli sketch dei flussi (sketch_*.json) delle cartelle selezionate e di queste cartelle in quantili globali.")
+    parser.add_argument("--runs", action="store_true", help="Elenca le esecuzioni registrate nel database dei risultati (al più n_server) invece di calcolare KPI.")
+    parser.add_argument("--cc", type=str, default=None, help="Con --runs: solo le esecuzioni con questo congestion control.")
+    parser.add_argument("--qdisc", type=str, default=None, help="Con --runs: solo le esecuzioni con questa qdisc.")
+    parser.add_argument("--days", type=float, default=None, help="Con --runs: solo le esecuzioni degli ultimi DAYS giorni.")
+    parser.add_argument("--experiment-id", type=str, default=None, help="Con --runs: solo le esecuzioni di questo esperimento.")
+    parser.add_argument("--role", choices=["server", "client"], default=None, help="Con --runs: solo le esecuzioni dei server o dei client.")
     args = parser.parse_args()
     
     with collect_agent.use_configuration('/opt/openbach/agent/jobs/KPIMetrics/KPIMetrics.conf'):
-        calculate_server_fairness(args.log_directory, args.n_server)
+        if args.runs:
+            list_runs(args.log_directory, args.n_server, args.cc, args.qdisc, args.days, args.experiment_id, args.role)
+        elif args.sketches is not None:
+            merge_sketches(args.log_directory, args.n_server, args.sketches)
+        elif args.join:
+            analyse_join(args.log_directory, args.n_server, args.join, args.join_bin)
+        elif args.handovers:
+            analyse_handovers(args.log_directory, args.n_server, args.handovers, args.window, args.settle_tolerance)
+        else:
+            calculate_server_fairness(args.log_directory, args.n_server)
 
 if __name__ == "__main__":
     main()
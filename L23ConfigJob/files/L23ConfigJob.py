@@ -1,29 +1,177 @@
-import subprocess
+import os
+import sys
+import time
+import socket
+import struct
 import syslog
+import argparse
+import ipaddress
 
-def main():
+import collect_agent
+
+
+CONFIG_FILE = "/opt/openbach/scripts/curr_route.conf"
+HANDOVER_LOG = "/opt/openbach/scripts/handovers.log"
+SPIN_MARGIN = 0.002  # s, busy-wait before a scheduled switch for ms accuracy
+
+# Routes of each host, previously hard-coded in change_route.sh: destination, then gateway per route
+ROUTES = {
+    "b1": ("10.0.40.0/24", {"sat": "10.0.100.1", "terr": "10.0.30.1"}),
+    "s1": ("10.0.10.0/24", {"sat": "10.0.40.254", "terr": "10.0.40.1"}),
+}
+ROUTE_IDS = {"terr": 0, "sat": 1}
+
+# rtnetlink constants (linux/netlink.h, linux/rtnetlink.h)
+NLMSG_HEADER = struct.Struct('IHHII')
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_REPLACE = 0x100
+RTM_NEWROUTE = 24
+RTMSG = struct.Struct('BBBBBBBBI')
+RTATTR = struct.Struct('HH')
+RTA_DST = 1
+RTA_GATEWAY = 5
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+
+
+def _attribute(kind, value):
+    length = RTATTR.size + len(value)
+    return RTATTR.pack(length, kind) + value + b'\0' * ((4 - length % 4) % 4)
+
+
+class RouteSwitcher:
+    """Change a route in-process with a single rtnetlink request (ip route change)"""
+
+    def __init__(self, destination):
+        self.destination = ipaddress.ip_network(destination)
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.socket.bind((0, 0))
+        self.sequence = 0
+
+    def close(self):
+        self.socket.close()
+
+    def change(self, gateway):
+        """Point the route to *gateway*; return the times (ns) around the kernel update"""
+        self.sequence += 1
+        message = RTMSG.pack(
+            socket.AF_INET, self.destination.prefixlen, 0, 0,
+            RT_TABLE_MAIN, RTPROT_BOOT, RT_SCOPE_UNIVERSE, RTN_UNICAST, 0)
+        message += _attribute(RTA_DST, self.destination.network_address.packed)
+        message += _attribute(RTA_GATEWAY, ipaddress.ip_address(gateway).packed)
+        header = NLMSG_HEADER.pack(
+            NLMSG_HEADER.size + len(message), RTM_NEWROUTE,
+            NLM_F_REQUEST | NLM_F_ACK | NLM_F_REPLACE, self.sequence, 0)
+
+        sent = time.time_ns()
+        self.socket.send(header + message)
+        while True:
+            data = self.socket.recv(65536)
+            acknowledged = time.time_ns()
+            _, kind, _, sequence, _ = NLMSG_HEADER.unpack_from(data)
+            if kind == NLMSG_ERROR and sequence == self.sequence:
+                error = -struct.unpack_from('i', data, NLMSG_HEADER.size)[0]
+                if error:
+                    raise OSError(error, f"route change via {gateway} failed: {os.strerror(error)}")
+                return sent, acknowledged
+
+
+def read_current_route():
     try:
-        # Log di avvio del job
-        syslog.syslog(syslog.LOG_INFO, "L23ConfigJob: Avvio dell'esecuzione dello script change_route.sh.")
-        
-        # Esegui lo script change_route.sh e cattura il risultato
-        result = subprocess.run(
-            ["/opt/openbach/scripts/change_route.sh"], 
-            check=True, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE
-        )
-        
-        # Log di successo
-        syslog.syslog(syslog.LOG_INFO, f"L23ConfigJob: Script eseguito correttamente. Output: {result.stdout.decode().strip()}")
-    
-    except subprocess.CalledProcessError as e:
-        # Log dell'errore con il messaggio di errore e l'output stderr
-        syslog.syslog(syslog.LOG_ERR, f"L23ConfigJob: Errore durante l'esecuzione dello script. "
-                                      f"Codice di uscita: {e.returncode}. "
-                                      f"Errore: {e.stderr.decode().strip()}")
-        exit(1)
+        with open(CONFIG_FILE) as config:
+            return config.readline().strip()
+    except FileNotFoundError:
+        return "terr"
 
-if __name__ == "__main__":
-    main()
 
+def write_current_route(route):
+    with open(CONFIG_FILE, 'w') as config:
+        config.write(route + "\n")
+
+
+def log_handover(switch_time_ns, route):
+    """Append the switch to the handover log read by KPIMetrics --handovers"""
+    with open(HANDOVER_LOG, 'a') as log:
+        log.write(f"{switch_time_ns / 1e9:.6f} {route}\n")
+
+
+def sleep_until(deadline):
+    """Sleep until the wall-clock *deadline*, spinning for the last ms for accuracy"""
+    remaining = deadline - time.time()
+    if remaining > SPIN_MARGIN:
+        time.sleep(remaining - SPIN_MARGIN)
+    while time.time() < deadline:
+        pass
+
+
+def handover(switcher, gateways, route, scheduled=None):
+    sent, acknowledged = switcher.change(gateways[route])
+    write_current_route(route)
+    log_handover(acknowledged, route)
+
+    statistics = {
+        'handover': ROUTE_IDS[route],
+        'handover_switch_time_us': acknowledged // 1000,
+        'handover_apply_time': (acknowledged - sent) / 1e6,
+    }
+    if scheduled is not None:
+        statistics['handover_lateness'] = (sent / 1e9 - scheduled) * 1000
+    collect_agent.send_stat(acknowledged // 1_000_000, **statistics)
+    syslog.syslog(syslog.LOG_INFO, f"L23ConfigJob: route switched to {route} in {statistics['handover_apply_time']:.3f} ms")
+    print(f"Switched to {route} communication in {statistics['handover_apply_time']:.3f} ms")
+
+
+def main(route, at, period, count):
+    hostname = socket.gethostname()
+    if hostname not in ROUTES:
+        message = f"L23ConfigJob: can only be executed on {' or '.join(ROUTES)}, not on {hostname}"
+        syslog.syslog(syslog.LOG_ERR, message)
+        collect_agent.send_log(syslog.LOG_ERR, message)
+        sys.exit(message)
+
+    destination, gateways = ROUTES[hostname]
+    switcher = RouteSwitcher(destination)
+    try:
+        # Switch at *at* (or right now), then every *period* seconds; the
+        # deadlines derive from the first one so that lateness never accumulates
+        scheduled = at is not None
+        first = at if scheduled else time.time()
+        switches = 0
+        while True:
+            deadline = first + switches * period
+            if scheduled:
+                sleep_until(deadline)
+            target = route or ("terr" if read_current_route() == "sat" else "sat")
+            handover(switcher, gateways, target, deadline if scheduled else None)
+            switches += 1
+
+            if not period or (count and switches >= count):
+                break
+            route = None  # periodic switches alternate between the routes
+            scheduled = True
+    except OSError as e:
+        message = f"L23ConfigJob: error while switching routes: {e}"
+        syslog.syslog(syslog.LOG_ERR, message)
+        collect_agent.send_log(syslog.LOG_ERR, message)
+        sys.exit(message)
+    finally:
+        switcher.close()
+
+
+if __name__ == "__main__":
+    with collect_agent.use_configuration('/opt/openbach/agent/jobs/L23ConfigJob/L23ConfigJob_rstats_filter.conf'):
+        parser = argparse.ArgumentParser(description="Switch the route between the sat and terr paths")
+        parser.add_argument('-r', '--route', choices=list(ROUTE_IDS), default=None,
+                            help="Route to switch to (default: the other one than the current route)")
+        parser.add_argument('-a', '--at', type=float, default=None,
+                            help="Unix time (s) of the first switch (default: now)")
+        parser.add_argument('-p', '--period', type=float, default=0,
+                            help="Switch again every PERIOD seconds, alternating routes (0 to switch once)")
+        parser.add_argument('-c', '--count', type=int, default=0,
+                            help="Number of periodic switches (0 to switch until the job is stopped)")
+        args = parser.parse_args()
+        main(**vars(args))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OpenBACH is a generic testbed able to control/configure multiple
+# network/physical entities (under test) and collect data from them. It is
+# composed of an Auditorium (HMIs), a Controller, a Collector and multiple
+# Agents (one for each network entity that wants to be tested).
+#
+#
+# Copyright © 2016-2023 CNES
+#
+#
+# This file is part of the OpenBACH testbed.
+#
+#
+# OpenBACH is a free software : you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY, without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+
+"""Congestion control regression gate of the wave binaries, on the namespace testbed
+
+A fixed matrix (congestion controls of the server jobs, queueManager
+bottlenecks, object sizes, numbers of concurrent flows) is run on the testbed
+of testbed.py, several trials per cell, trials of the cells interleaved so
+that a drift of the host does not bias one cell. Each trial yields:
+
+* throughput: sum over the flows of the throughput reported by quicosClient (Mbit/s)
+* rtt_p99: 99th percentile of latest_rtt in the server qlogs (ms)
+* fairness: Jain index of the throughputs of the flows
+* pto_rate: PTO count increments per second of flow, in the server qlogs
+
+Every metric of every cell is compared with the trials of the stored
+baseline by a one-sided permutation test of the means: a cell regresses when
+a metric moves in the bad direction by more than --tolerance with a p-value
+below --alpha. The JSON report lists every comparison and the verdict; the
+exit code is 1 on a regression or a cell without successful trial.
+
+Usage (as root, testbed up):
+    python3 benchmarks/cc_regression.py --update-baseline     # on the reference build
+    python3 benchmarks/cc_regression.py -r report.json        # on the new build
+"""
+
+import os
+import sys
+import json
+import math
+import random
+import argparse
+import tempfile
+import itertools
+import subprocess
+from datetime import datetime
+
+import testbed
+
+
+BASELINE = os.path.join(testbed.BENCHMARKS, 'baselines', 'cc_regression.json')
+WAVE_SOURCE = '/tmp/wave'  # ngtcp2-wave checkout of install_quicos*.yml
+SERVER_JOB = 'quicosServerMultiflow_2'
+DEFAULT_MATRIX = {
+        'congestion_controls': None,  # every CongestionControls of the server job
+        'queues': ['HTB', 'FQ_CoDel'],
+        'sizes': ['1M', '20M'],
+        'flows': [1, 4],
+}
+TRIALS = 5
+ALPHA = 0.05
+TOLERANCE = 0.05  # relative change below which a difference is not a regression
+EXACT_PERMUTATIONS = 20000  # above, the permutation test samples this many permutations
+# +1: higher is better, -1: lower is better
+METRICS = {'throughput': 1, 'rtt_p99': -1, 'fairness': 1, 'pto_rate': -1}
+
+
+def cell_key(congestion_control, queue, size, flows):
+    return f'{congestion_control}/{queue}/{size}/{flows}'
+
+
+def build_label():
+    try:
+        p = subprocess.run(['git', '-C', WAVE_SOURCE, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    return p.stdout.strip() or None
+
+
+def load_matrix(matrix_file, job):
+    matrix = dict(DEFAULT_MATRIX)
+    if matrix_file:
+        with open(matrix_file) as matrix_json:
+            matrix.update(json.load(matrix_json))
+    if not matrix['congestion_controls']:
+        module = testbed.load_module(job)
+        matrix['congestion_controls'] = [cc.value for cc in module.CongestionControls]
+    return [
+            (congestion_control, queue, size, flows)
+            for congestion_control in matrix['congestion_controls']
+            for queue in matrix['queues']
+            for size in matrix['sizes']
+            for flows in matrix['flows']]
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    rank = min(int(q / 100 * len(values)), len(values) - 1)
+    return values[rank]
+
+
+def _server_qlogs(directory):
+    for root, _, files in os.walk(os.path.join(directory, 'server')):
+        for file in files:
+            if file.endswith('.sqlog') or file.endswith('.qlog'):
+                yield os.path.join(root, file)
+
+
+def trial_metrics(directory, flows):
+    """Metrics of one trial from the statistics of the clients and the server qlogs"""
+    throughputs = []
+    stats_dir = os.path.join(directory, 'stats')
+    for file in os.listdir(stats_dir):
+        runs = []
+        with open(os.path.join(stats_dir, file)) as stats:
+            for line in stats:
+                _, _, _, statistics = json.loads(line)
+                if 'throughput' in statistics:
+                    runs.append(statistics['throughput'])
+        if runs:
+            # One file per client process, that is per flow
+            throughputs.append(sum(runs) / len(runs))
+    if len(throughputs) != flows:
+        raise RuntimeError(f"{len(throughputs)} client throughputs for {flows} flows in {stats_dir}")
+
+    rtts = []
+    ptos = 0
+    flow_time = 0.0
+    for path in _server_qlogs(directory):
+        first = last = previous_pto = None
+        with open(path) as qlog:
+            for line in qlog:
+                if 'metrics_updated' not in line:
+                    continue
+                event = json.loads(line.strip('\x1e \n'))
+                data = event.get('data', {})
+                if data.get('latest_rtt') is not None:
+                    rtts.append(data['latest_rtt'])
+                pto_count = data.get('pto_count')
+                if pto_count is not None:
+                    if previous_pto is not None and pto_count > previous_pto:
+                        ptos += pto_count - previous_pto
+                    previous_pto = pto_count
+                first = event['time'] if first is None else first
+                last = event['time']
+        if first is not None:
+            flow_time += (last - first) / 1000
+    if not rtts:
+        raise RuntimeError(f"no recovery:metrics_updated event in the server qlogs of {directory}")
+
+    total = sum(throughputs)
+    squares = sum(throughput ** 2 for throughput in throughputs)
+    return {
+            'throughput': total,
+            'rtt_p99': _percentile(rtts, 99),
+            'fairness': total ** 2 / (len(throughputs) * squares) if squares else 1.0,
+            'pto_rate': ptos / flow_time if flow_time else 0.0,
+    }
+
+
+def measure(cells, trials, job, output):
+    """Run the trials of every cell; return {cell: {metric: [values]}} and the failed trials"""
+    results = {cell_key(*cell): {metric: [] for metric in METRICS} for cell in cells}
+    failures = []
+    queue = None
+    # Interleaved trials: cell order changes the bottleneck as rarely as possible within a round
+    for trial in range(trials):
+        for cell in sorted(cells, key=lambda cell: cell[1]):
+            congestion_control, cell_queue, size, flows = cell
+            key = cell_key(*cell)
+            if cell_queue != queue:
+                testbed.set_queue(cell_queue)
+                queue = cell_queue
+            directory = os.path.join(output, key.replace('/', '_'), str(trial))
+            try:
+                _, returncodes = testbed.experiment(
+                        job, directory, testbed._parse_size(size), 1, congestion_control, flows=flows)
+                if any(returncodes):
+                    raise RuntimeError(f"client exit codes {returncodes}")
+                metrics = trial_metrics(directory, flows)
+            except (OSError, RuntimeError, ValueError) as e:
+                print(f"Trial {trial} of {key} failed: {e}")
+                failures.append({'cell': key, 'trial': trial, 'error': str(e)})
+                continue
+            for metric, value in metrics.items():
+                results[key][metric].append(value)
+    return results, failures
+
+
+def permutation_p_value(baseline, current, direction):
+    """One-sided p-value of the current mean being worse than the baseline mean
+
+    Worse means lower for *direction* +1 and higher for -1. Exact when the
+    number of relabellings is small enough, sampled (fixed seed) otherwise.
+    """
+    pooled = baseline + current
+    size = len(current)
+    total = sum(pooled)
+
+    def worsening(sample_sum):
+        return direction * ((total - sample_sum) / len(baseline) - sample_sum / size)
+
+    observed = worsening(sum(current))
+    if math.comb(len(pooled), size) <= EXACT_PERMUTATIONS:
+        samples = [sum(pooled[index] for index in indices) for indices in itertools.combinations(range(len(pooled)), size)]
+    else:
+        rng = random.Random(0)
+        samples = [sum(rng.sample(pooled, size)) for _ in range(EXACT_PERMUTATIONS)]
+    # Small tolerance: relabellings with the same means count as extreme
+    extreme = sum(1 for sample_sum in samples if worsening(sample_sum) >= observed - 1e-12)
+    return extreme / len(samples)
+
+
+def compare(results, baseline, alpha, tolerance):
+    """Verdict of every metric of every cell against the baseline trials"""
+    cells = []
+    for key, metrics in results.items():
+        congestion_control, queue, size, flows = key.split('/')
+        cell = {
+                'congestion_control': congestion_control, 'queue': queue,
+                'size': size, 'flows': int(flows), 'status': 'pass', 'metrics': {},
+        }
+        reference = baseline.get(key, {})
+        for metric, values in metrics.items():
+            comparison = {'current': values, 'current_mean': sum(values) / len(values) if values else None}
+            previous = reference.get(metric)
+            if not values:
+                comparison['status'] = 'error'
+            elif not previous:
+                comparison['status'] = 'no_baseline'
+            else:
+                baseline_mean = sum(previous) / len(previous)
+                change = (comparison['current_mean'] - baseline_mean) / abs(baseline_mean) if baseline_mean else 0.0
+                direction = METRICS[metric]
+                worse_p = permutation_p_value(previous, values, direction)
+                better_p = permutation_p_value(previous, values, -direction)
+                comparison.update(baseline_mean=baseline_mean, change=change, p_value=worse_p)
+                if direction * change < -tolerance and worse_p < alpha:
+                    comparison['status'] = 'regression'
+                elif direction * change > tolerance and better_p < alpha:
+                    comparison['status'] = 'improvement'
+                    comparison['p_value'] = better_p
+                else:
+                    comparison['status'] = 'pass'
+            cell['metrics'][metric] = comparison
+        statuses = {comparison['status'] for comparison in cell['metrics'].values()}
+        for status in ('error', 'regression'):
+            if status in statuses:
+                cell['status'] = status
+                break
+        cells.append(cell)
+    return cells
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Congestion control regression gate on the namespace testbed',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-m', '--matrix', type=str, default=None,
+                        help='JSON file overriding the matrix: congestion_controls, queues, sizes, flows')
+    parser.add_argument('-t', '--trials', type=int, default=TRIALS, help='Trials of each cell')
+    parser.add_argument('-j', '--job', choices=testbed.SERVER_JOBS, default=SERVER_JOB, help='Server job')
+    parser.add_argument('-b', '--baseline', type=str, default=BASELINE, help='Baseline results')
+    parser.add_argument('-u', '--update-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('-r', '--report', type=str, default=None, help='Pass/fail report (default: report.json in the output directory)')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Directory of the trials (default: new temporary directory)')
+    parser.add_argument('--results', type=str, default=None, help='Compare the results.json of a previous run instead of running the matrix')
+    parser.add_argument('--build', type=str, default=None, help=f'Label of the build under test (default: HEAD of {WAVE_SOURCE})')
+    parser.add_argument('--alpha', type=float, default=ALPHA, help='Significance level of the permutation tests')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='Relative change tolerated before a significant difference is a regression')
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results) as results_json:
+            measured = json.load(results_json)
+        output = os.path.dirname(os.path.abspath(args.results))
+    else:
+        if os.geteuid() != 0:
+            sys.exit("The testbed needs root privileges (network namespaces)")
+        output = os.path.abspath(args.output or tempfile.mkdtemp(prefix='quicos_cc_regression-'))
+        cells = load_matrix(args.matrix, args.job)
+        try:
+            results, failures = measure(cells, args.trials, args.job, output)
+        except (OSError, RuntimeError) as e:
+            sys.exit(str(e))
+        measured = {
+                'build': args.build or build_label(), 'date': datetime.now().isoformat(timespec='seconds'),
+                'job': args.job, 'trials': args.trials, 'cells': results, 'failures': failures,
+        }
+        with open(os.path.join(output, 'results.json'), 'w') as results_json:
+            json.dump(measured, results_json, indent=2)
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as baseline_json:
+            json.dump(measured, baseline_json, indent=2)
+        print(f"Baseline {args.baseline} updated ({len(measured['cells'])} cells, build {measured.get('build')})")
+
+    try:
+        with open(args.baseline) as baseline_json:
+            baseline = json.load(baseline_json)
+    except FileNotFoundError:
+        baseline = {'cells': {}}
+        print(f"No baseline {args.baseline}: every cell is reported without comparison")
+
+    cells = compare(measured['cells'], baseline['cells'], args.alpha, args.tolerance)
+    passed = all(cell['status'] == 'pass' for cell in cells)
+    report = {
+            'passed': passed,
+            'build': measured.get('build'),
+            'baseline_build': baseline.get('build'),
+            'date': measured.get('date'),
+            'alpha': args.alpha,
+            'tolerance': args.tolerance,
+            'failures': measured.get('failures', []),
+            'cells': cells,
+    }
+    report_path = args.report or os.path.join(output, 'report.json')
+    with open(report_path, 'w') as report_json:
+        json.dump(report, report_json, indent=2)
+
+    for cell in cells:
+        if cell['status'] != 'pass':
+            details = ', '.join(
+                    f"{metric} {comparison.get('change', 0):+.1%} (p={comparison.get('p_value', float('nan')):.3f})"
+                    for metric, comparison in cell['metrics'].items() if comparison['status'] in ('regression', 'error'))
+            print(f"{cell['status'].upper()}: {cell['congestion_control']} {cell['queue']} {cell['size']} x{cell['flows']}: {details}")
+    print(f"{'PASS' if passed else 'FAIL'}: {sum(cell['status'] == 'pass' for cell in cells)}/{len(cells)} cells, report {report_path}")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OpenBACH is a generic testbed able to control/configure multiple
+# network/physical entities (under test) and collect data from them. It is
+# composed of an Auditorium (HMIs), a Controller, a Collector and multiple
+# Agents (one for each network entity that wants to be tested).
+#
+#
+# Copyright © 2016-2023 CNES
+#
+#
+# This file is part of the OpenBACH testbed.
+#
+#
+# OpenBACH is a free software : you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY, without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+
+"""Stand-in for the OpenBACH collect_agent module, used by the benchmarks
+
+Scripts started from this directory import it instead of the real agent
+library. Every send_stat call is recorded with the wall-clock time at which
+it happened and written, in batches, as JSON lines into
+$QUICOS_BENCH_STATS_DIR/stats_<pid>.jsonl (one file per process, so the
+forked qlog readers of the jobs never share a file). Buffers are flushed on
+SIGTERM and periodically from a background thread, so that neither idle nor
+terminated readers keep points to themselves.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import syslog
+import tempfile
+import threading
+import contextlib
+
+
+FLUSH_SIZE = 4096
+FLUSH_INTERVAL = 0.2
+STATS_DIR_ENV = 'QUICOS_BENCH_STATS_DIR'
+
+
+class _Recorder:
+    def __init__(self):
+        self.pid = None
+        self.output = None
+        self.buffer = []
+        self.lock = threading.RLock()  # re-entered by the SIGTERM handler
+
+    def _open(self):
+        self.pid = os.getpid()
+        self.buffer = []  # records inherited through fork belong to the parent
+        self.lock = threading.RLock()  # re-entered by the SIGTERM handler
+        directory = os.environ.get(STATS_DIR_ENV) or tempfile.gettempdir()
+        self.output = open(os.path.join(directory, f'stats_{self.pid}.jsonl'), 'a')
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _flush_periodically(self):
+        pid = self.pid
+        while pid == os.getpid():
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def record(self, timestamp, suffix, stats):
+        if self.pid != os.getpid():
+            self._open()
+        record = json.dumps([time.time(), timestamp, suffix, stats])
+        with self.lock:
+            self.buffer.append(record)
+            full = len(self.buffer) >= FLUSH_SIZE
+        if full:
+            self.flush()
+
+    def flush(self):
+        if self.output is None or self.pid != os.getpid():
+            return
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+            if buffer:
+                self.output.write('\n'.join(buffer) + '\n')
+            self.output.flush()
+
+
+_recorder = _Recorder()
+
+
+def _terminate(signum, frame):
+    _recorder.flush()
+    os._exit(0)
+
+
+signal.signal(signal.SIGTERM, _terminate)
+
+
+def now():
+    return int(time.time() * 1000)
+
+
+def send_stat(timestamp, suffix=None, **stats):
+    _recorder.record(timestamp, suffix, stats)
+
+
+def flush():
+    _recorder.flush()
+
+
+def send_log(priority, message):
+    if priority <= syslog.LOG_ERR:
+        print(message, file=sys.stderr)
+
+
+def register_collect(config_file, new=False):
+    return True
+
+
+@contextlib.contextmanager
+def use_configuration(config_file):
+    yield
+    _recorder.flush()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OpenBACH is a generic testbed able to control/configure multiple
+# network/physical entities (under test) and collect data from them. It is
+# composed of an Auditorium (HMIs), a Controller, a Collector and multiple
+# Agents (one for each network entity that wants to be tested).
+#
+#
+# Copyright © 2016-2023 CNES
+#
+#
+# This file is part of the OpenBACH testbed.
+#
+#
+# OpenBACH is a free software : you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY, without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+
+
+"""Check of the tc commands of the queueManager schedule action
+
+netem keeps the parameters a 'tc qdisc change' does not give: a trace step
+without rate limit following a limited step must clear the rate explicitly.
+The check writes two-step traces, builds the batch lines of each step as the
+schedule action does, and fails if a step does not set the rate it means.
+
+Usage:
+    python3 benchmarks/netem_schedule_check.py
+"""
+
+import os
+import re
+import sys
+import tempfile
+
+from testbed import load_module
+
+
+# (rate_mbit of the first step, rate_mbit of the second step)
+CASES = [(10, 0), (0, 10), (10, 50), (0, 0)]
+RATE = re.compile(r' rate (\d+(?:\.\d+)?)(mbit|bit)\b')
+
+
+def step_rates(queue_manager, trace):
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as trace_file:
+        trace_file.write(trace)
+    try:
+        steps = queue_manager.load_schedule(trace_file.name)
+    finally:
+        os.unlink(trace_file.name)
+
+    rates = []
+    for verb, step in zip(['replace'] + ['change'] * (len(steps) - 1), steps):
+        command = queue_manager.build_netem_command(verb, 'eth3', step, queue_manager.NETEM_LIMIT)
+        match = RATE.search(command)
+        rates.append(None if match is None else float(match.group(1)) / (1 if match.group(2) == 'mbit' else 1e6))
+        print(command)
+    return rates
+
+
+def main():
+    queue_manager = load_module('queueManager')
+    failures = 0
+    for first, second in CASES:
+        trace = f"time_s,rate_mbit,delay_ms,jitter_ms,loss_percent\n0,{first},250,2,0\n1,{second},600,20,1\n"
+        rates = step_rates(queue_manager, trace)
+        if rates != [first, second]:
+            print(f"FAIL: steps with rates {first} and {second} Mbit/s apply {rates}")
+            failures += 1
+    print(f"{len(CASES) - failures}/{len(CASES)} two-step traces set the rate of every step")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
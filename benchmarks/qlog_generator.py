@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OpenBACH is a generic testbed able to control/configure multiple
+# network/physical entities (under test) and collect data from them. It is
+# composed of an Auditorium (HMIs), a Controller, a Collector and multiple
+# Agents (one for each network entity that wants to be tested).
+#
+#
+# Copyright © 2016-2023 CNES
+#
+#
+# This file is part of the OpenBACH testbed.
+#
+#
+# OpenBACH is a free software : you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY, without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+
+"""Synthetic qlog traces shaped like the ones of wave_server (ngtcp2)
+
+Each connection is written as a JSON-SEQ .sqlog file: the qlog header, then
+transport:packet_sent, transport:packet_received (ACK frames),
+recovery:packet_lost and recovery:metrics_updated events, and a final
+connectivity:connection_closed.
+
+The sender is modelled round by round (one round per RTT): the congestion
+window grows by one MSS per round (doubling in slow start) and is reduced by
+*beta* on losses, random ones or tail drops when the window exceeds the
+bottleneck BDP plus its buffer, whose filling also inflates the RTT. Only
+this per-round recurrence is sequential; packets, ACKs, RTT samples and the
+smoothed RTT/variance estimators are then generated with numpy on whole
+arrays, and lines are formatted from templates, so that GBs of trace are
+produced quickly. A given seed always produces the same traces.
+
+Usage:
+    python3 benchmarks/qlog_generator.py /tmp/qlogs -c 10 -t 60 --rtt 250 --loss 0.001
+"""
+
+import os
+import json
+import argparse
+from dataclasses import dataclass
+
+import numpy as np
+
+
+MSS = 1252
+ACK_LENGTH = 50
+EWMA_CHUNK = 1024
+HEADER_TEMPLATE = {
+        'qlog_version': '0.3',
+        'qlog_format': 'JSON-SEQ',
+        'title': 'ngtcp2 qlog',
+}
+PACKET_SENT = (
+        '\x1e{"time":%.6f,"name":"transport:packet_sent","data":{"header":'
+        '{"packet_type":"1RTT","packet_number":%d},"raw":{"length":%d},'
+        '"frames":[{"frame_type":"stream","stream_id":0,"offset":%d,"length":%d}]}}\n')
+PACKET_RECEIVED = (
+        '\x1e{"time":%.6f,"name":"transport:packet_received","data":{"header":'
+        '{"packet_type":"1RTT","packet_number":%d},"raw":{"length":%d},'
+        '"frames":[{"frame_type":"ack","ack_delay":0,"acked_ranges":[[%d,%d]]}]}}\n')
+PACKET_LOST = (
+        '\x1e{"time":%.6f,"name":"recovery:packet_lost","data":{"header":'
+        '{"packet_type":"1RTT","packet_number":%d}}}\n')
+METRICS_UPDATED = (
+        '\x1e{"time":%.6f,"name":"recovery:metrics_updated","data":{"min_rtt":%.6f,'
+        '"smoothed_rtt":%.6f,"latest_rtt":%.6f,"rtt_variance":%.6f,"pto_count":%d,'
+        '"congestion_window":%d,"bytes_in_flight":%d}}\n')
+CONNECTION_CLOSED = (
+        '\x1e{"time":%.6f,"name":"connectivity:connection_closed","data":{"owner":"local"}}\n')
+
+
+@dataclass
+class LinkModel:
+    rtt: float = 50.0         # base round-trip time (ms)
+    jitter: float = 1.0       # standard deviation of the RTT samples (ms)
+    loss: float = 0.0         # random loss probability of a packet
+    bandwidth: float = 100.0  # bottleneck rate (Mbit/s)
+    buffer: int = 62500       # bottleneck buffer (bytes)
+    beta: float = 0.7         # multiplicative decrease on loss
+    ack_every: int = 2        # packets acknowledged by each ACK
+    initial_window: int = 10 * MSS
+
+
+def ewma(samples, alpha, initial):
+    """Exponentially weighted moving average computed without a Python loop
+
+    s[k] = (1 - alpha) * s[k-1] + alpha * samples[k] is solved in closed form
+    on chunks small enough for (1 - alpha) ** -n to stay finite.
+    """
+    result = np.empty(len(samples))
+    decay = 1.0 - alpha
+    for start in range(0, len(samples), EWMA_CHUNK):
+        chunk = samples[start:start + EWMA_CHUNK]
+        powers = decay ** np.arange(1, len(chunk) + 1)
+        weighted = np.cumsum(alpha * chunk / powers)
+        result[start:start + len(chunk)] = powers * (initial + weighted)
+        initial = result[start + len(chunk) - 1]
+    return result
+
+
+def simulate_rounds(model, duration, rng):
+    """Congestion window, packet count, RTT and losses of each round"""
+    bdp = model.bandwidth * 1e6 / 8 * model.rtt / 1000
+    bytes_per_ms = model.bandwidth * 1e6 / 8 / 1000
+    cwnd = float(model.initial_window)
+    ssthresh = np.inf
+    now = 0.0
+    starts, windows, packets, rtts, losses = [], [], [], [], []
+    while now < duration:
+        count = max(int(cwnd // MSS), 1)
+        queued = min(max(cwnd - bdp, 0.0), model.buffer)
+        rtt = model.rtt + queued / bytes_per_ms
+        lost = rng.binomial(count, model.loss) if model.loss else 0
+        overflow = cwnd - bdp - model.buffer
+        if overflow > 0:
+            lost = max(lost, min(int(overflow // MSS) + 1, count))
+
+        starts.append(now)
+        windows.append(cwnd)
+        packets.append(count)
+        rtts.append(rtt)
+        losses.append(lost)
+
+        if lost:
+            ssthresh = max(cwnd * model.beta, 2 * MSS)
+            cwnd = ssthresh
+        elif cwnd < ssthresh:
+            cwnd *= 2
+        else:
+            cwnd += MSS
+        now += rtt
+
+    return (np.array(starts), np.array(windows), np.array(packets),
+            np.array(rtts), np.array(losses))
+
+
+def generate_events(model, duration, rng):
+    """All the events of one connection, as (times, lines) sorted by time"""
+    starts, windows, packets, rtts, losses = simulate_rounds(model, duration * 1000, rng)
+    total = int(packets.sum())
+    rounds = np.repeat(np.arange(len(packets)), packets)
+    first = np.repeat(np.cumsum(packets) - packets, packets)
+    position = np.arange(total) - first
+
+    # Packets are paced over the round; the last ones of a lossy round are lost
+    sent_times = starts[rounds] + position * rtts[rounds] / packets[rounds]
+    lost = position >= (packets - losses)[rounds]
+    samples = np.maximum(rtts[rounds] + rng.normal(0.0, model.jitter, total), model.rtt / 2)
+    acked_times = sent_times + samples
+
+    delivered = np.flatnonzero(~lost)
+    ack_last = delivered[model.ack_every - 1::model.ack_every]
+    ack_first = delivered[::model.ack_every][:len(ack_last)]
+    ack_times = acked_times[ack_last]
+    latest_rtt = samples[ack_last]
+    min_rtt = np.minimum.accumulate(latest_rtt)
+    smoothed_rtt = ewma(latest_rtt, 1 / 8, latest_rtt[0]) if len(latest_rtt) else latest_rtt
+    previous_srtt = np.concatenate(([latest_rtt[0]], smoothed_rtt[:-1])) if len(latest_rtt) else latest_rtt
+    rtt_variance = ewma(np.abs(previous_srtt - latest_rtt), 1 / 4, latest_rtt[0] / 2) if len(latest_rtt) else latest_rtt
+
+    # Lost packets are declared after 9/8 RTT (time threshold of RFC 9002)
+    lost_indices = np.flatnonzero(lost)
+    lost_times = sent_times[lost_indices] + rtts[rounds[lost_indices]] * 9 / 8
+    in_flight = (
+            np.searchsorted(sent_times, ack_times, side='right')
+            - np.searchsorted(np.sort(acked_times[delivered]), ack_times, side='right')
+            - np.searchsorted(np.sort(lost_times), ack_times, side='right'))
+    # A round entirely lost can only be recovered by a probe timeout
+    pto_count = np.cumsum(losses == packets)[rounds[ack_last]]
+
+    offsets = np.arange(total) * MSS
+    times = [sent_times, ack_times, ack_times, lost_times, [max(sent_times[-1], ack_times.max(initial=0)) + 1]]
+    lines = [
+            [PACKET_SENT % row for row in zip(sent_times.tolist(), range(total), [MSS] * total, offsets.tolist(), [MSS] * total)],
+            [PACKET_RECEIVED % row for row in zip(ack_times.tolist(), range(len(ack_last)), [ACK_LENGTH] * len(ack_last), ack_first.tolist(), ack_last.tolist())],
+            [METRICS_UPDATED % row for row in zip(
+                ack_times.tolist(), min_rtt.tolist(), smoothed_rtt.tolist(), latest_rtt.tolist(),
+                rtt_variance.tolist(), pto_count.tolist(), windows[rounds[ack_last]].astype(np.int64).tolist(),
+                (np.maximum(in_flight, 0) * MSS).tolist())],
+            [PACKET_LOST % row for row in zip(lost_times.tolist(), lost_indices.tolist())],
+            [CONNECTION_CLOSED % times[-1][0]],
+    ]
+    # Received packets come before the metrics update they trigger
+    all_times = np.concatenate([np.asarray(t, dtype=float) for t in times])
+    order = np.argsort(all_times, kind='stable')
+    all_lines = [line for group in lines for line in group]
+    return all_times[order], [all_lines[index] for index in order]
+
+
+def header(odcid, reference_time, vantage_point='server'):
+    content = dict(HEADER_TEMPLATE)
+    content['trace'] = {
+            'vantage_point': {'type': vantage_point},
+            'common_fields': {'group_id': odcid, 'ODCID': odcid, 'reference_time': reference_time},
+    }
+    return '\x1e' + json.dumps(content) + '\n'
+
+
+def generate(directory, connections=1, duration=10.0, model=None, seed=0, reference_time=0.0, stagger=0.0):
+    """Write *connections* synthetic qlogs into *directory*, return their paths"""
+    model = model or LinkModel()
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index in range(connections):
+        rng = np.random.default_rng([seed, index])
+        odcid = rng.bytes(8).hex()
+        path = os.path.join(directory, f'{odcid}.sqlog')
+        _, lines = generate_events(model, duration, rng)
+        with open(path, 'w') as qlog:
+            qlog.write(header(odcid, reference_time + index * stagger * 1000))
+            qlog.writelines(lines)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Generate synthetic wave_server-like qlog traces',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('directory', help='Directory to write the .sqlog files into')
+    parser.add_argument('-c', '--connections', type=int, default=1, help='Number of connections (one file each)')
+    parser.add_argument('-t', '--duration', type=float, default=10, help='Duration of each connection in seconds')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the random generator')
+    parser.add_argument('--rtt', type=float, default=LinkModel.rtt, help='Base round-trip time (ms)')
+    parser.add_argument('--jitter', type=float, default=LinkModel.jitter, help='Standard deviation of the RTT samples (ms)')
+    parser.add_argument('--loss', type=float, default=LinkModel.loss, help='Random loss probability of a packet')
+    parser.add_argument('--bandwidth', type=float, default=LinkModel.bandwidth, help='Bottleneck rate (Mbit/s)')
+    parser.add_argument('--buffer', type=int, default=LinkModel.buffer, help='Bottleneck buffer (bytes)')
+    parser.add_argument('--beta', type=float, default=LinkModel.beta, help='Multiplicative decrease of the window on loss')
+    parser.add_argument('--stagger', type=float, default=0, help='Delay between the reference times of two connections (s)')
+    args = parser.parse_args()
+
+    model = LinkModel(
+            rtt=args.rtt, jitter=args.jitter, loss=args.loss,
+            bandwidth=args.bandwidth, buffer=args.buffer, beta=args.beta)
+    paths = generate(args.directory, args.connections, args.duration, model, args.seed, stagger=args.stagger)
+    size = sum(os.path.getsize(path) for path in paths)
+    print(f"{len(paths)} qlog files written in {args.directory} ({size / 1e6:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
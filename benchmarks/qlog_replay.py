@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OpenBACH is a generic testbed able to control/configure multiple
+# network/physical entities (under test) and collect data from them. It is
+# composed of an Auditorium (HMIs), a Controller, a Collector and multiple
+# Agents (one for each network entity that wants to be tested).
+#
+#
+# Copyright © 2016-2023 CNES
+#
+#
+# This file is part of the OpenBACH testbed.
+#
+#
+# OpenBACH is a free software : you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY, without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+
+"""Replay of qlog traces into a directory watched by a quicos job
+
+Each replayed connection appends the lines of a source .sqlog (recorded by
+wave_server or synthetic) to its own file in the target directory, like
+wave_server does with --qlog-dir. Lines are paced so that the total event
+rate over all connections matches the requested rate; the wall-clock time at
+which each metrics line is written is kept to compute end-to-end latencies.
+"""
+
+import os
+import json
+import time
+import argparse
+
+
+METRICS_EVENT = 'recovery:metrics_updated'
+METRICS_KEYS = (
+        'min_rtt', 'smoothed_rtt', 'latest_rtt', 'rtt_variance',
+        'pto_count', 'congestion_window', 'bytes_in_flight',
+)
+
+
+def is_metrics_line(record):
+    """Whether a qlog record is shipped as one point by every ingestion job"""
+    if record.get('name') != METRICS_EVENT:
+        return False
+    data = record.get('data', {})
+    return all(data.get(key) is not None for key in METRICS_KEYS)
+
+
+class QlogTrace:
+    """Lines of a qlog file split into header and events, parsed once"""
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.events = []
+        self.metrics = []
+        with open(path) as qlog:
+            for line in qlog:
+                cleaned_line = line.strip()
+                if not cleaned_line:
+                    continue
+                try:
+                    record = json.loads(cleaned_line)
+                except json.JSONDecodeError:
+                    continue
+                if self.header is None and 'name' not in record:
+                    self.header = line
+                    continue
+                self.events.append(line)
+                self.metrics.append(is_metrics_line(record))
+
+        if not self.events:
+            raise ValueError(f"No qlog event found in '{path}'")
+
+
+class Connection:
+    def __init__(self, trace, path):
+        self.trace = trace
+        self.path = path
+        self.file = open(path, 'a')
+        if trace.header is not None:
+            self.file.write(trace.header)
+            self.file.flush()
+        self.position = 0
+        self.write_times = []
+
+    @property
+    def finished(self):
+        return self.position >= len(self.trace.events)
+
+    def write_next(self, now):
+        line = self.trace.events[self.position]
+        self.file.write(line if line.endswith('\n') else line + '\n')
+        if self.trace.metrics[self.position]:
+            self.write_times.append(now)
+        self.position += 1
+
+    def close(self):
+        self.file.close()
+
+
+class Replayer:
+    """Append *traces* to *connections* files of *directory* at *rate* events/s"""
+
+    def __init__(self, traces, directory, connections=1, rate=1000, duration=None):
+        self.traces = traces
+        self.directory = directory
+        self.nb_connections = connections
+        self.rate = rate
+        self.duration = duration
+        self.connections = []
+        self.events_written = 0
+        self.start_time = None
+        self.end_time = None
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        for index in range(self.nb_connections):
+            trace = self.traces[index % len(self.traces)]
+            name = f"{index:04d}_{os.path.basename(trace.path)}"
+            self.connections.append(Connection(trace, os.path.join(self.directory, name)))
+
+        self.start_time = time.time()
+        active = list(self.connections)
+        deadline = None if self.duration is None else time.monotonic() + self.duration
+        origin = time.monotonic()
+        turn = 0
+        while active and not self.stopped:
+            # Drift-free pacing: event k is due at origin + k / rate
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                break
+            due = int((now - origin) * self.rate) + 1
+            if due <= self.events_written:
+                time.sleep(max(min(self.events_written / self.rate - (now - origin), 0.01), 0))
+                continue
+
+            wall_clock = time.time()
+            touched = set()
+            while self.events_written < due and active:
+                turn %= len(active)
+                connection = active[turn]
+                connection.write_next(wall_clock)
+                touched.add(connection)
+                self.events_written += 1
+                if connection.finished:
+                    active.pop(turn)
+                else:
+                    turn += 1
+            for connection in touched:
+                connection.file.flush()
+
+        self.end_time = time.time()
+        for connection in self.connections:
+            connection.close()
+
+    @property
+    def metrics_written(self):
+        return sum(len(connection.write_times) for connection in self.connections)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Replay qlog traces into a directory watched by a quicos job',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('directory', help='Directory to write the replayed .sqlog files into')
+    parser.add_argument('qlog', nargs='+', help='Recorded or synthetic .sqlog files to replay')
+    parser.add_argument('-c', '--connections', type=int, default=1, help='Number of concurrent connections')
+    parser.add_argument('-r', '--rate', type=float, default=1000, help='Total number of events written per second')
+    parser.add_argument('-t', '--duration', type=float, default=None, help='Maximum replay duration in seconds')
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    replayer = Replayer(
+            [QlogTrace(path) for path in args.qlog], args.directory,
+            args.connections, args.rate, args.duration)
+    replayer.run()
+    elapsed = replayer.end_time - replayer.start_time
+    print(f"{replayer.events_written} events written in {elapsed:.2f}s "
+          f"({replayer.events_written / elapsed:.0f} events/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OpenBACH is a generic testbed able to control/configure multiple
+# network/physical entities (under test) and collect data from them. It is
+# composed of an Auditorium (HMIs), a Controller, a Collector and multiple
+# Agents (one for each network entity that wants to be tested).
+#
+#
+# Copyright © 2016-2023 CNES
+#
+#
+# This file is part of the OpenBACH testbed.
+#
+#
+# OpenBACH is a free software : you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY, without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+
+"""Ingestion benchmark of the quicos server jobs, without OpenBACH
+
+The LogFileHandler of the selected job watches a scratch directory into which
+qlog traces are replayed at increasing rates. Statistics are captured by the
+stand-in collect_agent of this directory and matched, flow by flow, with the
+lines written by the replayer. For each rate the report gives the delivered
+ratio, end-to-end latency percentiles and the CPU/RSS of the qlog readers; the
+highest rate delivering everything within the latency budget is the maximum
+sustainable event rate.
+
+Usage:
+    python3 benchmarks/run_benchmark.py quicosServerMultiflow_2 -q trace.sqlog -c 4 -r 1000 5000 20000
+
+Without -q, synthetic traces of qlog_generator are replayed instead.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import importlib.util
+from threading import Thread
+
+import collect_agent
+from qlog_replay import QlogTrace, Replayer
+from qlog_generator import generate
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOBS = {
+        'quicosServer': os.path.join(ROOT, 'quicosServer', 'files', 'quicosServer.py'),
+        'quicosServerMultiflow_2': os.path.join(ROOT, 'quicosServerMultiflow_2', 'files', 'quicosServerMultiflow_2.py'),
+        'quicosWAVE': os.path.join(ROOT, 'quicosWAVE', 'files', 'quicosWAVE.py'),
+}
+FLOW_FIELD = re.compile(r'^smoothed_rtt(?:_(\d+))?$')
+POLL_INTERVAL = 0.05
+
+
+def load_job(name):
+    spec = importlib.util.spec_from_file_location(f'quicos_benchmark_{name}', JOBS[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    rank = min(int(q / 100 * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[rank]
+
+
+class StatsCollector:
+    """Incremental reader of the files written by the stand-in collect_agent"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.offsets = {}
+        self.received = {}
+
+    @staticmethod
+    def flow_of(suffix, stats):
+        for key, value in stats.items():
+            match = FLOW_FIELD.match(key)
+            if match and value is not None:
+                return suffix if suffix is not None else match.group(1)
+        return False  # not a QUIC metrics point (telemetry, empty record...)
+
+    def poll(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            with open(path) as stats_file:
+                stats_file.seek(self.offsets.get(path, 0))
+                while True:
+                    line = stats_file.readline()
+                    if not line.endswith('\n'):
+                        break
+                    self.offsets[path] = stats_file.tell()
+                    wall_clock, _, suffix, stats = json.loads(line)
+                    flow = self.flow_of(suffix, stats)
+                    if flow is not False:
+                        self.received.setdefault(flow, []).append(wall_clock)
+        return sum(len(times) for times in self.received.values())
+
+
+def run_once(job, traces, connections, rate, duration, drain_timeout):
+    workdir = tempfile.mkdtemp(prefix='quicos_benchmark-')
+    watched_dir = os.path.join(workdir, 'qlogs')
+    stats_dir = os.path.join(workdir, 'stats')
+    os.makedirs(watched_dir)
+    os.makedirs(stats_dir)
+    os.environ[collect_agent.STATS_DIR_ENV] = stats_dir
+
+    handler = job.LogFileHandler(collect_agent)
+    observer = job.Observer()
+    observer.schedule(handler, path=watched_dir, recursive=False)
+    observer.start()
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    collector = StatsCollector(stats_dir)
+    replayer = Replayer(traces, watched_dir, connections, rate, duration)
+    replay_thread = Thread(target=replayer.run)
+    replay_thread.start()
+
+    # Flow labels are only known by the handler: remember them while they live
+    flows = {}
+    while replay_thread.is_alive():
+        flows.update({str(index): path for path, index in handler.file_indices.items()})
+        time.sleep(POLL_INTERVAL)
+    replay_thread.join()
+
+    deadline = time.monotonic() + drain_timeout
+    while collector.poll() < replayer.metrics_written and time.monotonic() < deadline:
+        flows.update({str(index): path for path, index in handler.file_indices.items()})
+        if hasattr(handler, 'reap_readers'):
+            handler.reap_readers()
+        time.sleep(POLL_INTERVAL)
+
+    observer.stop()
+    observer.join()
+    for process in list(handler.processes.values()):
+        process.terminate()
+        process.join()
+    collector.poll()
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    if flows:
+        # Jobs shipping unlabelled metrics only follow their first connection
+        flows[None] = flows[min(flows, key=int)]
+    write_times = {connection.path: connection.write_times for connection in replayer.connections}
+    latencies = []
+    for flow, received in collector.received.items():
+        written = write_times.get(flows.get(flow), [])
+        latencies.extend(
+                received_at - written_at
+                for written_at, received_at in zip(written, received))
+    latencies.sort()
+
+    monitored = {flows[flow] for flow in collector.received if flow in flows}
+    expected = sum(len(write_times[path]) for path in monitored) if monitored else replayer.metrics_written
+    elapsed = replayer.end_time - replayer.start_time
+    reader_cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+            'offered_rate': rate,
+            'connections': connections,
+            'events_written': replayer.events_written,
+            'achieved_rate': replayer.events_written / elapsed if elapsed else 0,
+            'metrics_written': expected,
+            'metrics_delivered': len(latencies),
+            'delivered_ratio': len(latencies) / expected if expected else 0,
+            'latency_p50_s': percentile(latencies, 50),
+            'latency_p90_s': percentile(latencies, 90),
+            'latency_p99_s': percentile(latencies, 99),
+            'latency_max_s': latencies[-1] if latencies else None,
+            'reader_cpu_s': reader_cpu,
+            'reader_cpu_percent': 100 * reader_cpu / elapsed if elapsed else 0,
+            'reader_max_rss_mb': usage_after.ru_maxrss / 1024,
+    }
+
+
+def _format(value, pattern):
+    return '-' if value is None else pattern.format(value)
+
+
+def print_report(job_name, results, max_sustainable):
+    print(f"Ingestion benchmark of {job_name}")
+    print(f"{'rate':>10} {'achieved':>10} {'delivered':>10} {'p50 (ms)':>10} {'p90 (ms)':>10} "
+          f"{'p99 (ms)':>10} {'max (ms)':>10} {'cpu %':>8} {'rss (MB)':>9} ok")
+    for result in results:
+        latencies = [
+                _format(result[key] and result[key] * 1000, '{:.1f}')
+                for key in ('latency_p50_s', 'latency_p90_s', 'latency_p99_s', 'latency_max_s')]
+        print(f"{result['offered_rate']:>10.0f} {result['achieved_rate']:>10.0f} "
+              f"{result['delivered_ratio']:>10.2%} {latencies[0]:>10} {latencies[1]:>10} "
+              f"{latencies[2]:>10} {latencies[3]:>10} {result['reader_cpu_percent']:>8.1f} "
+              f"{result['reader_max_rss_mb']:>9.1f} {'yes' if result['sustainable'] else 'no'}")
+    print(f"Maximum sustainable rate: {_format(max_sustainable, '{:.0f} events/s')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the qlog ingestion of a quicos server job',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('job', choices=list(JOBS), help='Job whose ingestion code is benchmarked')
+    parser.add_argument('-q', '--qlog', nargs='+', default=None, help='Recorded or synthetic .sqlog files to replay')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the synthetic traces used without --qlog')
+    parser.add_argument('-c', '--connections', type=int, default=1, help='Number of concurrent connections')
+    parser.add_argument('-r', '--rates', type=float, nargs='+', default=[1000, 5000, 20000], help='Event rates (events/s) to try')
+    parser.add_argument('-t', '--duration', type=float, default=10, help='Replay duration of each rate in seconds')
+    parser.add_argument('-d', '--drain-timeout', type=float, default=10, help='Time left to the job to catch up after the replay')
+    parser.add_argument('-m', '--max-latency', type=float, default=1.0, help='p99 latency budget (s) of a sustainable rate')
+    parser.add_argument('-j', '--json', type=str, default=None, help='Also write the results into this JSON file')
+    args = parser.parse_args()
+
+    job = load_job(args.job)
+    if args.qlog:
+        traces = [QlogTrace(path) for path in args.qlog]
+    else:
+        synthetic_dir = tempfile.mkdtemp(prefix='quicos_benchmark_traces-')
+        # Long enough for every connection to last the whole replay at the highest rate
+        duration = args.duration * max(args.rates) / args.connections / 1000
+        traces = [QlogTrace(path) for path in generate(synthetic_dir, args.connections, duration, seed=args.seed)]
+        shutil.rmtree(synthetic_dir, ignore_errors=True)
+
+    results = []
+    stdout = sys.stdout
+    for rate in sorted(args.rates):
+        # The jobs print every point they ship: keep that out of the report
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            try:
+                result = run_once(job, traces, args.connections, rate, args.duration, args.drain_timeout)
+            finally:
+                sys.stdout = stdout
+        result['sustainable'] = (
+                result['delivered_ratio'] >= 0.999
+                and result['latency_p99_s'] is not None
+                and result['latency_p99_s'] <= args.max_latency)
+        results.append(result)
+
+    sustainable = [result['achieved_rate'] for result in results if result['sustainable']]
+    max_sustainable = max(sustainable) if sustainable else None
+    print_report(args.job, results, max_sustainable)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'job': args.job, 'max_sustainable_rate': max_sustainable, 'runs': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
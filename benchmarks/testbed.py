@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OpenBACH is a generic testbed able to control/configure multiple
+# network/physical entities (under test) and collect data from them. It is
+# composed of an Auditorium (HMIs), a Controller, a Collector and multiple
+# Agents (one for each network entity that wants to be tested).
+#
+#
+# Copyright © 2016-2023 CNES
+#
+#
+# This file is part of the OpenBACH testbed.
+#
+#
+# OpenBACH is a free software : you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY, without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see http://www.gnu.org/licenses/.
+
+
+"""Single-host emulation of the quicos testbed with network namespaces
+
+The b1/s1 topology of L23ConfigJob is rebuilt with one namespace per host
+and veth pairs, without any OpenBACH deployment:
+
+    client 10.0.10.2 --- 10.0.10.1 b1 eth3 10.0.30.2 --- 10.0.30.1 terr 10.0.40.1 ---+
+                                      eth4 10.0.100.2 --- 10.0.100.1 sat 10.0.40.254 -+- br0 10.0.40.2 s1
+
+eth3 and eth4 of b1 are the bottleneck interfaces of queueManager, which runs
+unchanged in b1 (--queue); the terr and sat namespaces delay both directions
+of their path with netem. Routes are those of change_route.sh, and 'route'
+switches them like L23ConfigJob. 'run' starts the server job in s1 and the
+quicosClient job in client, both on the local wave_server/wave_client
+binaries, with the stand-in collect_agent of this directory recording their
+statistics.
+
+Usage (as root):
+    python3 benchmarks/testbed.py up --terr-delay 10 --sat-delay 125 --queue HTB
+    python3 benchmarks/testbed.py run quicosServerMultiflow_2 -o /tmp/testbed -s 50M
+    python3 benchmarks/testbed.py route sat
+    python3 benchmarks/testbed.py down
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import inspect
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+
+import collect_agent
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+SERVER_JOBS = ('quicosServer', 'quicosServerMultiflow_2', 'quicosWAVE')
+QUEUES = ('HTB', 'FIFO', 'FQ_CoDel', 'NetemQueue')
+PREFIX = 'quicos_'
+HOSTS = ('client', 'b1', 'terr', 'sat', 's1')
+ROUTERS = ('b1', 'terr', 'sat')
+# veth pairs: (host, interface, address) of each end; s1 bridges its two ends
+LINKS = (
+        (('client', 'eth0', '10.0.10.2/24'), ('b1', 'eth0', '10.0.10.1/24')),
+        (('b1', 'eth3', '10.0.30.2/24'), ('terr', 'eth0', '10.0.30.1/24')),
+        (('b1', 'eth4', '10.0.100.2/24'), ('sat', 'eth0', '10.0.100.1/24')),
+        (('terr', 'eth1', '10.0.40.1/24'), ('s1', 'terr0', None)),
+        (('sat', 'eth1', '10.0.40.254/24'), ('s1', 'sat0', None)),
+)
+S1_BRIDGE = ('br0', '10.0.40.2/24', ('terr0', 'sat0'))
+STATIC_ROUTES = {
+        'client': [('default', '10.0.10.1')],
+        'terr': [('10.0.10.0/24', '10.0.30.2')],
+        'sat': [('10.0.10.0/24', '10.0.100.2')],
+}
+PATH_INTERFACES = {'terr': ('eth0', 'eth1'), 'sat': ('eth0', 'eth1')}
+SERVER_IP = '10.0.40.2'
+SERVER_PORT = 4433
+RESOURCE = 'testbed.bin'
+BINARIES = ('wave_server', 'wave_client')
+SERVER_STARTUP = 1  # s left to wave_server before the client starts
+SERVER_STOP_TIMEOUT = 10  # s
+
+
+def namespace(host):
+    return PREFIX + host
+
+
+def run(*cmd, host=None, check=True):
+    """Run *cmd*, inside the namespace of *host* if given"""
+    if host is not None:
+        cmd = ('ip', 'netns', 'exec', namespace(host)) + cmd
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if check and p.returncode:
+        raise RuntimeError(f"{' '.join(cmd)}: {p.stderr.strip() or f'exit code {p.returncode}'}")
+    return p
+
+
+def existing_namespaces():
+    output = run('ip', 'netns', 'list').stdout
+    return {line.split()[0] for line in output.splitlines() if line.strip()}
+
+
+def load_module(name):
+    spec = importlib.util.spec_from_file_location(f'quicos_testbed_{name}', os.path.join(ROOT, name, 'files', f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def job_environment(stats_dir=None):
+    """Environment of the jobs: stand-in collect_agent first on the path"""
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [BENCHMARKS, environment.get('PYTHONPATH')]))
+    if stats_dir is not None:
+        environment[collect_agent.STATS_DIR_ENV] = stats_dir
+    return environment
+
+
+def up(terr_delay, sat_delay, jitter, loss, queue):
+    if PREFIX + 's1' in existing_namespaces():
+        sys.exit("The testbed is already up, take it down first")
+
+    for host in HOSTS:
+        run('ip', 'netns', 'add', namespace(host))
+        run('ip', 'link', 'set', 'lo', 'up', host=host)
+        # Both paths end on the same hosts: never drop packets coming from the other one
+        for conf in ('all', 'default'):
+            run('sysctl', '-qw', f'net.ipv4.conf.{conf}.rp_filter=0', host=host)
+    for host in ROUTERS:
+        run('sysctl', '-qw', 'net.ipv4.ip_forward=1', host=host)
+
+    for index, ends in enumerate(LINKS):
+        temporary = [f'qtb{index}a', f'qtb{index}b']
+        run('ip', 'link', 'add', temporary[0], 'type', 'veth', 'peer', 'name', temporary[1])
+        for name, (host, interface, address) in zip(temporary, ends):
+            run('ip', 'link', 'set', name, 'netns', namespace(host))
+            run('ip', '-n', namespace(host), 'link', 'set', name, 'name', interface)
+            if address is not None:
+                run('ip', '-n', namespace(host), 'addr', 'add', address, 'dev', interface)
+            run('ip', '-n', namespace(host), 'link', 'set', interface, 'up')
+
+    bridge, address, ports = S1_BRIDGE
+    run('ip', '-n', namespace('s1'), 'link', 'add', bridge, 'type', 'bridge')
+    for port in ports:
+        run('ip', '-n', namespace('s1'), 'link', 'set', port, 'master', bridge)
+    run('ip', '-n', namespace('s1'), 'addr', 'add', address, 'dev', bridge)
+    run('ip', '-n', namespace('s1'), 'link', 'set', bridge, 'up')
+
+    for host, routes in STATIC_ROUTES.items():
+        for destination, gateway in routes:
+            run('ip', '-n', namespace(host), 'route', 'add', destination, 'via', gateway)
+    for host, (destination, gateways) in load_module('L23ConfigJob').ROUTES.items():
+        run('ip', '-n', namespace(host), 'route', 'add', destination, 'via', gateways['terr'])
+
+    for host, delay in (('terr', terr_delay), ('sat', sat_delay)):
+        if not (delay or jitter or loss):
+            continue
+        command = ['qdisc', 'replace', 'dev', None, 'root', 'netem', 'delay', f'{delay}ms']
+        if jitter:
+            command.append(f'{jitter}ms')
+        if loss:
+            command.extend(['loss', f'{loss}%'])
+        for interface in PATH_INTERFACES[host]:
+            command[3] = interface
+            run('tc', *command, host=host)
+
+    if queue:
+        set_queue(queue)
+
+    print(f"Testbed up: namespaces {', '.join(namespace(host) for host in HOSTS)}, route terr, server {SERVER_IP}")
+
+
+def set_queue(queue):
+    """Bottleneck of eth3 and eth4 of b1, configured by the queueManager job itself"""
+    p = subprocess.run(
+            ['ip', 'netns', 'exec', namespace('b1'), sys.executable,
+             os.path.join(ROOT, 'queueManager', 'files', 'queueManager.py'), 'set_queue', queue, '--bond'],
+            env=job_environment(tempfile.gettempdir()), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    print(p.stdout.strip())
+    if p.returncode:
+        raise RuntimeError(f"queueManager failed with exit code {p.returncode}")
+
+
+def down():
+    present = existing_namespaces()
+    for host in HOSTS:
+        if namespace(host) in present:
+            # veth pairs and the bridge disappear with their namespaces
+            run('ip', 'netns', 'del', namespace(host))
+    print("Testbed down")
+
+
+def route(path):
+    """Switch the routes of b1 and s1 to *path*, like L23ConfigJob and change_route.sh"""
+    start = time.perf_counter()
+    for host, (destination, gateways) in load_module('L23ConfigJob').ROUTES.items():
+        run('ip', '-n', namespace(host), 'route', 'change', destination, 'via', gateways[path])
+    print(f"Routes switched to {path} in {(time.perf_counter() - start) * 1000:.3f} ms")
+
+
+def prepare_htdocs(directory, size=None):
+    """Resource served to the client (if *size* is given) and self-signed certificate of wave_server"""
+    htdocs = os.path.join(directory, 'htdocs')
+    os.makedirs(htdocs, exist_ok=True)
+    if size is not None:
+        with open(os.path.join(htdocs, RESOURCE), 'wb') as resource:
+            resource.truncate(size)
+    key = os.path.join(directory, 'server.key')
+    cert = os.path.join(directory, 'server.crt')
+    if not os.path.exists(cert):
+        run('openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=quicos-testbed', '-keyout', key, '-out', cert)
+    return htdocs, key, cert
+
+
+def _job_call(module, function, values):
+    """Call *function* of a job with the arguments of its signature taken from *values*
+
+    The server jobs do not share the same signature: the arguments a testbed
+    does not set keep the defaults of the job command line.
+    """
+    parameters = inspect.signature(function).parameters
+    missing = [name for name in parameters if name not in values]
+    if missing:
+        raise TypeError(f"{module.__name__}.{function.__name__}: no testbed value for {', '.join(missing)}")
+    return function(**{name: values[name] for name in parameters})
+
+
+def serve(job_name, directory, congestion_control, downsample_interval, extra_args):
+    """Run the server job in the current namespace (started by 'run' in s1)"""
+    job = load_module(job_name)
+    job.HTDOCS, job.KEY, job.CERT = prepare_htdocs(directory)
+    log_dir = os.path.join(directory, 'server')
+    os.makedirs(log_dir, exist_ok=True)
+    _job_call(job, job.server, {
+            'implementation': 'ngtcp2',
+            'congestion_control': congestion_control,
+            'server_port': SERVER_PORT,
+            'log_dir': log_dir,
+            'extra_args': extra_args,
+            'server_ip': SERVER_IP,
+            'idle_timeout': getattr(job, 'IDLE_TIMEOUT', None),
+            'reuse_flow_slots': False,
+            'stat_sink': 'collect_agent',
+            'sink_file': None,
+            'sink_address': job.SINK_ADDRESS,
+            'archive_dir': None,
+            'packet_stats_interval': job.PACKET_STATS_INTERVAL,
+            'downsample_interval': downsample_interval,
+            'qlog_sample_every': job.QLOG_SAMPLE_EVERY,
+            'qlog_sample_first': job.QLOG_SAMPLE_FIRST,
+            'qlog_sample_fraction': job.QLOG_SAMPLE_FRACTION,
+            'experiment_id': None,
+            'qdisc': None,
+    })
+
+
+def fetch(directory, runs, extra_args, flow=1):
+    """Run the quicosClient job in the current namespace (started by 'run' in client)"""
+    job = load_module('quicosClient')
+    log_dir = os.path.join(directory, 'client', str(flow))
+    download_dir = os.path.join(directory, 'downloads', str(flow))
+    _job_call(job, job.client, {
+            'implementation': 'ngtcp2',
+            'server_port': SERVER_PORT,
+            'log_dir': log_dir,
+            'extra_args': extra_args,
+            'server_ip': SERVER_IP,
+            'resources': RESOURCE,
+            'download_dir': download_dir,
+            'nb_runs': runs,
+            'experiment_id': None,
+            'qdisc': None,
+            'target_precision': None,
+            'precision_metric': job.PRECISION_METRICS[0],
+            'confidence': job.DEFAULT_CONFIDENCE,
+            'min_runs': job.DEFAULT_MIN_RUNS,
+    })
+
+
+def _parse_size(size):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1].upper()])
+    return int(size)
+
+
+def stop(process):
+    """Terminate the session of *process* (the job and the binary it started)"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(SERVER_STOP_TIMEOUT)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+
+
+def experiment(job_name, directory, size, runs, congestion_control, downsample_interval=0,
+               server_args=None, client_args=None, flows=1):
+    """Server job in s1, *flows* concurrent client jobs in client, statistics of all in *directory*/stats
+
+    Returns the directory of the experiment and the exit codes of the clients.
+    """
+    if PREFIX + 's1' not in existing_namespaces():
+        raise RuntimeError("The testbed is not up")
+    missing = [binary for binary in BINARIES if shutil.which(binary) is None]
+    if missing:
+        raise RuntimeError(f"Binaries not found in PATH: {', '.join(missing)}")
+
+    directory = os.path.abspath(directory or tempfile.mkdtemp(prefix='quicos_testbed-'))
+    stats_dir = os.path.join(directory, 'stats')
+    os.makedirs(stats_dir, exist_ok=True)
+    prepare_htdocs(directory, size)
+    environment = job_environment(stats_dir)
+    this = os.path.abspath(__file__)
+
+    server_cmd = ['ip', 'netns', 'exec', namespace('s1'), sys.executable, this, 'serve', job_name, directory,
+                  '--cc', congestion_control, '--downsample-interval', str(downsample_interval)]
+    if server_args:
+        server_cmd.extend(['--extra-args', server_args])
+    with open(os.path.join(directory, 'server.out'), 'w') as output:
+        # Own session: wave_server is stopped with the job, not left behind
+        server = subprocess.Popen(server_cmd, env=environment, stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        time.sleep(SERVER_STARTUP)
+        if server.poll() is not None:
+            raise RuntimeError(f"The server job exited with code {server.returncode}, see {directory}/server.out")
+
+        clients = []
+        start = time.monotonic()
+        for flow in range(1, flows + 1):
+            client_cmd = ['ip', 'netns', 'exec', namespace('client'), sys.executable, this,
+                          'fetch', directory, '-n', str(runs), '--flow', str(flow)]
+            if client_args:
+                client_cmd.extend(['--extra-args', client_args])
+            with open(os.path.join(directory, f'client_{flow}.out'), 'w') as output:
+                clients.append(subprocess.Popen(client_cmd, env=environment, stdout=output, stderr=subprocess.STDOUT))
+        returncodes = [client.wait() for client in clients]
+        elapsed = time.monotonic() - start
+    finally:
+        stop(server)
+
+    print(f"{flows} flow(s) of {runs} run(s) of {size} bytes with {job_name} ({congestion_control}) in {elapsed:.1f} s, "
+          f"client exit codes {returncodes}")
+    print(f"qlogs: {directory}/server, {directory}/client; statistics: {stats_dir}")
+    return directory, returncodes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Single-host emulated quicos testbed (network namespaces)',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    parser_up = subparsers.add_parser('up', help='Create the namespaces, links and routes (terr route active)')
+    parser_up.add_argument('--terr-delay', type=float, default=10, help='One-way delay (ms) of the terr path')
+    parser_up.add_argument('--sat-delay', type=float, default=125, help='One-way delay (ms) of the sat path')
+    parser_up.add_argument('--jitter', type=float, default=0, help='Delay jitter (ms) of both paths')
+    parser_up.add_argument('--loss', type=float, default=0, help='Loss (percent) of both paths, in each direction')
+    parser_up.add_argument('--queue', choices=QUEUES, default=None,
+                           help='Bottleneck of eth3/eth4 of b1, set by queueManager')
+
+    parser_queue = subparsers.add_parser('queue', help='Change the bottleneck of eth3/eth4 of b1 with queueManager')
+    parser_queue.add_argument('queue', choices=QUEUES)
+
+    subparsers.add_parser('down', help='Delete the namespaces')
+
+    parser_route = subparsers.add_parser('route', help='Switch the routes of b1 and s1')
+    parser_route.add_argument('path', choices=['terr', 'sat'])
+
+    parser_run = subparsers.add_parser('run', help='Run a server job in s1 and quicosClient in client')
+    parser_run.add_argument('job', choices=SERVER_JOBS, help='Server job')
+    parser_run.add_argument('-o', '--output', type=str, default=None, help='Directory of the qlogs and statistics (default: new temporary directory)')
+    parser_run.add_argument('-s', '--size', type=_parse_size, default='10M', help='Size of the downloaded resource (K, M, G suffixes)')
+    parser_run.add_argument('-n', '--runs', type=int, default=1, help='Number of downloads of each flow')
+    parser_run.add_argument('-f', '--flows', type=int, default=1, help='Number of concurrent clients')
+    parser_run.add_argument('-c', '--cc', type=str, default='wave', help='Congestion control of the server')
+    parser_run.add_argument('--downsample-interval', type=float, default=0, help='Downsample interval of the server job')
+    parser_run.add_argument('--server-args', type=str, default=None, help='Extra arguments of wave_server')
+    parser_run.add_argument('--client-args', type=str, default=None, help='Extra arguments of wave_client')
+
+    # Run by 'run' inside the namespaces
+    parser_serve = subparsers.add_parser('serve', help='Server job in the current namespace')
+    parser_serve.add_argument('job', choices=SERVER_JOBS)
+    parser_serve.add_argument('directory')
+    parser_serve.add_argument('--cc', type=str, default='wave')
+    parser_serve.add_argument('--downsample-interval', type=float, default=0)
+    parser_serve.add_argument('--extra-args', type=str, default=None)
+    parser_fetch = subparsers.add_parser('fetch', help='quicosClient job in the current namespace')
+    parser_fetch.add_argument('directory')
+    parser_fetch.add_argument('-n', '--runs', type=int, default=1)
+    parser_fetch.add_argument('--flow', type=int, default=1)
+    parser_fetch.add_argument('--extra-args', type=str, default=None)
+
+    args = parser.parse_args()
+    if os.geteuid() != 0:
+        sys.exit("The testbed needs root privileges (network namespaces)")
+
+    try:
+        if args.action == 'up':
+            up(args.terr_delay, args.sat_delay, args.jitter, args.loss, args.queue)
+        elif args.action == 'down':
+            down()
+        elif args.action == 'queue':
+            set_queue(args.queue)
+        elif args.action == 'route':
+            route(args.path)
+        elif args.action == 'run':
+            _, returncodes = experiment(
+                    args.job, args.output, args.size, args.runs, args.cc,
+                    args.downsample_interval, args.server_args, args.client_args, args.flows)
+            if any(returncodes):
+                sys.exit(1)
+        elif args.action == 'serve':
+            serve(args.job, args.directory, args.cc, args.downsample_interval, args.extra_args)
+        elif args.action == 'fetch':
+            fetch(args.directory, args.runs, args.extra_args, args.flow)
+    except (OSError, RuntimeError) as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main()
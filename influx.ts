@@ -64,6 +64,35 @@ export function getStatisticsComparative(jobID: number, statName: string, suffix
 };
 
 
+// Downsampled statistics written by the quicos jobs next to the per-ACK points
+// (<statistic>_<window>_mean and <statistic>_<window>_max), and the shortest
+// scenario duration from which each window is queried instead of the raw data
+const ROLLUP_STATISTICS = /^(min_rtt|smoothed_rtt|latest_rtt|rtt_variance|pto_count|congestion_window|bytes_in_flight)$/;
+const ROLLUP_WINDOWS: Array<[string, number]> = [
+    ["10s", moment.duration(6, "hours").asMilliseconds()],
+    ["1s", moment.duration(30, "minutes").asMilliseconds()],
+];
+
+
+const chooseRollupWindow = (instance: IScenarioInstance): string => {
+    const start = moment(instance.start_date);
+    const stop = instance.stop_date ? moment(instance.stop_date) : moment();
+    const duration = stop.diff(start);
+    const rollup = ROLLUP_WINDOWS.find(([window, minimumDuration]: [string, number]) => duration >= minimumDuration);
+    return rollup ? rollup[0] : null;
+};
+
+
+const rollupField = (statName: string, window: string): string => {
+    if (!window || !ROLLUP_STATISTICS.test(statName)) {
+        return null;
+    }
+    // PTO counts and window sizes are read for their peaks, the RTTs for their trend
+    const aggregate = /^(pto_count|congestion_window|bytes_in_flight)/.test(statName) ? "max" : "mean";
+    return `${statName}_${window}_${aggregate}`;
+};
+
+
 interface IGraphIntermediate {
     agent: string;
     name: string;
@@ -97,9 +126,15 @@ export function postGrafanaDashboard(instance: IScenarioInstance, statistics: IG
                 unit,
             });
         }
-        targets.push(statName);
+        // Per-flow statistics share their name and differ by suffix only: one
+        // query grouped by "@suffix" already draws every flow
+        if (!targets.includes(statName)) {
+            targets.push(statName);
+        }
     });
 
+    const rollupWindow = chooseRollupWindow(instance);
+
     const dashboard = {
         cells: graphs.map((graph: IGraphIntermediate, index: number) => {
             let yLabel = "Valore di prova per Y";
@@ -124,16 +159,19 @@ export function postGrafanaDashboard(instance: IScenarioInstance, statistics: IG
                 h: 4,
                 name: `${graphName} (#${graph.jobId})`,
                 type: isSingleStat ? "single-stat" : "line",
-                queries: graph.targets.map((statName: string, id: number) => ({
-                    query: [
-                        `SELECT "${statName}" FROM "openbach"."openbach"."${graph.name}"`,
-                        `WHERE time > ${moment(instance.start_date).valueOf()}ms`,
-                        `AND "@job_instance_id"='${graph.jobId}' GROUP BY "@suffix" FILL(null)`,
-                    ].join(" "),
-                    source: "",
-                    text: `${statName} (${graph.unit})`,
-                    type: "influxql",
-                })),
+                queries: graph.targets.map((statName: string, id: number) => {
+                    const field = rollupField(statName, rollupWindow);
+                    return {
+                        query: [
+                            `SELECT "${field || statName}" FROM "openbach"."openbach"."${graph.name}"`,
+                            `WHERE time > ${moment(instance.start_date).valueOf()}ms`,
+                            `AND "@job_instance_id"='${graph.jobId}' GROUP BY "@suffix" FILL(null)`,
+                        ].join(" "),
+                        source: "",
+                        text: field ? `${statName} (${graph.unit}, ${rollupWindow} ${field.split("_").pop()})` : `${statName} (${graph.unit})`,
+                        type: "influxql",
+                    };
+                }),
                 axes: {
                     x: {
                         base: "10",
@@ -1,7 +1,43 @@
 import collect_agent
-import os
 import sys
+import time
+import errno
+import socket
+import struct
+import syslog
 import argparse
+import subprocess
+from collections import namedtuple
+
+# Errors of 'tc qdisc del' meaning that the root qdisc is already the default one
+ALREADY_RESET_ERRORS = ('Cannot delete qdisc with handle of zero', 'No such file or directory')
+
+MIN_MONITOR_INTERVAL = 10  # ms
+OVERHEAD_REPORT_INTERVAL = 1  # s
+SPIN_MARGIN = 0.002  # s, busy-wait before a scheduled step for ms accuracy
+NETEM_LIMIT = 62500
+# Read by the quicos jobs to record the bottleneck of their runs
+QDISC_FILE = '/opt/openbach/scripts/curr_queue.conf'
+
+ScheduleStep = namedtuple('ScheduleStep', 'time rate delay jitter loss')
+
+# rtnetlink constants (linux/netlink.h, linux/rtnetlink.h, linux/gen_stats.h)
+NLMSG_HEADER = struct.Struct('IHHII')
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_GETQDISC = 38
+RTM_GETTCLASS = 42
+TCMSG = struct.Struct('BBHiIII')
+RTATTR = struct.Struct('HH')
+TCA_KIND = 1
+TCA_STATS2 = 7
+TCA_STATS_BASIC = 1
+TCA_STATS_QUEUE = 3
+GNET_STATS_BASIC = struct.Struct('QI')
+GNET_STATS_QUEUE = struct.Struct('IIIII')
+
 
 def main():
     config_file = '/opt/openbach/agent/jobs/queueManager/queueManager_rstats_filter.conf'
@@ -14,9 +50,13 @@ def main():
 
     # Parsing degli argomenti e logica del job
     parser = argparse.ArgumentParser(description="Queue Manager Job")
-    parser.add_argument('action', type=str, choices=['reset_queue', 'set_queue'], help="Action to perform")
+    parser.add_argument('action', type=str, choices=['reset_queue', 'set_queue', 'monitor', 'schedule'], help="Action to perform")
     parser.add_argument('queue_type', type=str, choices=['HTB', 'FIFO', 'FQ_CoDel', 'NetemQueue'], nargs='?', default='HTB', help="Type of queue to configure")
+    parser.add_argument('--trace-file', type=str, default=None, help="Schedule of the schedule action: CSV lines 'time_s,rate_mbit,delay_ms,jitter_ms,loss_percent'")
+    parser.add_argument('--limit', type=int, default=NETEM_LIMIT, help="Queue limit (packets) of the netem qdisc of the schedule action")
     parser.add_argument('--bond', action='store_true', help="Apply to both eth3 and eth4")
+    parser.add_argument('--interval', type=int, default=100, help="Sampling interval of the monitor action, in ms (min 10)")
+    parser.add_argument('--duration', type=float, default=0, help="Duration of the monitor action in seconds (0 to run until stopped)")
 
     args = parser.parse_args()
 
@@ -25,34 +65,323 @@ def main():
         reset_queue(args.bond)
     elif args.action == "set_queue" and args.queue_type:
         set_queue(args.queue_type, args.bond)
+    elif args.action == "monitor":
+        if args.interval < MIN_MONITOR_INTERVAL:
+            fail(f"The monitor interval must be at least {MIN_MONITOR_INTERVAL} ms")
+        monitor(args.bond, args.interval, args.duration)
+    elif args.action == "schedule":
+        if not args.trace_file:
+            fail("The schedule action needs a --trace-file")
+        schedule(args.trace_file, args.bond, args.limit)
     else:
         print("ERROR: Invalid arguments.")
         sys.exit(1)
 
-def reset_queue(bond):
+
+def get_interfaces(bond):
     interfaces = ['eth3']
     if bond:
         interfaces.append('eth4')
+    return interfaces
+
+
+def run_tc_batch(commands, force=False):
+    """Apply all *commands* with a single tc process and return its duration in ms
+
+    Without *force*, tc stops at the first failing command; with it, every
+    command is tried. The errors reported by tc are returned along with the
+    duration, the caller decides which ones are fatal.
+    """
+    cmd = ['tc']
+    if force:
+        cmd.append('-force')
+    cmd.extend(['-batch', '-'])
+
+    start = time.perf_counter()
+    p = subprocess.run(cmd, input='\n'.join(commands) + '\n', stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    # Warnings (e.g. the HTB quantum of fast classes) do not prevent tc from applying the command
+    errors = [line for line in p.stderr.splitlines() if line.strip() and not line.startswith('Warning:')]
+    if p.returncode != 0 and not errors:
+        errors.append(f"tc exited with code {p.returncode}")
+    return elapsed, errors
+
+
+def fail(message):
+    collect_agent.send_log(syslog.LOG_ERR, message)
+    print(f"ERROR: {message}")
+    sys.exit(message)
+
+
+def write_current_qdisc(qdisc):
+    try:
+        with open(QDISC_FILE, 'w') as qdisc_file:
+            qdisc_file.write(qdisc + '\n')
+    except OSError as e:
+        print(f"WARNING: could not record the qdisc in {QDISC_FILE}: {e}")
+
+
+def report(action, elapsed, commands):
+    message = f"queueManager: {action} applied in {elapsed:.3f} ms ({len(commands)} tc commands)"
+    collect_agent.send_log(syslog.LOG_INFO, message)
+    print(message)
+    collect_agent.send_stat(collect_agent.now(), reconfiguration_time=elapsed)
+
+
+def reset_queue(bond):
+    commands = [f"qdisc del dev {iface} root" for iface in get_interfaces(bond)]
+
+    elapsed, errors = run_tc_batch(commands, force=True)
+    errors = [error for error in errors if not any(benign in error for benign in ALREADY_RESET_ERRORS)]
+    if errors:
+        fail("Error resetting queues:\n" + '\n'.join(errors))
+    write_current_qdisc('default')
+    report('reset_queue', elapsed, commands)
+
+
+def build_queue_commands(queue_type, iface):
+    # 'replace' swaps the root qdisc in place: the interface is never left
+    # without a bottleneck between the removal of the old one and the new one
+    if queue_type == "HTB":
+        return [
+            f"qdisc replace dev {iface} root handle 1: htb default 1",
+            f"class replace dev {iface} parent 1: classid 1:1 htb rate 100mbit ceil 100mbit burst 15k cburst 15k",
+        ]
+    elif queue_type == "FIFO":
+        return [f"qdisc replace dev {iface} root pfifo_fast"]
+    elif queue_type == "FQ_CoDel":
+        return [f"qdisc replace dev {iface} root fq_codel"]
+    elif queue_type == "NetemQueue":
+        return [f"qdisc replace dev {iface} root netem limit 62500 delay 250ms"]
+    raise ValueError(f"Unknown queue type '{queue_type}'")
 
-    for iface in interfaces:
-        os.system(f"tc qdisc del dev {iface} root")
 
 def set_queue(queue_type, bond):
-    interfaces = ['eth3']
-    if bond:
-        interfaces.append('eth4')
+    commands = [
+        command
+        for iface in get_interfaces(bond)
+        for command in build_queue_commands(queue_type, iface)
+    ]
+
+    elapsed, errors = run_tc_batch(commands)
+    if errors:
+        fail(f"Error setting {queue_type} queues:\n" + '\n'.join(errors))
+    write_current_qdisc(queue_type)
+    report('set_queue', elapsed, commands)
+
+
+def _parse_attributes(data, offset=0):
+    attributes = {}
+    while offset + RTATTR.size <= len(data):
+        length, kind = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attributes[kind & 0x3fff] = data[offset + RTATTR.size:offset + length]
+        offset += (length + 3) & ~3
+    return attributes
+
+
+class TcStatsReader:
+    """Qdisc and class statistics read through rtnetlink, without forking tc"""
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.socket.bind((0, 0))
+        self.sequence = 0
+
+    def close(self):
+        self.socket.close()
+
+    def _dump(self, message_type, ifindex):
+        self.sequence += 1
+        request = TCMSG.pack(socket.AF_UNSPEC, 0, 0, ifindex, 0, 0, 0)
+        header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request), message_type, NLM_F_REQUEST | NLM_F_DUMP, self.sequence, 0)
+        self.socket.send(header + request)
+
+        while True:
+            data = self.socket.recv(65536)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, kind, _, sequence, _ = NLMSG_HEADER.unpack_from(data, offset)
+                if length < NLMSG_HEADER.size:
+                    return
+                payload = data[offset + NLMSG_HEADER.size:offset + length]
+                offset += (length + 3) & ~3
+                if sequence != self.sequence:
+                    continue
+                if kind == NLMSG_DONE:
+                    return
+                if kind == NLMSG_ERROR:
+                    error = -struct.unpack_from('i', payload)[0]
+                    if error:
+                        raise OSError(error, f"rtnetlink dump failed: {errno.errorcode.get(error, error)}")
+                    return
+                yield payload
+
+    def read(self, message_type, ifindex):
+        """Statistics of the qdiscs or classes of an interface, keyed by (kind, handle)"""
+        statistics = {}
+        for payload in self._dump(message_type, ifindex):
+            _, _, _, index, handle, parent, _ = TCMSG.unpack_from(payload)
+            if index != ifindex:
+                continue  # qdisc dumps are not filtered by the kernel
+            attributes = _parse_attributes(payload, TCMSG.size)
+            kind = attributes.get(TCA_KIND, b'').rstrip(b'\0').decode()
+            stats = _parse_attributes(attributes.get(TCA_STATS2, b''))
+            sent_bytes, sent_packets = GNET_STATS_BASIC.unpack_from(stats[TCA_STATS_BASIC]) if TCA_STATS_BASIC in stats else (0, 0)
+            qlen, backlog, drops, requeues, overlimits = GNET_STATS_QUEUE.unpack_from(stats[TCA_STATS_QUEUE]) if TCA_STATS_QUEUE in stats else (0,) * 5
+            statistics[(kind, f"{handle >> 16:x}-{handle & 0xffff:x}")] = {
+                'backlog_bytes': backlog,
+                'backlog_packets': qlen,
+                'drops': drops,
+                'overlimits': overlimits,
+                'requeues': requeues,
+                'sent_bytes': sent_bytes,
+                'sent_packets': sent_packets,
+            }
+        return statistics
+
+
+def monitor(bond, interval, duration):
+    """Stream the qdisc and class statistics of the interfaces every *interval* ms"""
+    interfaces = {iface: socket.if_nametoindex(iface) for iface in get_interfaces(bond)}
+    reader = TcStatsReader()
+    period = interval / 1000
+    start = time.monotonic()
+    tick = 0
+    busy = 0
+    last_overhead_report = start
+    print(f"queueManager: monitoring {', '.join(interfaces)} every {interval} ms")
+
+    try:
+        while not duration or time.monotonic() - start < duration:
+            sample_start = time.monotonic()
+            timestamp = collect_agent.now()
+            for iface, ifindex in interfaces.items():
+                for prefix, message_type in (('qdisc', RTM_GETQDISC), ('class', RTM_GETTCLASS)):
+                    for (kind, handle), stats in reader.read(message_type, ifindex).items():
+                        collect_agent.send_stat(
+                            timestamp, suffix=f"{iface}_{kind}_{handle}",
+                            **{f"{prefix}_{name}": value for name, value in stats.items()})
+
+            now = time.monotonic()
+            busy += now - sample_start
+            if now - last_overhead_report >= OVERHEAD_REPORT_INTERVAL:
+                collect_agent.send_stat(collect_agent.now(), monitor_overhead_percent=100 * busy / (now - last_overhead_report))
+                busy = 0
+                last_overhead_report = now
+
+            # Ticks are computed from the start time so that delays never accumulate;
+            # ticks that could not be honoured in time are skipped
+            tick = max(tick + 1, int((now - start) / period) + 1)
+            time.sleep(max(start + tick * period - time.monotonic(), 0))
+    except OSError as e:
+        fail(f"Error reading queue statistics: {e}")
+    finally:
+        reader.close()
+
+
+def load_schedule(trace_file):
+    """Steps of a link emulation trace, sorted by time
+
+    Each line is 'time_s,rate_mbit,delay_ms,jitter_ms,loss_percent'; empty
+    lines, '#' comments and a non numeric header line are ignored. A rate of
+    0 means that the rate is not limited.
+    """
+    steps = []
+    with open(trace_file) as trace:
+        for number, line in enumerate(trace, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            try:
+                values = [float(field) if field else 0.0 for field in fields]
+            except ValueError:
+                if not steps and number == 1:
+                    continue  # header
+                raise ValueError(f"{trace_file}:{number}: invalid values '{line}'")
+            if len(values) != len(ScheduleStep._fields) or any(value < 0 for value in values):
+                raise ValueError(f"{trace_file}:{number}: expected 5 positive values, got '{line}'")
+            step = ScheduleStep(*values)
+            if steps and step.time < steps[-1].time:
+                raise ValueError(f"{trace_file}:{number}: time goes backwards")
+            steps.append(step)
+
+    if not steps:
+        raise ValueError(f"{trace_file}: empty schedule")
+    return steps
+
+
+def build_netem_command(verb, iface, step, limit):
+    """tc batch line applying *step* to the netem root qdisc of *iface*
+
+    netem keeps its previous rate when a change does not give one, so the
+    rate is always given: 0 removes the limit of an earlier step.
+    """
+    command = f"qdisc {verb} dev {iface} root netem limit {limit} delay {step.delay}ms"
+    if step.jitter:
+        command += f" {step.jitter}ms"
+    command += f" loss {step.loss}%"
+    command += f" rate {step.rate}mbit" if step.rate else " rate 0bit"
+    return command
+
+
+def sleep_until(deadline):
+    """Sleep until the monotonic *deadline*, spinning for the last ms for accuracy"""
+    remaining = deadline - time.monotonic()
+    if remaining > SPIN_MARGIN:
+        time.sleep(remaining - SPIN_MARGIN)
+    while time.monotonic() < deadline:
+        pass
+
+
+def schedule(trace_file, bond, limit):
+    """Apply a time-varying netem configuration following *trace_file*
+
+    The first step replaces the root qdisc by netem, the next ones change it
+    in place so that queued packets are kept. Step deadlines are computed
+    from the start time, so lateness never accumulates; if several steps are
+    already due, only the most recent one is applied.
+    """
+    try:
+        steps = load_schedule(trace_file)
+    except (OSError, ValueError) as e:
+        fail(f"Error loading the schedule: {e}")
+
+    interfaces = get_interfaces(bond)
+    print(f"queueManager: applying {len(steps)} steps of {trace_file} on {', '.join(interfaces)}")
+    start = time.monotonic()
+    index = 0
+    verb = 'replace'
+    while index < len(steps):
+        sleep_until(start + steps[index].time)
+        # Skip the steps whose successor is already due
+        elapsed = time.monotonic() - start
+        while index + 1 < len(steps) and steps[index + 1].time <= elapsed:
+            index += 1
+        step = steps[index]
+
+        lateness = (time.monotonic() - start - step.time) * 1000
+        commands = [build_netem_command(verb, iface, step, limit) for iface in interfaces]
+        apply_time, errors = run_tc_batch(commands)
+        if errors:
+            fail(f"Error applying step {index} of the schedule:\n" + '\n'.join(errors))
+        if verb == 'replace':
+            write_current_qdisc('NetemSchedule')
+        collect_agent.send_stat(
+            collect_agent.now(),
+            schedule_step=index,
+            schedule_rate=step.rate,
+            schedule_delay=step.delay,
+            schedule_jitter=step.jitter,
+            schedule_loss=step.loss,
+            schedule_lateness=lateness,
+            schedule_apply_time=apply_time)
+        verb = 'change'
+        index += 1
 
-    for iface in interfaces:
-        if queue_type == "HTB":
-            os.system(f"tc qdisc add dev {iface} handle 1: root htb")
-            os.system(f"tc class add dev {iface} classid 1:1 root htb rate 100mbit ceil 100mbit burst 15k cburst 15k")
-            os.system(f"tc filter add dev {iface} pref 0 protocol ip u32 match ip dst 0.0.0.0/0 classid 1:1")
-        elif queue_type == "FIFO":
-            os.system(f"tc qdisc add dev {iface} root pfifo_fast")
-        elif queue_type == "FQ_CoDel":
-            os.system(f"tc qdisc add dev {iface} root fq_codel")
-        elif queue_type == "NetemQueue":
-            os.system(f"tc qdisc add dev {iface} root netem limit 62500 delay 250ms")
 
 if __name__ == "__main__":
     main()
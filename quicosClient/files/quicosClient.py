@@ -36,15 +36,19 @@ __credits__ = '''Contributors:
 
 import os
 import time
+import math
 import json
 import threading
 import sys
 import string
 import random
 import shlex
+import socket
+import sqlite3
 import syslog
 import argparse
 import tempfile
+import statistics
 import subprocess
 from enum import Enum
 from ipaddress import ip_address
@@ -73,6 +77,52 @@ KEY = "/etc/ssl/private/quicosClient.openbach.com.pem"
 HTDOCS = "/var/www/quicosClient.openbach.com/"
 DOWNLOAD_DIR = tempfile.mkdtemp(prefix='openbach_job_quicosClient-')
 LOG_DIR = tempfile.mkdtemp(dir=DOWNLOAD_DIR, prefix='logs-')
+TELEMETRY_INTERVAL = 5
+SKETCH_METRICS = ('smoothed_rtt', 'latest_rtt', 'congestion_window')
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_WRITE_INTERVAL = 30  # s
+RESULTS_DB = 'results.sqlite'
+RESULTS_DB_TIMEOUT = 10  # s waiting for the lock held by another job
+QDISC_FILE = "/opt/openbach/scripts/curr_queue.conf"
+ACCOUNTING_INTERVAL = 1  # s between two /proc samples of the QUIC endpoint
+PRECISION_METRICS = ('throughput', 'download_time')
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_MIN_RUNS = 3  # below, the sample variance is too unreliable to stop on
+RESULTS_SCHEMA = '''
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    experiment_id TEXT,
+    run_number INTEGER,
+    job TEXT NOT NULL,
+    role TEXT NOT NULL,
+    host TEXT,
+    congestion_control TEXT,
+    qdisc TEXT,
+    resource TEXT,
+    resource_size INTEGER,
+    log_dir TEXT,
+    started REAL NOT NULL,
+    ended REAL
+);
+CREATE INDEX IF NOT EXISTS runs_by_cc ON runs (congestion_control, qdisc, started);
+CREATE INDEX IF NOT EXISTS runs_by_qdisc ON runs (qdisc, started);
+CREATE INDEX IF NOT EXISTS runs_by_role ON runs (role, started);
+CREATE INDEX IF NOT EXISTS runs_by_experiment ON runs (experiment_id, run_number);
+CREATE TABLE IF NOT EXISTS files (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (run_id, path)
+);
+CREATE TABLE IF NOT EXISTS kpis (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, name)
+);
+CREATE INDEX IF NOT EXISTS kpis_by_name ON kpis (name, value);
+'''
 
 
 class Implementations(Enum):
@@ -106,15 +156,502 @@ def ensure_directory_exists(directory_path):
     return directory_path
     
 
+class IngestionTelemetry:
+    """Health statistics of a qlog reader, shipped next to the QUIC metrics"""
+
+    def __init__(self, collect_agent, interval=TELEMETRY_INTERVAL, suffix=None):
+        self.collect_agent = collect_agent
+        self.interval = interval
+        self.suffix = suffix
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self._reset(time.monotonic(), time.process_time())
+
+    def _reset(self, now, cpu_time):
+        self.lines = 0
+        self.stats = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+        self.last_report = now
+        self.last_cpu_time = cpu_time
+
+    def line_parsed(self):
+        self.lines += 1
+
+    def stat_shipped(self, event_timestamp):
+        latency = self.collect_agent.now() - event_timestamp
+        self.stats += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def _rss(self):
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * self.page_size
+
+    def maybe_report(self, file):
+        """Ship the reader statistics once every *interval* seconds"""
+        now = time.monotonic()
+        elapsed = now - self.last_report
+        if elapsed < self.interval:
+            return
+
+        cpu_time = time.process_time()
+        statistics = {
+            'ingest_lines_per_s': self.lines / elapsed,
+            'ingest_stats_per_s': self.stats / elapsed,
+            'ingest_backlog_bytes': max(os.fstat(file.fileno()).st_size - file.tell(), 0),
+            'ingest_rss_bytes': self._rss(),
+            'ingest_cpu_percent': 100 * (cpu_time - self.last_cpu_time) / elapsed,
+        }
+        if self.stats:
+            statistics['ingest_latency_mean_ms'] = self.latency_sum / self.stats
+            statistics['ingest_latency_max_ms'] = self.latency_max
+
+        try:
+            self.collect_agent.send_stat(self.collect_agent.now(), suffix=self.suffix, **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio delle statistiche di ingestione: {e}")
+        self._reset(now, cpu_time)
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch of relative accuracy *alpha* (DDSketch-like)
+
+    Values are counted in logarithmic bins of ratio (1 + alpha) / (1 - alpha),
+    so that the quantiles of any merge of sketches (bins added together, as
+    KPIMetrics does) are within a relative error alpha of the exact ones.
+    Adding a value is O(1); a sketch of RTTs or windows is a few hundred bins.
+    """
+
+    def __init__(self, alpha=SKETCH_RELATIVE_ACCURACY):
+        self.alpha = alpha
+        self.log_gamma = math.log((1 + alpha) / (1 - alpha))
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add(self, value):
+        if value > 0:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def to_dict(self):
+        return {
+            'alpha': self.alpha,
+            'count': self.count,
+            'zero_count': self.zero_count,
+            'min': self.minimum if self.count else None,
+            'max': self.maximum if self.count else None,
+            'bins': {str(index): count for index, count in self.bins.items()},
+        }
+
+
+class FlowSketches:
+    """Quantile sketches of SKETCH_METRICS for one flow
+
+    They are written to *path* (atomically, as JSON) every *interval*
+    seconds while the flow is active and when the flow ends.
+    """
+
+    def __init__(self, path, flow=None, interval=SKETCH_WRITE_INTERVAL):
+        self.path = path
+        self.flow = flow
+        self.interval = interval
+        self.sketches = {metric: QuantileSketch() for metric in SKETCH_METRICS}
+        self.last_write = time.monotonic()
+        self.dirty = False
+
+    def add(self, statistics):
+        for metric, sketch in self.sketches.items():
+            value = statistics.get(metric)
+            if value is not None:
+                sketch.add(value)
+        self.dirty = True
+        if time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        self.last_write = time.monotonic()
+        if not self.dirty:
+            return
+        content = {
+            'host': socket.gethostname(),
+            'flow': self.flow,
+            'metrics': {metric: sketch.to_dict() for metric, sketch in self.sketches.items()},
+        }
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'w') as sketch_file:
+                json.dump(content, sketch_file)
+            os.replace(temporary, self.path)
+            self.dirty = False
+        except OSError as e:
+            print(f"Errore durante la scrittura degli sketch in {self.path}: {e}")
+
+
+def read_current_qdisc():
+    """Qdisc of the bottleneck last set by queueManager on this host, if any"""
+    try:
+        with open(QDISC_FILE) as qdisc:
+            return qdisc.readline().strip() or None
+    except OSError:
+        return None
+
+
+class ResultsStore:
+    """Index of the runs of the quicos jobs, in a SQLite database next to their log folders
+
+    A run is registered with its experiment, congestion control, qdisc and
+    resource; its files and KPIs are attached to it as they come, so that
+    KPIMetrics and the queries on past runs never scan the log folders. A
+    connection is opened per operation since the qlog readers write from
+    their own processes, and errors are only printed: the index never stops
+    a job.
+    """
+
+    def __init__(self, log_dir):
+        self.path = os.path.join(log_dir, RESULTS_DB)
+        self.run_id = None
+        self._execute(RESULTS_SCHEMA, script=True)
+
+    def _execute(self, statement, parameters=(), script=False, many=False):
+        try:
+            db = sqlite3.connect(self.path, timeout=RESULTS_DB_TIMEOUT)
+            try:
+                with db:
+                    if script:
+                        db.executescript(statement)
+                    elif many:
+                        db.executemany(statement, parameters)
+                    else:
+                        return db.execute(statement, parameters).lastrowid
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            print(f"Errore del database dei risultati {self.path}: {e}")
+
+    def register_run(self, job, role, **fields):
+        fields.update(job=job, role=role, host=socket.gethostname(), started=time.time())
+        self.run_id = self._execute(
+                f"INSERT INTO runs ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                tuple(fields.values()))
+        return self.run_id
+
+    def update_run(self, **fields):
+        if self.run_id is None or not fields:
+            return
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        self._execute(f"UPDATE runs SET {assignments} WHERE id = ?", (*fields.values(), self.run_id))
+
+    def finish_run(self, **fields):
+        self.update_run(ended=time.time(), **fields)
+
+    def add_file(self, path, kind):
+        if self.run_id is not None:
+            self._execute("INSERT OR IGNORE INTO files (run_id, path, kind) VALUES (?, ?, ?)", (self.run_id, path, kind))
+
+    def add_kpis(self, **kpis):
+        if self.run_id is not None:
+            self._execute(
+                    "INSERT OR REPLACE INTO kpis (run_id, name, value) VALUES (?, ?, ?)",
+                    [(self.run_id, name, value) for name, value in kpis.items()], many=True)
+
+
+def student_t_cdf(t, df):
+    """P(T <= t) for the Student t distribution with integer *df* degrees of freedom
+
+    Closed-form finite series of Abramowitz & Stegun 26.7.3 (odd *df*) and
+    26.7.4 (even *df*), exact up to floating point rounding.
+    """
+    theta = math.atan(t / math.sqrt(df))
+    sin, cos = math.sin(theta), math.cos(theta)
+    if df % 2:
+        term = total = cos if df > 1 else 0.0
+        for k in range(1, (df - 1) // 2):
+            term *= cos * cos * (2 * k) / (2 * k + 1)
+            total += term
+        a = 2 / math.pi * (theta + sin * total)
+    else:
+        term = total = 1.0
+        for k in range(1, df // 2):
+            term *= cos * cos * (2 * k - 1) / (2 * k)
+            total += term
+        a = sin * total
+    return (1 + a) / 2
+
+
+def student_t_quantile(p, df):
+    """Quantile *p* of the Student t distribution with *df* degrees of freedom
+
+    Bisection on the exact cdf of :func:`student_t_cdf`, down to 1e-9.
+    """
+    if p < 0.5:
+        return -student_t_quantile(1 - p, df)
+    low, high = 0.0, 1.0
+    while student_t_cdf(high, df) < p:
+        low, high = high, high * 2
+    while high - low > 1e-9:
+        middle = (low + high) / 2
+        if student_t_cdf(middle, df) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def confidence_interval(values, confidence=DEFAULT_CONFIDENCE):
+    """Mean of *values* and half-width of its two-sided Student t confidence interval"""
+    mean = statistics.fmean(values)
+    if len(values) < 2:
+        return mean, math.inf
+    half_width = student_t_quantile((1 + confidence) / 2, len(values) - 1) * statistics.stdev(values) / math.sqrt(len(values))
+    return mean, half_width
+
+
+class SequentialStop:
+    """Stopping rule of the repeated runs on the precision of the mean of a metric
+
+    Runs go on until the confidence interval of the mean is narrower than
+    *target* times the mean (half-width over mean), after at least *min_runs*
+    runs; the caller stops anyway at its maximum number of runs.
+    """
 
+    def __init__(self, metric, target, confidence=DEFAULT_CONFIDENCE, min_runs=DEFAULT_MIN_RUNS):
+        self.metric = metric
+        self.target = target
+        self.confidence = confidence
+        self.min_runs = max(min_runs, 2)
+        self.values = []
+        self.relative = math.inf
+
+    def add(self, value):
+        """Account for a run; return the statistics of the running mean"""
+        self.values.append(value)
+        mean, half_width = confidence_interval(self.values, self.confidence)
+        relative = half_width / abs(mean) if mean else math.inf
+        running = {f'{self.metric}_mean': mean, 'runs_used': len(self.values)}
+        if math.isfinite(relative):
+            running[f'{self.metric}_ci'] = half_width
+            running[f'{self.metric}_ci_relative'] = relative
+        self.relative = relative
+        return running
+
+    def done(self):
+        return len(self.values) >= self.min_runs and self.relative <= self.target
+
+
+def cpu_frequency():
+    """Nominal CPU frequency (Hz) converting CPU time into cycles, None if unknown"""
+    try:
+        with open('/sys/devices/system/cpu/cpu0/cpufreq/base_frequency') as frequency:
+            return int(frequency.read()) * 1000
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('cpu MHz'):
+                    return float(line.split(':')[1]) * 1e6
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class EndpointAccounting:
+    """Resource usage of the QUIC endpoint process and its descendants
+
+    While the endpoint runs, /proc is sampled every *interval* seconds and the
+    CPU time (user and system), RSS, context switches and read/write syscalls
+    of its process tree are shipped as endpoint_* rates. When it exits, its
+    exact totals are taken from wait4() and shipped with the cost per
+    delivered byte.
+    """
 
+    def __init__(self, collect_agent, interval=ACCOUNTING_INTERVAL, suffix=None):
+        self.collect_agent = collect_agent
+        self.interval = interval
+        self.suffix = suffix
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.children_files = os.path.exists(f'/proc/self/task/{os.getpid()}/children')
+        self.stopped = threading.Event()
+        self.samples = {}  # last counters of each live process of the tree
+        self.exited = [0.0, 0.0, 0, 0, 0]  # counters of the processes gone since
+        self.sampling_time = 0
+        self.thread = None
+
+    def start(self, pid):
+        self.pid = pid
+        self.started = time.monotonic()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _tree(self):
+        if self.children_files:
+            pids, pending = [], [self.pid]
+            while pending:
+                pid = pending.pop()
+                pids.append(pid)
+                try:
+                    for task in os.listdir(f'/proc/{pid}/task'):
+                        with open(f'/proc/{pid}/task/{task}/children') as children:
+                            pending.extend(int(child) for child in children.read().split())
+                except OSError:
+                    pass
+            return pids
+
+        # Kernels without CONFIG_PROC_CHILDREN: parents of every process
+        children = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open(f'/proc/{name}/stat') as stat:
+                        parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+                except (OSError, ValueError, IndexError):
+                    continue
+                children.setdefault(parent, []).append(int(name))
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, ()))
+        return pids
+
+    def _read(self, pid):
+        """user (s), system (s), voluntary and involuntary switches, syscalls, rss (bytes)"""
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        # Fields 14, 15 and 24 of proc(5), counted from the state (field 3)
+        counters = [int(fields[11]) / self.ticks, int(fields[12]) / self.ticks, 0, 0, None]
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('voluntary_ctxt_switches'):
+                    counters[2] = int(line.split()[1])
+                elif line.startswith('nonvoluntary_ctxt_switches'):
+                    counters[3] = int(line.split()[1])
+        try:
+            with open(f'/proc/{pid}/io') as io:
+                counters[4] = sum(int(line.split()[1]) for line in io if line.startswith(('syscr', 'syscw')))
+        except OSError:
+            pass  # no task I/O accounting
+        return counters, int(fields[21]) * self.page_size
+
+    def sample(self):
+        """Cumulative counters of the tree (as in _read) and its current RSS"""
+        samples, rss = {}, 0
+        for pid in self._tree():
+            try:
+                samples[pid], process_rss = self._read(pid)
+            except (OSError, ValueError, IndexError):
+                continue  # exited meanwhile
+            rss += process_rss
+        for pid, counters in self.samples.items():
+            if pid not in samples:
+                for index, value in enumerate(counters):
+                    self.exited[index] += value or 0
+        self.samples = samples
+
+        totals = list(self.exited)
+        syscalls_available = False
+        for counters in samples.values():
+            for index, value in enumerate(counters):
+                totals[index] += value or 0
+            syscalls_available = syscalls_available or counters[4] is not None
+        if not syscalls_available and not self.exited[4]:
+            totals[4] = None
+        return totals, rss
+
+    def _run(self):
+        last, last_time = None, time.monotonic()
+        while not self.stopped.wait(self.interval):
+            begin = time.thread_time()
+            totals, rss = self.sample()
+            now = time.monotonic()
+            elapsed, last_time = now - last_time, now
+            if last is not None and elapsed > 0:
+                statistics = {
+                    'endpoint_cpu_user_percent': 100 * (totals[0] - last[0]) / elapsed,
+                    'endpoint_cpu_system_percent': 100 * (totals[1] - last[1]) / elapsed,
+                    'endpoint_rss_bytes': rss,
+                    'endpoint_voluntary_ctxt_switches_per_s': (totals[2] - last[2]) / elapsed,
+                    'endpoint_involuntary_ctxt_switches_per_s': (totals[3] - last[3]) / elapsed,
+                }
+                if totals[4] is not None and last[4] is not None:
+                    statistics['endpoint_syscalls_per_s'] = (totals[4] - last[4]) / elapsed
+                try:
+                    self.collect_agent.send_stat(self.collect_agent.now(), suffix=self.suffix, **statistics)
+                except Exception as e:
+                    print(f"Errore durante l'invio delle statistiche dell'endpoint: {e}")
+            last = totals
+            self.sampling_time += time.thread_time() - begin
+
+    def finish(self, process, delivered_bytes=None):
+        """Stop sampling, reap the endpoint *process* and ship the totals of its run
+
+        Return the shipped statistics, for the results index.
+        """
+        if self.thread is None:
+            return {}
+        self.stopped.set()
+        self.thread.join()
+        totals, _ = self.sample()
+        elapsed = time.monotonic() - self.started
+        statistics = {
+            'endpoint_cpu_user_s': totals[0],
+            'endpoint_cpu_system_s': totals[1],
+            'endpoint_voluntary_ctxt_switches': totals[2],
+            'endpoint_involuntary_ctxt_switches': totals[3],
+        }
+        try:
+            # Exact figures, including the CPU time since the last sample
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            statistics.update({
+                'endpoint_cpu_user_s': usage.ru_utime,
+                'endpoint_cpu_system_s': usage.ru_stime,
+                'endpoint_max_rss_bytes': usage.ru_maxrss * 1024,
+                'endpoint_voluntary_ctxt_switches': usage.ru_nvcsw,
+                'endpoint_involuntary_ctxt_switches': usage.ru_nivcsw,
+            })
+        except ChildProcessError:
+            pass  # already reaped: the sampled totals are what is left
+        if totals[4] is not None:
+            statistics['endpoint_syscalls'] = totals[4]
+        if elapsed > 0:
+            statistics['endpoint_sampling_overhead_percent'] = 100 * self.sampling_time / elapsed
+
+        if delivered_bytes:
+            cpu_time = statistics['endpoint_cpu_user_s'] + statistics['endpoint_cpu_system_s']
+            statistics['endpoint_delivered_bytes'] = delivered_bytes
+            statistics['endpoint_cpu_ns_per_byte'] = cpu_time * 1e9 / delivered_bytes
+            frequency = cpu_frequency()
+            if frequency:
+                statistics['endpoint_cpu_cycles_per_byte'] = cpu_time * frequency / delivered_bytes
+            if statistics.get('endpoint_syscalls'):
+                statistics['endpoint_bytes_per_syscall'] = delivered_bytes / statistics['endpoint_syscalls']
 
-def run_command(cmd, cwd=None):
+        try:
+            self.collect_agent.send_stat(self.collect_agent.now(), suffix=self.suffix, **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio delle statistiche dell'endpoint: {e}")
+        print(f"Endpoint resources: {statistics}")
+        return statistics
+
+
+def run_command(cmd, cwd=None, accounting=None):
     "Run cmd and wait for command to complete then return a CompletedProcessess instance"
     try:
         #p = subprocess.run(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd, check=False) #.Popen shell=True
 
         p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE)
+        if accounting is not None:
+            accounting.start(p.pid)
         grep = subprocess.Popen(["grep", "python"], stdin=p.stdout, stdout=subprocess.PIPE)
         for line in grep.stdout:
             print(line.decode("utf-8").strip())
@@ -179,15 +716,20 @@ def tail_file(file_path):
     timeout = 3
 
     with open(file_path, 'r') as file:
+        telemetry = IngestionTelemetry(collect_agent)
+        # One sketch file per run: the qlog file of the client is reused by every run
+        sketches = FlowSketches(os.path.join(os.path.dirname(file_path), f"sketch_client_{collect_agent.now()}.json"))
         while True:
             line = file.readline()
+            telemetry.maybe_report(file)
             if line:
+                telemetry.line_parsed()
                 cleaned_line = line.strip()
                 if cleaned_line:
                     try:
                         data = json.loads(cleaned_line)
                         if data.get("name") == "recovery:metrics_updated":
-                            process_statistics(data)
+                            process_statistics(data, sketches)
 
                     except json.JSONDecodeError:
                         pass
@@ -195,9 +737,10 @@ def tail_file(file_path):
             else:
                 if time.time() - last_update_time > timeout:
                     break
+        sketches.write()
 
 
-def process_statistics(data):
+def process_statistics(data, sketches=None):
     timestamp = data.get("time")
     stats = data.get("data", {})
     statistics = {
@@ -209,6 +752,8 @@ def process_statistics(data):
         'congestion_window': stats.get('congestion_window'),
         'bytes_in_flight': stats.get('bytes_in_flight'),
     }
+    if sketches is not None:
+        sketches.add(statistics)
     #print(statistics)
     #collect_agent.send_stat(collect_agent.now(), **statistics)
     
@@ -233,12 +778,20 @@ def manage_log_client_directory(base_dir):
     return log_file_path
     
     
-def client(implementation, server_port, log_dir, extra_args, server_ip, resources, download_dir, nb_runs):
+def client(implementation, server_port, log_dir, extra_args, server_ip, resources, download_dir, nb_runs, experiment_id, qdisc,
+           target_precision, precision_metric, confidence, min_runs):
     """
     Avvia il client utilizzando un experiment_id per i log.
+
+    Con target_precision, nb_runs è il numero massimo di esecuzioni: il client
+    si ferma prima appena l'intervallo di confidenza della media di
+    precision_metric è entro target_precision volte la media.
     """
     ensure_directory_exists(download_dir)
     errors = []
+    experiment_id = experiment_id or datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    qdisc = qdisc or read_current_qdisc()
+    stop = target_precision and SequentialStop(precision_metric, target_precision, confidence, min_runs)
     for run_number in range(nb_runs):
         # Usa experiment_id per creare la directory di log
         log_file_path = manage_log_client_directory(log_dir)
@@ -256,11 +809,18 @@ def client(implementation, server_port, log_dir, extra_args, server_ip, resource
             )
             remove_resources(resources, download_dir)
 
+            results = ResultsStore(log_dir)
+            results.register_run(
+                    'quicosClient', 'client', experiment_id=experiment_id, run_number=run_number + 1,
+                    qdisc=qdisc, resource=resources, log_dir=log_dir)
+            results.add_file(log_file_path, 'qlog')
+
             tail_thread = threading.Thread(target=tail_file, args=(log_file_path,))
             tail_thread.start()
 
+            accounting = EndpointAccounting(collect_agent)
             start_time = collect_agent.now()
-            p = run_command(cmd, cwd=download_dir)
+            p = run_command(cmd, cwd=download_dir, accounting=accounting)
             end_time = collect_agent.now()
             
             file_path = os.path.join(download_dir, resources)
@@ -268,9 +828,26 @@ def client(implementation, server_port, log_dir, extra_args, server_ip, resource
             
             time_taken = (end_time - start_time) / 1000
             
-            throughput = round((file_size * 8 / time_taken) / 1_000_000, 2) if time_taken > 0 else 0
+            goodput = (file_size * 8 / time_taken) / 1_000_000 if time_taken > 0 else 0
+            throughput = round(goodput, 2)
             
             collect_agent.send_stat(collect_agent.now(), throughput=throughput)
+            costs = accounting.finish(p, file_size)
+            results.finish_run(resource_size=file_size)
+            results.add_kpis(throughput=throughput, download_time=time_taken, **costs)
+
+        if stop:
+            running = stop.add({'throughput': goodput, 'download_time': time_taken}[precision_metric])
+            collect_agent.send_stat(collect_agent.now(), **running)
+            print(f"Run {run_number + 1}: {running}")
+            if stop.done():
+                message = f"quicosClient: {precision_metric} mean within {target_precision:.1%} after {run_number + 1} runs"
+                collect_agent.send_log(syslog.LOG_INFO, message)
+                print(message)
+                break
+    else:
+        if stop:
+            collect_agent.send_log(syslog.LOG_WARNING, f"quicosClient: {precision_metric} mean not within {target_precision:.1%} after {nb_runs} runs")
 
     if errors:
         message = '\n'.join('Error on run #{}: {}'.format(run, error) for run, error in errors)
@@ -351,8 +928,34 @@ if __name__ == "__main__":
 	)
         parser.add_argument(
 	    '-n', '--nb-runs', type=int, default=1,
-	    help='The number of times resources will be downloaded'
+	    help='The number of times resources will be downloaded (maximum number with --target-precision)'
 	)
+        parser.add_argument(
+            '--target-precision', type=float, default=None,
+            help='Stop repeating the downloads once the confidence interval half-width of the mean of '
+                 '--precision-metric is within this fraction of the mean (e.g. 0.05)'
+        )
+        parser.add_argument(
+            '--precision-metric', choices=PRECISION_METRICS, default=PRECISION_METRICS[0],
+            help='Metric whose mean must reach --target-precision'
+        )
+        parser.add_argument(
+            '--confidence', type=float, default=DEFAULT_CONFIDENCE,
+            help='Confidence level of the interval of --target-precision'
+        )
+        parser.add_argument(
+            '--min-runs', type=int, default=DEFAULT_MIN_RUNS,
+            help='Minimum number of downloads before stopping on --target-precision'
+        )
+
+        parser.add_argument(
+            '--experiment-id', type=str, default=None,
+            help='Experiment of the run in the results database of the log directory (default: start time of the job)'
+        )
+        parser.add_argument(
+            '--qdisc', type=str, default=None,
+            help=f'Bottleneck qdisc recorded with the run (default: the one last set by queueManager in {QDISC_FILE})'
+        )
 
         parser.set_defaults(function=client)
 
@@ -36,17 +36,27 @@ __credits__ = '''Contributors:
 
 import os
 import time
+import math
+import errno
+import abc
 import json
 import threading
 import sys
 import string
 import random
+import heapq
 import shlex
+import socket
+import sqlite3
+import zlib
+import signal
 import syslog
 import argparse
 import tempfile
+import tracemalloc
 import subprocess
 from enum import Enum
+from collections import Counter, OrderedDict, deque
 from ipaddress import ip_address
 from watchdog.events import FileSystemEventHandler
 from datetime import datetime, timedelta
@@ -73,6 +83,87 @@ KEY = "/etc/ssl/private/quicosWAVE.openbach.com.pem"
 HTDOCS = "/var/www/quicosWAVE.openbach.com/"
 DOWNLOAD_DIR = tempfile.mkdtemp(prefix='openbach_job_quicosWAVE-')
 LOG_DIR = tempfile.mkdtemp(dir=DOWNLOAD_DIR, prefix='logs-')
+TELEMETRY_INTERVAL = 5
+PROFILE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_TOP = 50
+IDLE_TIMEOUT = 30
+CLOSED_FILES_HISTORY = 4096
+READER_IDLE_EXIT = 3  # exit code of a reader stopped by the idle timeout, resumed on the next write
+CONNECTION_CLOSED_EVENTS = {'connectivity:connection_closed'}
+CONNECTION_STARTED_EVENTS = {'connectivity:connection_started', 'transport:connection_started'}
+FLOW_INDEX_FILE = 'flow_index.jsonl'
+ARCHIVE_CHUNK = 1024 * 1024
+ARCHIVE_REPORT_INTERVAL = 5  # s
+STAT_SINKS = ('collect_agent', 'file', 'udp')
+SINK_BATCH_SIZE = 1000
+SINK_FLUSH_INTERVAL = 1  # s
+SINK_FILE = 'statistics.lp'
+SINK_ADDRESS = '127.0.0.1:8089'
+UDP_DATAGRAM_SIZE = 8192
+RING_BUFFER_SIZE = 100000
+ROLLUP_WINDOWS = (1, 10)  # s
+ROLLUP_IDLE_FLUSH = 10  # s without new qlog lines before shipping the windows in progress
+PACKET_EVENTS = {'transport:packet_sent', 'transport:packet_received', 'recovery:packet_lost', 'recovery:packets_acked', 'transport:packets_acked'}
+PACKET_STATS_INTERVAL = 1  # s
+SPURIOUS_HISTORY = 4096
+ACK_RANGE_HISTORY = 256  # ACK ranges already searched for spurious losses
+SKETCH_METRICS = ('smoothed_rtt', 'latest_rtt', 'congestion_window')
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_WRITE_INTERVAL = 30  # s
+RESULTS_DB = 'results.sqlite'
+RESULTS_DB_TIMEOUT = 10  # s waiting for the lock held by another job
+QDISC_FILE = "/opt/openbach/scripts/curr_queue.conf"
+ACCOUNTING_INTERVAL = 1  # s between two /proc samples of the QUIC endpoint
+READER_DRAIN_TIMEOUT = 10  # s waited for the qlog readers to catch up once the endpoint exits
+RESULTS_SCHEMA = '''
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    experiment_id TEXT,
+    run_number INTEGER,
+    job TEXT NOT NULL,
+    role TEXT NOT NULL,
+    host TEXT,
+    congestion_control TEXT,
+    qdisc TEXT,
+    resource TEXT,
+    resource_size INTEGER,
+    log_dir TEXT,
+    started REAL NOT NULL,
+    ended REAL
+);
+CREATE INDEX IF NOT EXISTS runs_by_cc ON runs (congestion_control, qdisc, started);
+CREATE INDEX IF NOT EXISTS runs_by_qdisc ON runs (qdisc, started);
+CREATE INDEX IF NOT EXISTS runs_by_role ON runs (role, started);
+CREATE INDEX IF NOT EXISTS runs_by_experiment ON runs (experiment_id, run_number);
+CREATE TABLE IF NOT EXISTS files (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (run_id, path)
+);
+CREATE TABLE IF NOT EXISTS kpis (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, name)
+);
+CREATE INDEX IF NOT EXISTS kpis_by_name ON kpis (name, value);
+'''
+ANOMALY_EWMA_ALPHA = 0.05
+ANOMALY_Z_THRESHOLD = 4
+ANOMALY_RTT_MARGIN = 0.1  # relative excess of an RTT spike over the mean, against the jitter of short RTTs
+ANOMALY_WARMUP = 20  # RTT samples before the z-score is trusted
+ANOMALY_CWND_DROP = 0.5  # relative drop of the congestion window between two points
+ANOMALY_HOLD = 2  # s of full resolution after the last detection
+ANOMALY_EVENTS = {'event_rtt_zscore': 'rtt_spike', 'event_pto_increment': 'pto', 'event_cwnd_drop': 'cwnd_drop'}
+DOWNSAMPLE_INTERVAL = 0  # s between two points outside anomalies (0: every point)
+QLOG_SAMPLE_EVERY = 1  # qlog read in full for one connection in QLOG_SAMPLE_EVERY
+QLOG_SAMPLE_FIRST = 0  # only the first connections are read in full (0: no limit)
+QLOG_SAMPLE_FRACTION = 1.0
+SUMMARY_TAIL_BYTES = 64 * 1024  # read at the end of the qlog of an unsampled connection
+SUMMARY_METRICS = ('min_rtt', 'smoothed_rtt', 'latest_rtt', 'congestion_window', 'pto_count')
 
 
 class Implementations(Enum):
@@ -106,56 +197,995 @@ def ensure_directory_exists(directory_path):
     return directory_path
     
 
+class IngestionTelemetry:
+    """Health statistics of a qlog reader, shipped next to the QUIC metrics"""
+
+    def __init__(self, collect_agent, interval=TELEMETRY_INTERVAL, suffix=None):
+        self.collect_agent = collect_agent
+        self.interval = interval
+        self.suffix = suffix
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self._reset(time.monotonic(), time.process_time())
+
+    def _reset(self, now, cpu_time):
+        self.lines = 0
+        self.stats = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+        self.last_report = now
+        self.last_cpu_time = cpu_time
+
+    def line_parsed(self):
+        self.lines += 1
+
+    def stat_shipped(self, event_timestamp):
+        latency = self.collect_agent.now() - event_timestamp
+        self.stats += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def _rss(self):
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * self.page_size
+
+    def maybe_report(self, file):
+        """Ship the reader statistics once every *interval* seconds"""
+        now = time.monotonic()
+        elapsed = now - self.last_report
+        if elapsed < self.interval:
+            return
+
+        cpu_time = time.process_time()
+        statistics = {
+            'ingest_lines_per_s': self.lines / elapsed,
+            'ingest_stats_per_s': self.stats / elapsed,
+            'ingest_backlog_bytes': max(os.fstat(file.fileno()).st_size - file.tell(), 0),
+            'ingest_rss_bytes': self._rss(),
+            'ingest_cpu_percent': 100 * (cpu_time - self.last_cpu_time) / elapsed,
+        }
+        if self.stats:
+            statistics['ingest_latency_mean_ms'] = self.latency_sum / self.stats
+            statistics['ingest_latency_max_ms'] = self.latency_max
+
+        try:
+            self.collect_agent.send_stat(self.collect_agent.now(), suffix=self.suffix, **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio delle statistiche di ingestione: {e}")
+        self._reset(now, cpu_time)
+
+
+class RollupAggregator:
+    """Downsampled statistics computed in-process while the qlog streams
+
+    Every statistic is summarised over tumbling windows of ROLLUP_WINDOWS
+    seconds of event time and shipped as <name>_<window>s_mean and
+    <name>_<window>s_max, timestamped with the start of the window, once the
+    window is over. Dashboards of long runs query these rollups instead of
+    the per-ACK points.
+    """
+
+    def __init__(self, collect_agent, windows=ROLLUP_WINDOWS, suffix=None):
+        self.collect_agent = collect_agent
+        self.suffix = suffix
+        self.windows = [(f'{window}s', window * 1000) for window in windows]
+        self.buckets = {label: None for label, _ in self.windows}
+        self.aggregates = {label: {} for label, _ in self.windows}
+
+    def add(self, timestamp, statistics):
+        for label, width in self.windows:
+            bucket = timestamp // width
+            current = self.buckets[label]
+            if current is None or bucket > current:
+                self._flush(label, width)
+                self.buckets[label] = bucket
+
+            aggregates = self.aggregates[label]
+            for name, value in statistics.items():
+                if value is None:
+                    continue
+                aggregate = aggregates.get(name)
+                if aggregate is None:
+                    aggregates[name] = [value, 1, value]
+                else:
+                    aggregate[0] += value
+                    aggregate[1] += 1
+                    if value > aggregate[2]:
+                        aggregate[2] = value
+
+    def _flush(self, label, width):
+        aggregates, self.aggregates[label] = self.aggregates[label], {}
+        if not aggregates:
+            return
+
+        statistics = {}
+        for name, (total, count, maximum) in aggregates.items():
+            statistics[f'{name}_{label}_mean'] = total / count
+            statistics[f'{name}_{label}_max'] = maximum
+        try:
+            self.collect_agent.send_stat(self.buckets[label] * width, suffix=self.suffix, **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio delle statistiche aggregate: {e}")
+
+    def flush(self):
+        """Ship the windows in progress (end of the connection or idle qlog)"""
+        for label, width in self.windows:
+            self._flush(label, width)
+
+
+class PacketCounters:
+    """Packet-level counters of a flow, from the transport and recovery events of its qlog
+
+    Work per event is constant (per frame for the stream and ACK frames).
+    Every *interval* seconds of qlog time the counters of the interval are
+    shipped: packets sent/received/lost, loss rate, retransmitted bytes
+    (stream bytes sent again below the highest offset already sent on their
+    stream), sent/acked ratio and spurious losses (packets declared lost
+    and acknowledged afterwards). Acked packets are counted from the ACK
+    ranges above the largest packet acknowledged so far. ACK frames repeat
+    their ranges: a range is only searched for lost packets the first time
+    it is seen. stream_bytes counts the stream bytes sent at least once over
+    the whole connection, the bytes delivered by the endpoint.
+    """
+
+    def __init__(self, collect_agent, interval=PACKET_STATS_INTERVAL, suffix=None):
+        self.collect_agent = collect_agent
+        self.interval = interval * 1000
+        self.suffix = suffix
+        self.stream_ends = {}
+        self.stream_bytes = 0
+        self.largest_acked = -1
+        self.lost_packets = OrderedDict()  # last SPURIOUS_HISTORY packets declared lost, oldest first
+        self.highest_lost = -1
+        self.searched_ranges = OrderedDict()
+        self.bucket = None
+        self.timestamp = None
+        self._reset()
+
+    def _reset(self):
+        self.sent = 0
+        self.bytes_sent = 0
+        self.received = 0
+        self.lost = 0
+        self.acked = 0
+        self.retransmitted_bytes = 0
+        self.spurious = 0
+
+    def add(self, name, data, event_time, timestamp):
+        bucket = event_time // self.interval
+        if self.bucket is None or bucket > self.bucket:
+            self.flush()
+            self.bucket = bucket
+        self.timestamp = timestamp
+
+        if name == 'transport:packet_sent':
+            self._packet_sent(data)
+        elif name == 'transport:packet_received':
+            self._packet_received(data)
+        elif name == 'recovery:packet_lost':
+            self._packet_lost(data)
+        else:
+            for packet_number in data.get('packet_numbers', ()):
+                self._acked(packet_number, packet_number)
+
+    def _packet_sent(self, data):
+        self.sent += 1
+        self.bytes_sent += data.get('raw', {}).get('length', 0)
+        for frame in data.get('frames', ()):
+            if frame.get('frame_type') != 'stream':
+                continue
+            start = frame.get('offset', 0)
+            end = start + frame.get('length', 0)
+            highest = self.stream_ends.get(frame.get('stream_id'), 0)
+            if start < highest:
+                self.retransmitted_bytes += min(end, highest) - start
+            if end > highest:
+                self.stream_bytes += end - max(start, highest)
+                self.stream_ends[frame.get('stream_id')] = end
+
+    def _packet_received(self, data):
+        self.received += 1
+        for frame in data.get('frames', ()):
+            if frame.get('frame_type') == 'ack':
+                for acked_range in frame.get('acked_ranges', ()):
+                    self._acked(acked_range[0], acked_range[-1])
+
+    def _packet_lost(self, data):
+        self.lost += 1
+        packet_number = data.get('header', {}).get('packet_number')
+        if packet_number is not None:
+            self.lost_packets[packet_number] = None
+            self.highest_lost = max(self.highest_lost, packet_number)
+            if len(self.lost_packets) > SPURIOUS_HISTORY:
+                self.lost_packets.popitem(last=False)
+
+    def _acked(self, low, high):
+        if high > self.largest_acked:
+            self.acked += high - max(low - 1, self.largest_acked)
+            self.largest_acked = high
+        if not self.lost_packets or low > self.highest_lost:
+            return
+        if low == high:
+            if self.lost_packets.pop(low, False) is None:
+                self.spurious += 1
+            return
+        if (low, high) in self.searched_ranges:
+            return
+        self.searched_ranges[(low, high)] = None
+        if len(self.searched_ranges) > ACK_RANGE_HISTORY:
+            self.searched_ranges.popitem(last=False)
+
+        high = min(high, self.highest_lost)
+        if high - low < len(self.lost_packets):
+            acked = [number for number in range(low, high + 1) if number in self.lost_packets]
+        else:
+            acked = [number for number in self.lost_packets if low <= number <= high]
+        for number in acked:
+            del self.lost_packets[number]
+        self.spurious += len(acked)
+
+    def flush(self):
+        if not (self.sent or self.received or self.lost):
+            return
+        statistics = {
+            'packets_sent': self.sent,
+            'packets_received': self.received,
+            'packets_lost': self.lost,
+            'loss_rate': self.lost / self.sent if self.sent else 0.0,
+            'bytes_sent': self.bytes_sent,
+            'retransmitted_bytes': self.retransmitted_bytes,
+            'spurious_losses': self.spurious,
+        }
+        if self.acked:
+            statistics['sent_acked_ratio'] = self.sent / self.acked
+        try:
+            self.collect_agent.send_stat(self.timestamp, suffix=self.suffix, **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio dei contatori dei pacchetti: {e}")
+        self._reset()
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch of relative accuracy *alpha* (DDSketch-like)
+
+    Values are counted in logarithmic bins of ratio (1 + alpha) / (1 - alpha),
+    so that the quantiles of any merge of sketches (bins added together, as
+    KPIMetrics does) are within a relative error alpha of the exact ones.
+    Adding a value is O(1); a sketch of RTTs or windows is a few hundred bins.
+    """
+
+    def __init__(self, alpha=SKETCH_RELATIVE_ACCURACY):
+        self.alpha = alpha
+        self.log_gamma = math.log((1 + alpha) / (1 - alpha))
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add(self, value):
+        if value > 0:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def to_dict(self):
+        return {
+            'alpha': self.alpha,
+            'count': self.count,
+            'zero_count': self.zero_count,
+            'min': self.minimum if self.count else None,
+            'max': self.maximum if self.count else None,
+            'bins': {str(index): count for index, count in self.bins.items()},
+        }
+
+
+class FlowSketches:
+    """Quantile sketches of SKETCH_METRICS for one flow
+
+    They are written to *path* (atomically, as JSON) every *interval*
+    seconds while the flow is active and when the flow ends.
+    """
+
+    def __init__(self, path, flow=None, interval=SKETCH_WRITE_INTERVAL):
+        self.path = path
+        self.flow = flow
+        self.interval = interval
+        self.sketches = {metric: QuantileSketch() for metric in SKETCH_METRICS}
+        self.last_write = time.monotonic()
+        self.dirty = False
+
+    def add(self, statistics):
+        for metric, sketch in self.sketches.items():
+            value = statistics.get(metric)
+            if value is not None:
+                sketch.add(value)
+        self.dirty = True
+        if time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        self.last_write = time.monotonic()
+        if not self.dirty:
+            return
+        content = {
+            'host': socket.gethostname(),
+            'flow': self.flow,
+            'metrics': {metric: sketch.to_dict() for metric, sketch in self.sketches.items()},
+        }
+        temporary = self.path + '.tmp'
+        try:
+            with open(temporary, 'w') as sketch_file:
+                json.dump(content, sketch_file)
+            os.replace(temporary, self.path)
+            self.dirty = False
+        except OSError as e:
+            print(f"Errore durante la scrittura degli sketch in {self.path}: {e}")
+
+
+class AnomalyDetector:
+    """Streaming anomaly detectors of a flow, driving the resolution of its statistics
+
+    RTT spikes (z-score of latest_rtt against its EWMA mean and variance,
+    and at least ANOMALY_RTT_MARGIN above the mean),
+    PTO count increments and sudden congestion window drops are shipped as
+    discrete `event` statistics. While an anomaly is in progress, and for
+    *hold* seconds after its last detection, every point of the flow is
+    shipped; outside anomalies only one point every *downsample_interval*
+    seconds is (every point if 0). The last point skipped before an anomaly
+    is shipped with its onset, so that the detail keeps its context.
+    """
+
+    def __init__(self, collect_agent, downsample_interval=DOWNSAMPLE_INTERVAL, suffix=None,
+                 z_threshold=ANOMALY_Z_THRESHOLD, hold=ANOMALY_HOLD):
+        self.collect_agent = collect_agent
+        self.suffix = suffix
+        self.interval = downsample_interval * 1000
+        self.z_threshold = z_threshold
+        self.hold = hold * 1000
+        self.rtt_mean = None
+        self.rtt_variance = 0.0
+        self.rtt_samples = 0
+        self.pto_count = None
+        self.congestion_window = None
+        self.anomaly_start = None
+        self.last_detection = None
+        self.last_shipped = None
+        self.pending = None
+
+    def _detect(self, statistics):
+        events = {}
+        rtt = statistics.get('latest_rtt')
+        if rtt is not None:
+            if self.rtt_mean is None:
+                self.rtt_mean = rtt
+            else:
+                deviation = rtt - self.rtt_mean
+                if self.rtt_samples >= ANOMALY_WARMUP and self.rtt_variance > 0:
+                    z_score = deviation / math.sqrt(self.rtt_variance)
+                    if z_score >= self.z_threshold and deviation > ANOMALY_RTT_MARGIN * self.rtt_mean:
+                        events['event_rtt_zscore'] = z_score
+                increment = ANOMALY_EWMA_ALPHA * deviation
+                self.rtt_mean += increment
+                self.rtt_variance = (1 - ANOMALY_EWMA_ALPHA) * (self.rtt_variance + deviation * increment)
+            self.rtt_samples += 1
+
+        pto_count = statistics.get('pto_count')
+        if pto_count is not None:
+            if self.pto_count is not None and pto_count > self.pto_count:
+                events['event_pto_increment'] = pto_count - self.pto_count
+            self.pto_count = pto_count
+
+        congestion_window = statistics.get('congestion_window')
+        if congestion_window is not None:
+            if self.congestion_window and congestion_window < (1 - ANOMALY_CWND_DROP) * self.congestion_window:
+                events['event_cwnd_drop'] = 1 - congestion_window / self.congestion_window
+            self.congestion_window = congestion_window
+        return events
+
+    def _send(self, timestamp, **statistics):
+        try:
+            self.collect_agent.send_stat(timestamp, suffix=self.suffix, **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio degli eventi di anomalia: {e}")
+
+    def _end_anomaly(self):
+        self._send(self.last_detection + self.hold, event='anomaly_end',
+                   anomaly_duration=self.last_detection - self.anomaly_start)
+        self.anomaly_start = None
+
+    def update(self, timestamp, statistics):
+        """Run the detectors on a point; return the (timestamp, statistics) points to ship"""
+        events = self._detect(statistics)
+        if self.anomaly_start is not None and timestamp > self.last_detection + self.hold:
+            self._end_anomaly()
+
+        points = []
+        if events:
+            if self.anomaly_start is None:
+                self.anomaly_start = timestamp
+                if self.pending is not None:
+                    points.append(self.pending)
+            self.last_detection = timestamp
+            self._send(timestamp, event=','.join(ANOMALY_EVENTS[name] for name in events), **events)
+
+        if (self.anomaly_start is not None or not self.interval
+                or self.last_shipped is None or timestamp - self.last_shipped >= self.interval):
+            points.append((timestamp, statistics))
+            self.last_shipped = timestamp
+            self.pending = None
+        else:
+            self.pending = (timestamp, statistics)
+        return points
+
+    def flush(self, final=False):
+        """Points left to ship when the qlog is idle; *final* also closes the anomaly in progress"""
+        points = [self.pending] if self.pending is not None else []
+        if points:
+            self.last_shipped = self.pending[0]
+            self.pending = None
+        if final and self.anomaly_start is not None:
+            self._end_anomaly()
+        return points
+
+
 class FileHandler(FileSystemEventHandler):
-    def __init__(self, log_dir):
+    """Incremental archive of the qlogs, one append-only copy per connection in *log_dir*
+
+    On every event only the bytes appended to the qlog since the last sync
+    are copied, with copy_file_range (in-kernel) or positional reads and
+    writes where it is not supported. The archival throughput and lag (bytes
+    of all the qlogs not archived yet) are shipped every ARCHIVE_REPORT_INTERVAL
+    seconds.
+    """
+
+    def __init__(self, log_dir, collect_agent=None):
         self.log_dir = log_dir
+        self.collect_agent = collect_agent
+        self.offsets = {}
+        self.sizes = {}  # last known size of the qlogs, against self.offsets for the lag
+        self.copy_file_range = hasattr(os, 'copy_file_range')
+        self.copied_bytes = 0
+        self.lag_ms_max = 0
+        self.last_report = time.monotonic()
 
     def on_modified(self, event):
-        if not event.is_directory:  # Ignora le modifiche ai soli file
-            self._backup_file(event.src_path)
+        if not event.is_directory and event.src_path.endswith(".sqlog"):
+            self._sync(event.src_path)
 
     def on_created(self, event):
-        if not event.is_directory:  # Ignora la creazione di directory
-            self._backup_file(event.src_path)
+        if not event.is_directory and event.src_path.endswith(".sqlog"):
+            self._sync(event.src_path)
+
+    def _copy(self, source, destination, offset, size):
+        while offset < size:
+            if self.copy_file_range:
+                try:
+                    copied = os.copy_file_range(source, destination, size - offset, offset, offset)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    print(f"copy_file_range non disponibile ({e}), uso di pread/pwrite")
+                    self.copy_file_range = False
+                    continue
+            else:
+                copied = os.pwrite(destination, os.pread(source, min(size - offset, ARCHIVE_CHUNK), offset), offset)
+            if not copied:
+                break
+            offset += copied
+        return offset
+
+    def _sync(self, file_path):
+        archive_path = os.path.join(self.log_dir, os.path.basename(file_path))
+        try:
+            source = os.open(file_path, os.O_RDONLY)
+            try:
+                status = os.fstat(source)
+                offset = self.offsets.get(file_path)
+                flags = os.O_WRONLY | os.O_CREAT
+                if offset is None or status.st_size < offset:
+                    # New connection, or a qlog truncated since the last sync: start over
+                    offset = 0
+                    flags |= os.O_TRUNC
+                destination = os.open(archive_path, flags, 0o644)
+                try:
+                    synced = self._copy(source, destination, offset, status.st_size)
+                finally:
+                    os.close(destination)
+            finally:
+                os.close(source)
+        except OSError as e:
+            print(f"Errore durante l'archiviazione del file {file_path}: {e}")
+            return
+
+        self.offsets[file_path] = synced
+        self.sizes[file_path] = status.st_size
+        self.copied_bytes += synced - offset
+        if synced > offset:
+            # Delay between the last write of the qlog and its archival
+            self.lag_ms_max = max(self.lag_ms_max, time.time() * 1000 - status.st_mtime_ns / 1e6)
+        self._maybe_report()
+
+    def lag_bytes(self):
+        """Bytes written to the tracked qlogs and not archived yet"""
+        lag = 0
+        for file_path, synced in self.offsets.items():
+            try:
+                self.sizes[file_path] = os.path.getsize(file_path)
+            except OSError:
+                pass  # removed: last known size
+            lag += max(self.sizes[file_path] - synced, 0)
+        return lag
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        elapsed = now - self.last_report
+        if self.collect_agent is None or elapsed < ARCHIVE_REPORT_INTERVAL:
+            return
+        statistics = {
+            'archive_throughput_bytes_per_s': self.copied_bytes / elapsed,
+            'archive_lag_bytes': self.lag_bytes(),
+            'archive_lag_ms_max': self.lag_ms_max,
+            'archive_connections': len(self.offsets),
+        }
+        try:
+            self.collect_agent.send_stat(self.collect_agent.now(), **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio delle statistiche di archiviazione: {e}")
+        self.copied_bytes = 0
+        self.lag_ms_max = 0
+        self.last_report = now
+
+
+class JobProfiler:
+    """On-demand profiling of the job, driven by signals
+
+    SIGUSR1 starts/stops a statistical profiler sampling the stack every
+    *interval* seconds of CPU time; SIGUSR2 starts/stops tracemalloc.
+    Results are written into *log_dir* with a timestamp and the pid, the
+    CPU profile in the collapsed stacks format used by flamegraph tools.
+    The signal is forwarded to the qlog readers, each profiling itself.
+    """
+
+    def __init__(self, log_dir, interval=PROFILE_INTERVAL):
+        self.log_dir = log_dir
+        self.interval = interval
+        self.samples = None
+
+    def install(self):
+        signal.signal(signal.SIGUSR1, self._on_signal)
+        signal.signal(signal.SIGUSR2, self._on_signal)
 
-    def _backup_file(self, file_path):
-        # Crea una directory con il timestamp nella log_dir
+    def _output_path(self, kind, extension):
         timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        backup_dir = os.path.join(self.log_dir, timestamp)
+        return os.path.join(self.log_dir, f"{kind}_{timestamp}_{os.getpid()}.{extension}")
 
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
+    def _on_signal(self, signum, frame):
+        for child in multiprocessing.active_children():
+            os.kill(child.pid, signum)
 
-        # Copia il file nella directory di backup
         try:
-            shutil.copy(file_path, backup_dir)
-            print(f"File copiato: {file_path} -> {backup_dir}")
+            if signum == signal.SIGUSR1:
+                self._toggle_sampling()
+            else:
+                self._toggle_tracemalloc()
         except Exception as e:
-            print(f"Errore durante la copia del file {file_path}: {e}")
-        
-        
+            print(f"Errore durante la profilazione: {e}")
+
+    def _toggle_sampling(self):
+        if self.samples is None:
+            self.samples = Counter()
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            print(f"Profilazione CPU avviata (pid {os.getpid()})")
+            return
+
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        samples, self.samples = self.samples, None
+        path = self._output_path('profile', 'folded')
+        with open(path, 'w') as output:
+            for stack, count in samples.most_common():
+                output.write(f"{stack} {count}\n")
+        print(f"Profilazione CPU terminata, {sum(samples.values())} campioni scritti in {path}")
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def _toggle_tracemalloc(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            print(f"Tracemalloc avviato (pid {os.getpid()})")
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(self._output_path('tracemalloc', 'snapshot'))
+        path = self._output_path('tracemalloc', 'txt')
+        with open(path, 'w') as output:
+            for statistic in snapshot.statistics('traceback')[:TRACEMALLOC_TOP]:
+                output.write(f"{statistic}\n")
+                output.writelines(f"    {line}\n" for line in statistic.traceback.format())
+        print(f"Tracemalloc terminato, snapshot scritto in {path}")
+
+
+class FlowIndex:
+    """Reverse index from connection ID to the flows of a log directory
+
+    The reader of each qlog appends the identity of its connection (ODCID,
+    qlog file, flow label, start time, reference time, vantage point and,
+    once known, peer address) to FLOW_INDEX_FILE, next to the qlogs, as one
+    JSON object per line. load() merges the records into a dict keyed by
+    ODCID, so that the server and client traces of a connection can be
+    joined without scanning the qlogs again.
+    """
+
+    def __init__(self, log_dir):
+        self.path = os.path.join(log_dir, FLOW_INDEX_FILE)
+
+    def record(self, odcid, **fields):
+        # Single small append: the readers of all the flows share the file
+        with open(self.path, 'a') as index:
+            index.write(json.dumps({'odcid': odcid, **fields}) + '\n')
+
+    def load(self):
+        flows = {}
+        try:
+            with open(self.path) as index:
+                for line in index:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    flows.setdefault(entry['odcid'], {}).update(entry)
+        except FileNotFoundError:
+            pass
+        return flows
+
+
+class StatSink(abc.ABC):
+    """Destination of the statistics shipped by the qlog readers
+
+    Sinks are used in place of collect_agent (same now/send_stat calls):
+    points are buffered and written by batches of *batch_size*, or once
+    *flush_interval* seconds have passed since the last write. The readers
+    also call flush() when their qlog is idle and before exiting.
+
+    A sink is shared by the threads of the job (watchdog, endpoint
+    accounting): a lock serializes the buffer and the writes. A forked
+    reader starts with a fresh lock and an empty buffer, so that it neither
+    inherits a lock held by another thread nor writes the points of its
+    parent again.
+    """
+
+    def __init__(self, batch_size=SINK_BATCH_SIZE, flush_interval=SINK_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+        self.buffer = []
+
+    def now(self):
+        return collect_agent.now()
+
+    def send_stat(self, timestamp, suffix=None, **statistics):
+        with self.lock:
+            self.buffer.append((timestamp, suffix, statistics))
+            if len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        buffer, self.buffer = self.buffer, []
+        self.last_flush = time.monotonic()
+        if not buffer:
+            return
+        try:
+            self._write(buffer)
+        except Exception as e:
+            print(f"Errore durante la scrittura di {len(buffer)} statistiche: {e}")
+
+    @abc.abstractmethod
+    def _write(self, points):
+        """Write a batch of (timestamp, suffix, statistics) points"""
+
+
+class CollectAgentSink(StatSink):
+    """Batches sent through collect_agent, one call per timestamp and suffix"""
+
+    def __init__(self, collect_agent, **kwargs):
+        super().__init__(**kwargs)
+        self.collect_agent = collect_agent
+
+    def _write(self, points):
+        merged = {}
+        for timestamp, suffix, statistics in points:
+            merged.setdefault((timestamp, suffix), {}).update(statistics)
+        for (timestamp, suffix), statistics in merged.items():
+            self.collect_agent.send_stat(timestamp, suffix=suffix, **statistics)
+
+
+def _line_protocol_escape(value, special=',= '):
+    for character in special:
+        value = value.replace(character, '\\' + character)
+    return value
+
+
+def _line_protocol_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f'{value}i'
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class LineProtocolSink(StatSink):
+    """Points formatted as InfluxDB line protocol, tagged with their suffix"""
+
+    def __init__(self, measurement, **kwargs):
+        super().__init__(**kwargs)
+        self.measurement = _line_protocol_escape(measurement, ', ')
+
+    def _lines(self, points):
+        for timestamp, suffix, statistics in points:
+            fields = ','.join(
+                f'{_line_protocol_escape(name)}={_line_protocol_value(value)}'
+                for name, value in statistics.items() if value is not None)
+            if not fields:
+                continue
+            tags = f',@suffix={_line_protocol_escape(str(suffix))}' if suffix is not None else ''
+            yield f'{self.measurement}{tags} {fields} {int(timestamp) * 1000000}\n'.encode()
+
+    def _write(self, points):
+        self._emit(list(self._lines(points)))
+
+
+class LineProtocolFileSink(LineProtocolSink):
+    """Local append-only line protocol file, shared by all the readers"""
+
+    def __init__(self, measurement, path, **kwargs):
+        super().__init__(measurement, **kwargs)
+        # Unbuffered O_APPEND: each batch is a single write, never interleaved with other readers
+        self.file = open(path, 'ab', buffering=0)
+
+    def _emit(self, lines):
+        self.file.write(b''.join(lines))
+
+
+class UdpLineProtocolSink(LineProtocolSink):
+    """Line protocol datagrams, e.g. to the UDP listener of a local InfluxDB"""
+
+    def __init__(self, measurement, address, **kwargs):
+        super().__init__(measurement, **kwargs)
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _emit(self, lines):
+        datagram = b''
+        for line in lines:
+            if datagram and len(datagram) + len(line) > UDP_DATAGRAM_SIZE:
+                self.socket.sendto(datagram, self.address)
+                datagram = b''
+            datagram += line
+        if datagram:
+            self.socket.sendto(datagram, self.address)
+
+
+class RingBufferSink(StatSink):
+    """Last *capacity* points kept in memory of the process, for tests
+
+    Not one of the STAT_SINKS of the job: the qlog readers are forked, the
+    points they send would stay in their own copy of the buffer.
+    """
+
+    def __init__(self, capacity=RING_BUFFER_SIZE):
+        super().__init__()
+        self.points = deque(maxlen=capacity)
+
+    def send_stat(self, timestamp, suffix=None, **statistics):
+        self.points.append((timestamp, suffix, statistics))
+
+    def _write(self, points):
+        self.points.extend(points)
+
+
+def build_stat_sink(kind, measurement, path=None, address=None):
+    if kind == 'file':
+        return LineProtocolFileSink(measurement, path)
+    if kind == 'udp':
+        return UdpLineProtocolSink(measurement, address)
+    return CollectAgentSink(collect_agent)
+
+
+def read_current_qdisc():
+    """Qdisc of the bottleneck last set by queueManager on this host, if any"""
+    try:
+        with open(QDISC_FILE) as qdisc:
+            return qdisc.readline().strip() or None
+    except OSError:
+        return None
+
+
+class ResultsStore:
+    """Index of the runs of the quicos jobs, in a SQLite database next to their log folders
+
+    A run is registered with its experiment, congestion control, qdisc and
+    resource; its files and KPIs are attached to it as they come, so that
+    KPIMetrics and the queries on past runs never scan the log folders. A
+    connection is opened per operation since the qlog readers write from
+    their own processes, and errors are only printed: the index never stops
+    a job.
+    """
+
+    def __init__(self, log_dir):
+        self.path = os.path.join(log_dir, RESULTS_DB)
+        self.run_id = None
+        self._execute(RESULTS_SCHEMA, script=True)
+
+    def _execute(self, statement, parameters=(), script=False, many=False):
+        try:
+            db = sqlite3.connect(self.path, timeout=RESULTS_DB_TIMEOUT)
+            try:
+                with db:
+                    if script:
+                        db.executescript(statement)
+                    elif many:
+                        db.executemany(statement, parameters)
+                    else:
+                        return db.execute(statement, parameters).lastrowid
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            print(f"Errore del database dei risultati {self.path}: {e}")
+
+    def register_run(self, job, role, **fields):
+        fields.update(job=job, role=role, host=socket.gethostname(), started=time.time())
+        self.run_id = self._execute(
+                f"INSERT INTO runs ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+                tuple(fields.values()))
+        return self.run_id
+
+    def update_run(self, **fields):
+        if self.run_id is None or not fields:
+            return
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        self._execute(f"UPDATE runs SET {assignments} WHERE id = ?", (*fields.values(), self.run_id))
+
+    def finish_run(self, **fields):
+        self.update_run(ended=time.time(), **fields)
+
+    def add_file(self, path, kind):
+        if self.run_id is not None:
+            self._execute("INSERT OR IGNORE INTO files (run_id, path, kind) VALUES (?, ?, ?)", (self.run_id, path, kind))
+
+    def add_kpis(self, **kpis):
+        if self.run_id is not None:
+            self._execute(
+                    "INSERT OR REPLACE INTO kpis (run_id, name, value) VALUES (?, ?, ?)",
+                    [(self.run_id, name, value) for name, value in kpis.items()], many=True)
+
+
+class QlogSampler:
+    """Selection of the connections whose qlog is read in full
+
+    A connection is sampled when it is one of the *first* connections (0 for
+    no limit), one in *every* connections and within *fraction* of the
+    connections by a hash of its qlog name, stable across runs and hosts.
+    The other connections only get an end-of-connection summary.
+    """
+
+    def __init__(self, every=QLOG_SAMPLE_EVERY, first=QLOG_SAMPLE_FIRST, fraction=QLOG_SAMPLE_FRACTION):
+        self.every = max(every, 1)
+        self.first = first
+        self.fraction = fraction
+        self.seen = 0
+        self.sampled = 0
+
+    def select(self, file_path):
+        position = self.seen
+        self.seen += 1
+        sampled = (
+                (not self.first or position < self.first)
+                and position % self.every == 0
+                and zlib.crc32(os.path.basename(file_path).encode()) < self.fraction * 2 ** 32)
+        if sampled:
+            self.sampled += 1
+        return sampled
+
+    def statistics(self):
+        """Effective sampling rate, scaling the KPIs computed on the sampled connections"""
+        return {
+            'qlog_connections_seen': self.seen,
+            'qlog_connections_sampled': self.sampled,
+            'qlog_sampling_rate': self.sampled / self.seen if self.seen else 1.0,
+        }
+
+
+def summarize_qlog(file_path, tail_bytes=SUMMARY_TAIL_BYTES):
+    """End-of-connection summary of a qlog read from its last bytes only
+
+    Return the last recovery metrics of the connection, its duration (qlog
+    time of its last event) and qlog size, and whether it is closed.
+    """
+    with open(file_path, 'rb') as qlog:
+        size = qlog.seek(0, os.SEEK_END)
+        qlog.seek(max(size - tail_bytes, 0))
+        lines = qlog.read().decode(errors='replace').split('\n')
+    if size > tail_bytes:
+        lines = lines[1:]  # truncated by the seek
+
+    summary = {'summary_qlog_bytes': size}
+    closed = False
+    for line in reversed(lines):
+        try:
+            event = json.loads(line.strip())  # JSON-SEQ records start with RS
+        except ValueError:
+            continue
+        if not isinstance(event, dict):
+            continue
+        if event.get('name') in CONNECTION_CLOSED_EVENTS:
+            closed = True
+        if 'summary_duration' not in summary and isinstance(event.get('time'), (int, float)):
+            summary['summary_duration'] = event['time']
+        data = event.get('data')
+        if isinstance(data, dict) and all(data.get(key) is not None for key in SUMMARY_METRICS):
+            summary.update({f'summary_{key}': data[key] for key in SUMMARY_METRICS})
+            break
+    return summary, closed
+
+
 class LogFileHandler(FileSystemEventHandler):
-    def __init__(self, collect_agent):
+    def __init__(self, collect_agent, idle_timeout=IDLE_TIMEOUT, reuse_flow_slots=False, packet_stats_interval=PACKET_STATS_INTERVAL, downsample_interval=DOWNSAMPLE_INTERVAL, results=None, sampler=None):
         self.collect_agent = collect_agent
+        self.sampler = sampler or QlogSampler()
+        self.packet_stats_interval = packet_stats_interval
+        self.downsample_interval = downsample_interval
+        self.results = results
+        self.idle_timeout = idle_timeout
+        self.reuse_flow_slots = reuse_flow_slots
         self.file_positions = {}
         self.file_indices = {}
         self.current_index = 1
         self.processes = {}
+        self.reader_positions = {}  # offsets published by the readers, kept to resume idle connections
+        self.reader_drains = {}  # (offset, stream bytes) published by the readers at the end of their qlog
+        self.stream_bytes = 0  # stream bytes of the readers that are over
+        self.free_indices = []
+        # Bounded history of finished connections, so late modifications of a
+        # closed qlog do not spawn a new reader starting again from offset 0
+        self.closed_files = OrderedDict()
+        self.unsampled = {}
+        self.lock = threading.Lock()
+        self.telemetry = None
+        self.rollups = None
+        self.packets = None
+        self.sketches = None
+        self.anomalies = None
+        self.connection = None
 
     def on_created(self, event):
         if not event.is_directory and event.src_path.endswith(".sqlog"):
             print(f"Nuovo file di log creato: {event.src_path}")
-            
-            if event.src_path not in self.file_indices:
-                self.file_indices[event.src_path] = self.current_index
-                print(f"Assegnato indice {self.current_index} al file {event.src_path}")
-                self.current_index += 1
-            else:
-                print(f"File {event.src_path} già monitorato con indice {self.file_indices[event.src_path]}")
-            
-            process = multiprocessing.Process(target=self._read_new_lines, args=(event.src_path,))
-            process.start()
-            self.processes[event.src_path] = process
+            self._start_reader(event.src_path)
             
     def on_modified(self, event):
         if not event.is_directory and event.src_path.endswith(".sqlog"):
@@ -164,12 +1194,162 @@ class LogFileHandler(FileSystemEventHandler):
                 return
             
             # Se un nuovo file viene modificato, avvia un processo
-            process = multiprocessing.Process(target=self._read_new_lines, args=(event.src_path,))
-            process.start()
-            self.processes[event.src_path] = process
+            self._start_reader(event.src_path)
 
-    def _read_new_lines(self, file_path):
-        """ Legge nuove righe dal file senza bloccare gli altri processi """
+    def _start_reader(self, file_path):
+        with self.lock:
+            if file_path in self.processes or file_path in self.closed_files or file_path in self.unsampled:
+                return
+
+            if file_path not in self.file_indices:
+                if self.reuse_flow_slots and self.free_indices:
+                    file_index = heapq.heappop(self.free_indices)
+                else:
+                    file_index = self.current_index
+                    self.current_index += 1
+                self.file_indices[file_path] = file_index
+                print(f"Assegnato indice {file_index} al file {file_path}")
+                if not self._sample(file_path):
+                    return
+            else:
+                print(f"File {file_path} (indice {self.file_indices[file_path]}) di nuovo attivo, ripresa dall'offset {self.file_positions.get(file_path, 0)}")
+
+            position = multiprocessing.Value('q', self.file_positions.get(file_path, 0), lock=False)
+            drained = multiprocessing.Array('q', 2, lock=False)
+            process = multiprocessing.Process(target=self._read_new_lines, args=(file_path, position, drained))
+            self.reader_positions[file_path] = position
+            self.reader_drains[file_path] = drained
+            process.start()
+            self.processes[file_path] = process
+
+    def reap_readers(self):
+        """Release the readers of connections that are over, along with their flow slot"""
+        with self.lock:
+            for file_path, process in list(self.processes.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                idle = process.exitcode == READER_IDLE_EXIT
+                process.close()
+                del self.processes[file_path]
+                position = self.reader_positions.pop(file_path)
+                self.stream_bytes += self.reader_drains.pop(file_path)[1]
+                if idle:
+                    # Only quiet: keep the flow and the offset, the next write resumes the reader
+                    self.file_positions[file_path] = position.value
+                    print(f"Lettore del file {file_path} sospeso all'offset {position.value}")
+                    continue
+                file_index = self._release(file_path)
+                print(f"Lettore del file {file_path} (indice {file_index}) terminato")
+            self._summarize_unsampled()
+
+    def _release(self, file_path):
+        """Forget a connection that is over and free its flow slot"""
+        file_index = self.file_indices.pop(file_path, None)
+        self.file_positions.pop(file_path, None)
+
+        self.closed_files[file_path] = file_index
+        while len(self.closed_files) > CLOSED_FILES_HISTORY:
+            self.closed_files.popitem(last=False)
+
+        if self.reuse_flow_slots and file_index is not None:
+            heapq.heappush(self.free_indices, file_index)
+        return file_index
+
+    def delivered_bytes(self, timeout=READER_DRAIN_TIMEOUT):
+        """Stream bytes sent by the endpoint, as counted by the packet counters of the readers
+
+        Wait up to *timeout* seconds for the readers to reach the end of
+        their qlog. The bytes of the sampled connections are scaled to all
+        the connections by the sampling rate. None without packet counters,
+        or when a reader is still behind.
+        """
+        if not self.packet_stats_interval:
+            return None
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                total = self.stream_bytes
+                behind = []
+                for file_path, drained in self.reader_drains.items():
+                    try:
+                        if drained[0] < os.path.getsize(file_path):
+                            behind.append(file_path)
+                            continue
+                    except OSError:
+                        pass  # removed
+                    total += drained[1]
+                sampling_rate = self.sampler.statistics()['qlog_sampling_rate']
+            if not behind:
+                return round(total / sampling_rate) if sampling_rate else None
+            if time.monotonic() > deadline:
+                print(f"Lettori ancora indietro su {behind}: byte consegnati non disponibili")
+                return None
+            time.sleep(0.5)
+
+    def _sample(self, file_path):
+        """Apply the sampling policy to a new connection; False if it only gets a summary"""
+        sampled = self.sampler.select(file_path)
+        statistics = self.sampler.statistics()
+        try:
+            self.collect_agent.send_stat(self.collect_agent.now(), **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio del tasso di campionamento: {e}")
+        if self.results is not None:
+            self.results.add_kpis(**statistics)
+        if not sampled:
+            if self.results is not None:
+                self.results.add_file(file_path, 'qlog_summary')
+            self.unsampled[file_path] = [None, time.monotonic(), False]  # size, last change, tail read
+            print(f"File {file_path} non campionato: solo riepilogo a fine connessione")
+        return sampled
+
+    def _summarize_unsampled(self):
+        """Ship the summary of the unsampled connections that are over
+
+        The tail of a qlog is only read once it has not grown for a whole
+        check, and then again only if it grows.
+        """
+        now = time.monotonic()
+        for file_path, state in list(self.unsampled.items()):
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = None  # removed
+            if size != state[0]:
+                state[:] = [size, now, False]
+                continue
+            idle = size is None or now - state[1] > self.idle_timeout
+            if state[2] and not idle:
+                continue
+            state[2] = True
+
+            try:
+                summary, closed = summarize_qlog(file_path)
+            except OSError:
+                summary, closed = {}, True
+            if not (closed or idle):
+                continue
+            del self.unsampled[file_path]
+            file_index = self._release(file_path)
+            if len(summary) > 1:
+                try:
+                    self.collect_agent.send_stat(self.collect_agent.now(), suffix=str(file_index), **summary)
+                except Exception as e:
+                    print(f"Errore durante l'invio del riepilogo della connessione: {e}")
+            print(f"Riepilogo del file {file_path} (indice {file_index}): {summary}")
+
+    def _read_new_lines(self, file_path, position=None, drained=None):
+        """ Legge nuove righe dal file senza bloccare gli altri processi
+
+        L'offset raggiunto è pubblicato in *position*; dopo idle_timeout
+        secondi senza scritture il lettore termina con READER_IDLE_EXIT e
+        riprende da lì alla scrittura successiva. In fondo al file, l'offset
+        e i byte di stream contati sono pubblicati in *drained*.
+        """
+        idle = False
+        if self.results is not None:
+            self.results.add_file(file_path, 'qlog')
         try:
             with open(file_path, "r") as file:
                 if file_path in self.file_positions:
@@ -177,62 +1357,374 @@ class LogFileHandler(FileSystemEventHandler):
                 else:
                     self.file_positions[file_path] = 0
 
+                file_index = self.file_indices.get(file_path, 0)
+                self.telemetry = IngestionTelemetry(self.collect_agent, suffix=str(file_index))
+                self.rollups = RollupAggregator(self.collect_agent, suffix=str(file_index))
+                self.sketches = FlowSketches(os.path.join(os.path.dirname(file_path), f"sketch_{os.path.splitext(os.path.basename(file_path))[0]}.json"), flow=str(file_index))
+                self.anomalies = AnomalyDetector(self.collect_agent, self.downsample_interval, suffix=str(file_index))
+                if self.packet_stats_interval:
+                    self.packets = PacketCounters(self.collect_agent, self.packet_stats_interval, suffix=str(file_index))
+                last_activity = time.monotonic()
+                connection_closed = False
                 while True:
                     line = file.readline()
+                    self.telemetry.maybe_report(file)
                     if not line:
-                        time.sleep(0.5)
+                        if drained is not None and self.packets is not None:
+                            drained[1] = self.packets.stream_bytes
+                            drained[0] = file.tell()
+                        if connection_closed:
+                            # Final drain done: nothing left after the close event
+                            break
+                        if time.monotonic() - last_activity > self.idle_timeout:
+                            print(f"Nessuna attività sul file {file_path} da {self.idle_timeout}s, sospensione del lettore")
+                            idle = True
+                            break
+                        if time.monotonic() - last_activity > ROLLUP_IDLE_FLUSH:
+                            self.rollups.flush()
+                            if self.packets is not None:
+                                self.packets.flush()
+                            self.sketches.write()
+                            self._ship(self.anomalies.flush(), str(file_index))
+                        self.collect_agent.flush()
+                        time.sleep(0.5)  # Attendi senza consumare CPU inutilmente
                         continue
+                    last_activity = time.monotonic()
+                    self.telemetry.line_parsed()
                     cleaned_line = line.strip()
-                    file_index = self.file_indices.get(file_path, 0)
-                    self._process_line(cleaned_line, file_index)
+                    if self._process_line(cleaned_line, file_index, file_path):
+                        print(f"Connessione chiusa sul file {file_path}, lettura delle ultime righe")
+                        connection_closed = True
                     self.file_positions[file_path] = file.tell()
+                    if position is not None:
+                        position.value = self.file_positions[file_path]
+                self.rollups.flush()
+                if self.packets is not None:
+                    self.packets.flush()
+                self.sketches.write()
+                self._ship(self.anomalies.flush(final=True), str(file_index))
+                self.collect_agent.flush()
         except Exception as e:
             print(f"Errore durante la lettura del file {file_path}: {e}")
-
-    def _process_line(self, line, file_index):
-        """ Elabora e invia i dati letti dal file """
+        if idle:
+            sys.exit(READER_IDLE_EXIT)
+
+    def _index_connection(self, trace, file_index, file_path):
+        """Record the identity of the connection read from the qlog header"""
+        common_fields = trace.get('common_fields', {})
+        odcid = common_fields.get('ODCID') or common_fields.get('group_id')
+        if not odcid:
+            print(f"Intestazione senza connection ID nel file {file_path}")
+            return
+
+        self.connection = {
+            'odcid': odcid,
+            'vantage_point': trace.get('vantage_point', {}).get('type'),
+        }
+        try:
+            FlowIndex(os.path.dirname(file_path)).record(
+                    odcid,
+                    file=os.path.basename(file_path),
+                    flow=str(file_index),
+                    start_time=self.collect_agent.now(),
+                    reference_time=common_fields.get('reference_time'),
+                    vantage_point=self.connection['vantage_point'])
+            print(f"Connessione {odcid} associata al flusso {file_index}")
+        except OSError as e:
+            print(f"Errore durante l'aggiornamento dell'indice dei flussi: {e}")
+
+    def _index_peer(self, data, file_path):
+        if self.connection is None:
+            return
+        # The peer is the destination for a client, the source for a server
+        side = 'dst' if self.connection['vantage_point'] == 'client' else 'src'
+        address = data.get(f'{side}_ip')
+        if address is None:
+            return
+        try:
+            FlowIndex(os.path.dirname(file_path)).record(
+                    self.connection['odcid'], peer=f"{address}:{data.get(f'{side}_port', '')}")
+        except OSError as e:
+            print(f"Errore durante l'aggiornamento dell'indice dei flussi: {e}")
+
+    def _ship(self, points, suffix=None):
+        """Send the points kept by the anomaly detector"""
+        for timestamp, statistics in points:
+            self.collect_agent.send_stat(timestamp, suffix=suffix, **statistics)
+            self.telemetry.stat_shipped(timestamp)
+
+    def _process_line(self, line, file_index, file_path):
+        """ Elabora e invia i dati letti dal file
+
+        Returns True when the line reports the end of the connection.
+        """
         try:
             data = json.loads(line)
+            if 'trace' in data:
+                self._index_connection(data['trace'], file_index, file_path)
+                return False
+            if data.get("name") in CONNECTION_CLOSED_EVENTS:
+                return True
+            if data.get("name") in CONNECTION_STARTED_EVENTS:
+                self._index_peer(data.get("data", {}), file_path)
+                return False
+
             timestamp = data.get("time")
             stats = data.get("data", {})
+            if data.get("name") in PACKET_EVENTS:
+                if self.packets is not None:
+                    self.packets.add(data["name"], stats, timestamp, collect_agent.now())
+                return False
+            if data.get("name") != "recovery:metrics_updated":
+                return False
 
             statistics = {
-                f'min_rtt_{file_index}': stats.get('min_rtt'),
-                f'smoothed_rtt_{file_index}': stats.get('smoothed_rtt'),
-                f'latest_rtt_{file_index}': stats.get('latest_rtt'),
-                f'rtt_variance_{file_index}': stats.get('rtt_variance'),
-                f'pto_count_{file_index}': stats.get('pto_count'),
-                f'congestion_window_{file_index}': stats.get('congestion_window'),
-                f'bytes_in_flight_{file_index}': stats.get('bytes_in_flight'),
+                'min_rtt': stats.get('min_rtt'),
+                'smoothed_rtt': stats.get('smoothed_rtt'),
+                'latest_rtt': stats.get('latest_rtt'),
+                'rtt_variance': stats.get('rtt_variance'),
+                'pto_count': stats.get('pto_count'),
+                'congestion_window': stats.get('congestion_window'),
+                'bytes_in_flight': stats.get('bytes_in_flight'),
             }
             print(f"Nuove statistiche dal file {file_index}: {statistics}")
-            self.collect_agent.send_stat(collect_agent.now(), **statistics)
+            timestamp = collect_agent.now()
+            # The flow is carried by the suffix so that the field names stay the same for every connection
+            self._ship(self.anomalies.update(timestamp, statistics), str(file_index))
+            self.rollups.add(timestamp, statistics)
+            self.sketches.add(statistics)
         except json.JSONDecodeError:
             print(f"Riga non valida (non JSON): {line}")
         except Exception as e:
             print(f"Errore durante il processamento della riga: {e}")
+        return False
             
 
-def start_watchdog(collect_agent, log_dir):
-    event_handler = LogFileHandler(collect_agent)
+def start_watchdog(event_handler, log_dir, archive_dir=None):
     observer = Observer()
     observer.schedule(event_handler, path=log_dir, recursive=False)
+    if archive_dir is not None:
+        observer.schedule(FileHandler(archive_dir, event_handler.collect_agent), path=log_dir, recursive=False)
     observer.start()
 
     try:
         while True:
             time.sleep(1)
+            event_handler.reap_readers()
     except KeyboardInterrupt:
+        pass
+    finally:
         observer.stop()
-    observer.join()
+        observer.join()
+        event_handler.collect_agent.flush()
 
 
-def run_command(cmd, cwd=None):
+def cpu_frequency():
+    """Nominal CPU frequency (Hz) converting CPU time into cycles, None if unknown"""
+    try:
+        with open('/sys/devices/system/cpu/cpu0/cpufreq/base_frequency') as frequency:
+            return int(frequency.read()) * 1000
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('cpu MHz'):
+                    return float(line.split(':')[1]) * 1e6
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class EndpointAccounting:
+    """Resource usage of the QUIC endpoint process and its descendants
+
+    While the endpoint runs, /proc is sampled every *interval* seconds and the
+    CPU time (user and system), RSS, context switches and read/write syscalls
+    of its process tree are shipped as endpoint_* rates. When it exits, its
+    exact totals are taken from wait4() and shipped with the cost per
+    delivered byte.
+    """
+
+    def __init__(self, collect_agent, interval=ACCOUNTING_INTERVAL, suffix=None):
+        self.collect_agent = collect_agent
+        self.interval = interval
+        self.suffix = suffix
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.children_files = os.path.exists(f'/proc/self/task/{os.getpid()}/children')
+        self.stopped = threading.Event()
+        self.samples = {}  # last counters of each live process of the tree
+        self.exited = [0.0, 0.0, 0, 0, 0]  # counters of the processes gone since
+        self.sampling_time = 0
+        self.thread = None
+
+    def start(self, pid):
+        self.pid = pid
+        self.started = time.monotonic()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _tree(self):
+        if self.children_files:
+            pids, pending = [], [self.pid]
+            while pending:
+                pid = pending.pop()
+                pids.append(pid)
+                try:
+                    for task in os.listdir(f'/proc/{pid}/task'):
+                        with open(f'/proc/{pid}/task/{task}/children') as children:
+                            pending.extend(int(child) for child in children.read().split())
+                except OSError:
+                    pass
+            return pids
+
+        # Kernels without CONFIG_PROC_CHILDREN: parents of every process
+        children = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open(f'/proc/{name}/stat') as stat:
+                        parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+                except (OSError, ValueError, IndexError):
+                    continue
+                children.setdefault(parent, []).append(int(name))
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, ()))
+        return pids
+
+    def _read(self, pid):
+        """user (s), system (s), voluntary and involuntary switches, syscalls, rss (bytes)"""
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        # Fields 14, 15 and 24 of proc(5), counted from the state (field 3)
+        counters = [int(fields[11]) / self.ticks, int(fields[12]) / self.ticks, 0, 0, None]
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('voluntary_ctxt_switches'):
+                    counters[2] = int(line.split()[1])
+                elif line.startswith('nonvoluntary_ctxt_switches'):
+                    counters[3] = int(line.split()[1])
+        try:
+            with open(f'/proc/{pid}/io') as io:
+                counters[4] = sum(int(line.split()[1]) for line in io if line.startswith(('syscr', 'syscw')))
+        except OSError:
+            pass  # no task I/O accounting
+        return counters, int(fields[21]) * self.page_size
+
+    def sample(self):
+        """Cumulative counters of the tree (as in _read) and its current RSS"""
+        samples, rss = {}, 0
+        for pid in self._tree():
+            try:
+                samples[pid], process_rss = self._read(pid)
+            except (OSError, ValueError, IndexError):
+                continue  # exited meanwhile
+            rss += process_rss
+        for pid, counters in self.samples.items():
+            if pid not in samples:
+                for index, value in enumerate(counters):
+                    self.exited[index] += value or 0
+        self.samples = samples
+
+        totals = list(self.exited)
+        syscalls_available = False
+        for counters in samples.values():
+            for index, value in enumerate(counters):
+                totals[index] += value or 0
+            syscalls_available = syscalls_available or counters[4] is not None
+        if not syscalls_available and not self.exited[4]:
+            totals[4] = None
+        return totals, rss
+
+    def _run(self):
+        last, last_time = None, time.monotonic()
+        while not self.stopped.wait(self.interval):
+            begin = time.thread_time()
+            totals, rss = self.sample()
+            now = time.monotonic()
+            elapsed, last_time = now - last_time, now
+            if last is not None and elapsed > 0:
+                statistics = {
+                    'endpoint_cpu_user_percent': 100 * (totals[0] - last[0]) / elapsed,
+                    'endpoint_cpu_system_percent': 100 * (totals[1] - last[1]) / elapsed,
+                    'endpoint_rss_bytes': rss,
+                    'endpoint_voluntary_ctxt_switches_per_s': (totals[2] - last[2]) / elapsed,
+                    'endpoint_involuntary_ctxt_switches_per_s': (totals[3] - last[3]) / elapsed,
+                }
+                if totals[4] is not None and last[4] is not None:
+                    statistics['endpoint_syscalls_per_s'] = (totals[4] - last[4]) / elapsed
+                try:
+                    self.collect_agent.send_stat(self.collect_agent.now(), suffix=self.suffix, **statistics)
+                except Exception as e:
+                    print(f"Errore durante l'invio delle statistiche dell'endpoint: {e}")
+            last = totals
+            self.sampling_time += time.thread_time() - begin
+
+    def finish(self, process, delivered_bytes=None):
+        """Stop sampling, reap the endpoint *process* and ship the totals of its run
+
+        Return the shipped statistics, for the results index.
+        """
+        if self.thread is None:
+            return {}
+        self.stopped.set()
+        self.thread.join()
+        totals, _ = self.sample()
+        elapsed = time.monotonic() - self.started
+        statistics = {
+            'endpoint_cpu_user_s': totals[0],
+            'endpoint_cpu_system_s': totals[1],
+            'endpoint_voluntary_ctxt_switches': totals[2],
+            'endpoint_involuntary_ctxt_switches': totals[3],
+        }
+        try:
+            # Exact figures, including the CPU time since the last sample
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            statistics.update({
+                'endpoint_cpu_user_s': usage.ru_utime,
+                'endpoint_cpu_system_s': usage.ru_stime,
+                'endpoint_max_rss_bytes': usage.ru_maxrss * 1024,
+                'endpoint_voluntary_ctxt_switches': usage.ru_nvcsw,
+                'endpoint_involuntary_ctxt_switches': usage.ru_nivcsw,
+            })
+        except ChildProcessError:
+            pass  # already reaped: the sampled totals are what is left
+        if totals[4] is not None:
+            statistics['endpoint_syscalls'] = totals[4]
+        if elapsed > 0:
+            statistics['endpoint_sampling_overhead_percent'] = 100 * self.sampling_time / elapsed
+
+        if delivered_bytes:
+            cpu_time = statistics['endpoint_cpu_user_s'] + statistics['endpoint_cpu_system_s']
+            statistics['endpoint_delivered_bytes'] = delivered_bytes
+            statistics['endpoint_cpu_ns_per_byte'] = cpu_time * 1e9 / delivered_bytes
+            frequency = cpu_frequency()
+            if frequency:
+                statistics['endpoint_cpu_cycles_per_byte'] = cpu_time * frequency / delivered_bytes
+            if statistics.get('endpoint_syscalls'):
+                statistics['endpoint_bytes_per_syscall'] = delivered_bytes / statistics['endpoint_syscalls']
+
+        try:
+            self.collect_agent.send_stat(self.collect_agent.now(), suffix=self.suffix, **statistics)
+        except Exception as e:
+            print(f"Errore durante l'invio delle statistiche dell'endpoint: {e}")
+        print(f"Endpoint resources: {statistics}")
+        return statistics
+
+
+def run_command(cmd, cwd=None, accounting=None):
     "Run cmd and wait for command to complete then return a CompletedProcessess instance"
     try:
         #p = subprocess.run(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd, check=False) #.Popen shell=True
 
         p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE)
+        if accounting is not None:
+            accounting.start(p.pid)
         grep = subprocess.Popen(["grep", "python"], stdin=p.stdout, stdout=subprocess.PIPE)
         for line in grep.stdout:
             print(line.decode("utf-8").strip())
@@ -306,15 +1798,18 @@ def tail_file(file_path):
     timeout = 3
 
     with open(file_path, 'r') as file:
+        telemetry = IngestionTelemetry(collect_agent)
         while True:
             line = file.readline()
+            telemetry.maybe_report(file)
             if line:
+                telemetry.line_parsed()
                 cleaned_line = line.strip()
                 if cleaned_line:
                     try:
                         data = json.loads(cleaned_line)
                         if data.get("name") == "recovery:metrics_updated":
-                            process_statistics(data)
+                            telemetry.stat_shipped(process_statistics(data))
 
                     except json.JSONDecodeError:
                         pass
@@ -337,7 +1832,9 @@ def process_statistics(data):
         'bytes_in_flight': stats.get('bytes_in_flight'),
     }
     print(statistics)
-    collect_agent.send_stat(collect_agent.now(), **statistics)
+    timestamp = collect_agent.now()
+    collect_agent.send_stat(timestamp, **statistics)
+    return timestamp
     
     
 def manage_log_client_directory(base_dir, experiment_id, run_number):
@@ -398,14 +1895,24 @@ def client(implementation, server_port, log_dir, extra_args, server_ip, resource
 
 
 
-def server(implementation, congestion_control, server_port, log_dir, extra_args, server_ip):
+def server(implementation, congestion_control, server_port, log_dir, extra_args, server_ip, idle_timeout, reuse_flow_slots, stat_sink, sink_file, sink_address, archive_dir, packet_stats_interval, downsample_interval, qlog_sample_every, qlog_sample_first, qlog_sample_fraction, experiment_id, qdisc):
     ensure_directory_exists(log_dir)
     
     timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     output_dir = os.path.join(log_dir, timestamp)
     os.makedirs(output_dir, exist_ok=True)
+    results = ResultsStore(log_dir)
+    results.register_run(
+            'quicosWAVE', 'server', experiment_id=experiment_id or timestamp, congestion_control=congestion_control,
+            qdisc=qdisc or read_current_qdisc(), log_dir=output_dir)
+
+    # Installed before the readers are forked so that they inherit the hooks
+    JobProfiler(log_dir).install()
     
-    watchdog_thread = Thread(target=start_watchdog, args=(collect_agent, output_dir), daemon=True)
+    sampler = QlogSampler(qlog_sample_every, qlog_sample_first, qlog_sample_fraction)
+    sink = build_stat_sink(stat_sink, 'quicosWAVE', sink_file or os.path.join(output_dir, SINK_FILE), sink_address)
+    event_handler = LogFileHandler(sink, idle_timeout, reuse_flow_slots, packet_stats_interval, downsample_interval, results, sampler)
+    watchdog_thread = Thread(target=start_watchdog, args=(event_handler, output_dir, archive_dir), daemon=True)
     watchdog_thread.start()
     with open(os.path.join(output_dir, 'log_server.txt'), 'w+') as log_file:
         cmd = build_cmd(implementation, 'server', server_port, log_file.name, server_ip=server_ip, extra_args=extra_args)
@@ -414,8 +1921,16 @@ def server(implementation, congestion_control, server_port, log_dir, extra_args,
         #tail_thread = threading.Thread(target=tail_file, args=(log_file_path,))
         #tail_thread.start()
         print("Command to be executed:", ' '.join(cmd))
-        p = run_command(cmd, cwd=HTDOCS)
+        accounting = EndpointAccounting(sink)
+        try:
+            p = run_command(cmd, cwd=HTDOCS, accounting=accounting)
+            costs = accounting.finish(p, event_handler.delivered_bytes())
+        finally:
+            # The watchdog thread is a daemon: ship what it left buffered
+            sink.flush()
         print(f"Return code: {p.returncode}")
+    results.finish_run()
+    results.add_kpis(**costs)
 
 
 
@@ -493,6 +2008,60 @@ if __name__ == "__main__":
 	    'server_ip', type=str, 
 	    help='The IP address for the server to listen on'
 	)
+        parser_server.add_argument(
+            '-t', '--idle-timeout', type=float, default=IDLE_TIMEOUT,
+            help='Seconds without new qlog lines after which a connection is considered closed'
+        )
+        parser_server.add_argument(
+            '-r', '--reuse-flow-slots', action='store_true',
+            help='Reuse the flow indices of closed connections for new ones'
+        )
+        parser_server.add_argument(
+            '-k', '--stat-sink', choices=STAT_SINKS, default='collect_agent',
+            help='Where the statistics of the qlogs go: the OpenBACH collector, a local InfluxDB line protocol '
+                 'file or UDP line protocol datagrams'
+        )
+        parser_server.add_argument(
+            '--sink-file', type=str, default=None,
+            help=f'Line protocol file of the file sink (default: {SINK_FILE} in the log directory of the run)'
+        )
+        parser_server.add_argument(
+            '--packet-stats-interval', type=float, default=PACKET_STATS_INTERVAL,
+            help='Seconds of qlog time between two packet-level statistics of a flow (0 to disable them)'
+        )
+        parser_server.add_argument(
+            '--downsample-interval', type=float, default=DOWNSAMPLE_INTERVAL,
+            help='Seconds between two shipped points of a flow outside anomalies (0 to ship every point); '
+                 'anomaly events are always shipped and anomalies always get every point'
+        )
+        parser_server.add_argument(
+            '--qlog-sample-every', type=int, default=QLOG_SAMPLE_EVERY,
+            help='Read the qlog of one connection in N in full; the others only get an end-of-connection summary'
+        )
+        parser_server.add_argument(
+            '--qlog-sample-first', type=int, default=QLOG_SAMPLE_FIRST,
+            help='Read in full the qlogs of the first K connections only (0 for no limit)'
+        )
+        parser_server.add_argument(
+            '--qlog-sample-fraction', type=float, default=QLOG_SAMPLE_FRACTION,
+            help='Read in full the qlogs of this fraction of the connections (hash of the qlog name)'
+        )
+        parser_server.add_argument(
+            '--experiment-id', type=str, default=None,
+            help='Experiment of the run in the results database of the log directory (default: name of the log folder of the run)'
+        )
+        parser_server.add_argument(
+            '--qdisc', type=str, default=None,
+            help=f'Bottleneck qdisc recorded with the run (default: the one last set by queueManager in {QDISC_FILE})'
+        )
+        parser_server.add_argument(
+            '--sink-address', type=str, default=SINK_ADDRESS,
+            help='HOST:PORT receiving the datagrams of the udp sink'
+        )
+        parser_server.add_argument(
+            '-a', '--archive-dir', type=writable_dir, default=None,
+            help='Archive the qlogs incrementally into this directory (only the appended bytes are copied)'
+        )
         parser_client = subparsers.add_parser(
 	    'client', 
 	    help='Run in client mode'